@@ -1,24 +1,56 @@
 from django.contrib import admin
-from .models import Post, Comment
+from django.contrib.admin.views.main import ChangeList
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import invalidate_sidebar
+from .counters import recount_comments
+from .models import Post, Comment, OutboundEmail
+from .pagecache import purge_pages
+from .pagination import EstimatedCountPaginator
+from .search import get_backend
 
 
 # Every line writen here customizes the admin screen panel. You can do it
 # one by one and seeing the results.
 
+# The changelists below are made for big tables: they load only the columns
+# they show (list_columns), don't count the whole table twice (the
+# "N total" link needs show_full_result_count) and count pages with
+# EstimatedCountPaginator (see pagination.py).
+class ColumnsChangeList(ChangeList):
+    def get_queryset(self, request):
+        return super().get_queryset(request).only(*self.model_admin.list_columns)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    list_columns = ()
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return ColumnsChangeList
+
+
 # Only this line creates a editable Post model on admin page:
 # admin.site.register(Post)
 #
 # This decorator makes that class PostAdmin displayable according fields below.
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
+class PostAdmin(LargeTableAdmin):
     # it controls which column will be displayed.
     list_display = ('title', 'slug', 'author', 'publish', 'status')
+    # the author comes in the same query, and only the columns above are loaded.
+    list_select_related = ('author',)
+    list_columns = ('title', 'slug', 'author__username', 'publish', 'status')
 
     # it generates a column list where you can sort by those fields.
     list_filter = ('status', 'created', 'publish', 'author')
 
-    # it controls which fields will be searchable on the search bar.
-    search_fields = ('title', 'body')
+    # it shows the search bar. The search itself goes through the search
+    # backend's index (get_search_results below), not LIKE '%...%' over
+    # every body.
+    search_fields = ('title',)
 
     # when you add new posts, the slug will be populated automatically,
     # when you write the title.
@@ -34,10 +66,54 @@ class PostAdmin(admin.ModelAdmin):
     # it adds a little arrow that will order by status or publish.
     ordering = ('status', 'publish')
 
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return get_backend().filter_admin(queryset, search_term), False
+
+
+# Approving or deactivating comments in bulk is one UPDATE, which doesn't send
+# the post_save signals. So what they would do is done here, once for all the
+# posts involved: the counters are counted again, the sidebar is thrown away
+# and the comments of those posts are purged from the page cache.
+def set_comments_active(queryset, active):
+    with transaction.atomic():
+        changing = queryset.exclude(active=active)
+        post_ids = set(changing.values_list('post_id', flat=True))
+        changed = changing.update(active=active, updated=timezone.now())
+        if changed:
+            recount_comments(post_ids)
+            invalidate_sidebar()
+            purge_pages(*[f'comments:{post_id}' for post_id in post_ids])
+    return changed
+
 
 # every thing on this new class have the same properties and behaviors as described above.
 @admin.register(Comment)
-class CommentAdmin(admin.ModelAdmin):
+class CommentAdmin(LargeTableAdmin):
     list_display = ('name', 'email', 'post', 'created', 'active')
+    list_select_related = ('post',)
+    list_columns = ('name', 'email', 'post__title', 'created', 'active')
     list_filter = ('active', 'created', 'updated')
-    search_fields = ('name', 'email', 'body')
+    # an exact email or the start of a name: no more scanning every body.
+    search_fields = ('=email', '^name')
+    actions = ['approve_comments', 'deactivate_comments']
+
+    def approve_comments(self, request, queryset):
+        changed = set_comments_active(queryset, True)
+        self.message_user(request, f'{changed} comment(s) approved.')
+    approve_comments.short_description = 'Approve selected comments'
+
+    def deactivate_comments(self, request, queryset):
+        changed = set_comments_active(queryset, False)
+        self.message_user(request, f'{changed} comment(s) deactivated.')
+    deactivate_comments.short_description = 'Deactivate selected comments'
+
+
+# the outbox of post_share, to follow what was sent and what is failing.
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to', 'status', 'attempts', 'next_attempt', 'sent')
+    list_filter = ('status',)
+    search_fields = ('to', 'subject')
@@ -0,0 +1,326 @@
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, Q, Sum, prefetch_related_objects
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from taggit.models import Tag
+
+from .conditional import conditional, latest, make_etag, sidebar_state
+from .models import Post, Comment
+from .pagination import KeysetPaginator, KeysetStream
+from .popularity import track_views
+from .postlookup import lookup_post
+from .querybudget import query_budget
+from .related import post_tagged_items
+from .search import get_backend
+
+# A read-only JSON API, for the mobile app and the headless frontend: the
+# published posts (all of them, by tag, or one by its date and slug), their
+# comments, the tags and the search.
+#
+# - ?fields=title,url picks the fields of each object, and the columns of the
+#   other fields aren't even loaded (a list of titles never reads a body).
+# - The lists are paginated by cursor: each answer has "next", the URL of the
+#   next page (null on the last one). ?limit= changes the page size, up to
+#   BLOG_API_MAX_PAGE_SIZE.
+# - ETag and Last-Modified come from the same data as the HTML pages' (see
+#   conditional.py), so an unchanged answer is a 304 without reading the rows.
+# - The JSON is written while the rows are read, BLOG_API_CHUNK_SIZE rows at a
+#   time, so a big page is never whole in memory. Django 3.0's ASGI handler
+#   reads streaming responses on the event loop, where the ORM can't run, so
+#   under ASGI the rows are read in the view and only the JSON is streamed.
+#
+# The rows cost one query per chunk, two with the tags. The query budgets
+# count what runs in the view, so they leave room for one chunk (the rows
+# of a streamed page are read after it, under ASGI in it).
+
+
+class ApiError(Exception):
+    pass
+
+
+# field name -> (the columns it needs, how it's written)
+POST_FIELDS = {
+    'id': ((), lambda post: post.pk),
+    'title': (('title',), lambda post: post.title),
+    'slug': (('slug',), lambda post: post.slug),
+    'url': (('slug', 'publish'), lambda post: post.get_absolute_url()),
+    'author': (('author', 'author__username'), lambda post: post.author.username),
+    'publish': (('publish',), lambda post: post.publish),
+    'updated': (('updated',), lambda post: post.updated),
+    'excerpt_html': (('excerpt_html',), lambda post: post.excerpt_html),
+    'body': (('body',), lambda post: post.body),
+    'body_html': (('body_html',), lambda post: post.body_html),
+    'comments': (('active_comments',), lambda post: post.active_comments),
+    'tags': ((), lambda post: sorted(tag.slug for tag in post.tags.all())),
+}
+POST_LIST_FIELDS = ('id', 'title', 'slug', 'url', 'author', 'publish', 'excerpt_html', 'tags', 'comments')
+POST_DETAIL_FIELDS = POST_LIST_FIELDS + ('updated', 'body_html')
+
+# the e-mails of the readers are never shown.
+COMMENT_FIELDS = {
+    'id': ((), lambda comment: comment.pk),
+    'name': (('name',), lambda comment: comment.name),
+    'body': (('body',), lambda comment: comment.body),
+    'created': (('created',), lambda comment: comment.created),
+}
+
+TAG_FIELDS = ('slug', 'name', 'url', 'posts')
+
+
+def api_view(view):
+    # Only GET and HEAD, and the errors answer JSON too.
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            response = JsonResponse({'error': 'Method not allowed.'}, status=405)
+            response['Allow'] = 'GET, HEAD'
+            return response
+        try:
+            return view(request, *args, **kwargs)
+        except ApiError as error:
+            return JsonResponse({'error': str(error)}, status=400)
+        except Http404:
+            return JsonResponse({'error': 'Not found.'}, status=404)
+    return inner
+
+
+def requested_fields(request, available, default):
+    if 'fields' not in request.GET:
+        return list(default)
+    fields = [name.strip() for name in request.GET['fields'].split(',') if name.strip()]
+    unknown = [name for name in fields if name not in available]
+    if unknown or not fields:
+        raise ApiError(f"Unknown fields: {', '.join(unknown) or '(none)'}. "
+                       f"Available: {', '.join(available)}.")
+    return list(dict.fromkeys(fields))
+
+
+def page_size(request):
+    limit = getattr(settings, 'BLOG_API_PAGE_SIZE', 20)
+    if 'limit' in request.GET:
+        try:
+            limit = int(request.GET['limit'])
+        except ValueError:
+            raise ApiError('limit must be a number.')
+    return min(max(limit, 1), getattr(settings, 'BLOG_API_MAX_PAGE_SIZE', 500))
+
+
+def chunk_size():
+    return getattr(settings, 'BLOG_API_CHUNK_SIZE', 100)
+
+
+def only_fields(queryset, specs, fields, always=()):
+    # the queryset loads the columns of the asked fields, and nothing else.
+    columns = set(always)
+    for name in fields:
+        columns.update(specs[name][0])
+    if any(column.startswith('author__') for column in columns):
+        queryset = queryset.select_related('author')
+    return queryset.only(queryset.model._meta.pk.name, *columns)
+
+
+def serializer(specs, fields):
+    writers = [(name, specs[name][1]) for name in fields]
+    return lambda obj: {name: write(obj) for name, write in writers}
+
+
+def with_tags(batches, fields):
+    # the tags of a whole batch in one query (prefetch_related doesn't work
+    # with iterator()).
+    for batch in batches:
+        if 'tags' in fields:
+            prefetch_related_objects(batch, 'tags')
+        yield batch
+
+
+def next_url(request, **params):
+    query = request.GET.copy()
+    for name, value in params.items():
+        query[name] = value
+    return request.path + '?' + query.urlencode()
+
+
+def stream_json(request, batches, serialize, tail):
+    # {"results": [...], ...tail()}: tail is called once every row was
+    # written, because the next page is only known then.
+    def chunks():
+        yield '{"results": ['
+        first = True
+        for batch in batches:
+            text = ', '.join(json.dumps(serialize(obj), cls=DjangoJSONEncoder) for obj in batch)
+            if text:
+                yield text if first else ', ' + text
+                first = False
+        yield '], ' + json.dumps(tail(), cls=DjangoJSONEncoder)[1:]
+
+    if isinstance(request, ASGIRequest):
+        batches = list(batches)
+    return StreamingHttpResponse(chunks(), content_type='application/json')
+
+
+def stream_posts(request, queryset, default_fields=POST_LIST_FIELDS):
+    fields = requested_fields(request, POST_FIELDS, default_fields)
+    # the rows are read once the view returned: the database is chosen now,
+    # while the request's routing (see routers.py) is still known.
+    queryset = only_fields(queryset, POST_FIELDS, fields, always=('publish',))
+    queryset = queryset.using(queryset.db)
+    stream = KeysetStream(KeysetPaginator(queryset, page_size(request)),
+                          request.GET.get('cursor'), chunk_size())
+    return stream_json(request, with_tags(stream, fields), serializer(POST_FIELDS, fields),
+                       lambda: {'next': stream.next_cursor and next_url(request, cursor=stream.next_cursor)})
+
+
+def list_validators(request, tag_slug=None):
+    # The posts, their counters and the tags change Post.updated, the counts
+    # of posts and of comments: the answer changes with them.
+    if tag_slug is None:
+        scope = sidebar_state()
+    else:
+        scope = (Post.published.filter(tags__slug=tag_slug)
+                 .aggregate(last=Max('updated'), posts=Count('id'), comments=Sum('active_comments')))
+    return (make_etag('api-list', tag_slug, scope, request.GET.urlencode()),
+            latest(scope['last']))
+
+
+def detail_validators(request, year, month, day, post):
+    found = lookup_post(Post.published.values('pk', 'updated', 'active_comments'), year, month, day, post)
+    if found is None:
+        return None, None
+    return make_etag('api-detail', found, request.GET.urlencode()), latest(found['updated'])
+
+
+def comments_validators(request, post_id):
+    found = (Post.published.filter(pk=post_id)
+             .annotate(comments_updated=Max('comments__updated', filter=Q(comments__active=True)))
+             .values('active_comments', 'comments_updated').first())
+    if found is None:
+        return None, None
+    return (make_etag('api-comments', post_id, found, request.GET.urlencode()),
+            latest(found['comments_updated']))
+
+
+def state_validators(request):
+    # the tags and the search follow what's published.
+    scope = sidebar_state()
+    return (make_etag('api', request.path, scope, request.GET.urlencode()),
+            latest(scope['last']))
+
+
+@query_budget(3)
+@api_view
+@conditional(list_validators)
+def post_list(request):
+    return stream_posts(request, Post.published.all())
+
+
+@query_budget(4)
+@api_view
+@conditional(list_validators)
+def post_list_by_tag(request, tag_slug):
+    tag = get_object_or_404(Tag, slug=tag_slug)
+    return stream_posts(request, Post.published.filter(tags__in=[tag]))
+
+
+@query_budget(3)
+@api_view
+@track_views
+@conditional(detail_validators)
+def post_detail(request, year, month, day, post):
+    fields = requested_fields(request, POST_FIELDS, POST_DETAIL_FIELDS)
+    found = lookup_post(only_fields(Post.published.all(), POST_FIELDS, fields), year, month, day, post)
+    if found is None:
+        raise Http404
+    if 'tags' in fields:
+        prefetch_related_objects([found], 'tags')
+    return JsonResponse(serializer(POST_FIELDS, fields)(found), encoder=DjangoJSONEncoder)
+
+
+@query_budget(3)
+@api_view
+@conditional(comments_validators)
+def post_comments(request, post_id):
+    # the oldest first, like on the post's page.
+    get_object_or_404(Post.published.only('pk'), pk=post_id)
+    fields = requested_fields(request, COMMENT_FIELDS, COMMENT_FIELDS)
+    queryset = only_fields(Comment.objects.filter(post_id=post_id, active=True),
+                           COMMENT_FIELDS, fields, always=('created',))
+    queryset = queryset.using(queryset.db)
+    stream = KeysetStream(KeysetPaginator(queryset, page_size(request), ordering=('created', 'id')),
+                          request.GET.get('cursor'), chunk_size())
+    return stream_json(request, stream, serializer(COMMENT_FIELDS, fields),
+                       lambda: {'next': stream.next_cursor and next_url(request, cursor=stream.next_cursor)})
+
+
+@query_budget(2)
+@api_view
+@conditional(state_validators)
+def tag_list(request):
+    # Every tag of a published post, by slug. There are far fewer tags than
+    # posts, so they come in one answer, without pages.
+    fields = requested_fields(request, TAG_FIELDS, TAG_FIELDS)
+    rows = (post_tagged_items()
+            .filter(object_id__in=Post.published.values('pk'))
+            .values('tag__slug', 'tag__name')
+            .order_by('tag__slug'))
+    # counting is only done when it's asked for.
+    rows = rows.annotate(posts=Count('id')) if 'posts' in fields else rows.distinct()
+    rows = rows.using(rows.db).iterator(chunk_size=chunk_size())
+
+    def serialize(row):
+        tag = {'slug': row['tag__slug'],
+               'name': row['tag__name'],
+               'url': reverse('BlogApp:api_posts_by_tag', args=[row['tag__slug']]),
+               'posts': row.get('posts')}
+        return {name: tag[name] for name in fields}
+
+    return stream_json(request, batched(rows, chunk_size()), serialize, lambda: {'next': None})
+
+
+def batched(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@query_budget(4)
+@api_view
+@conditional(state_validators)
+def post_search(request):
+    # Ranked results don't fit a cursor, so these pages are numbered (up to
+    # BLOG_SEARCH_MAX_PAGES of them, like the search page).
+    query = request.GET.get('q', '').strip()
+    if not query:
+        raise ApiError('Give a query: ?q=...')
+    fields = requested_fields(request, POST_FIELDS, POST_LIST_FIELDS)
+    limit = page_size(request)
+    try:
+        number = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        raise ApiError('page must be a number.')
+    number = min(number, settings.BLOG_SEARCH_MAX_PAGES)
+    offset = (number - 1) * limit
+    ids = get_backend().search_ids(query, offset + limit + 1)
+    has_next = len(ids) > offset + limit and number < settings.BLOG_SEARCH_MAX_PAGES
+    page_ids = ids[offset:offset + limit]
+
+    queryset = only_fields(Post.published.all(), POST_FIELDS, fields)
+    queryset = queryset.using(queryset.db)
+
+    def ranked():
+        for chunk in batched(page_ids, chunk_size()):
+            found = queryset.in_bulk(chunk)
+            yield [found[pk] for pk in chunk if pk in found]
+
+    return stream_json(request, with_tags(ranked(), fields), serializer(POST_FIELDS, fields),
+                       lambda: {'next': next_url(request, page=number + 1) if has_next else None})
@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class BlogappConfig(AppConfig):
     name = 'BlogApp'
+
+    def ready(self):
+        # it connects the signal receivers.
+        from . import signals  # noqa: F401
+        # it warns when the page cache can't be shared by the processes.
+        from .pagecache import check_page_cache
+        checks.register(check_page_cache, checks.Tags.caches)
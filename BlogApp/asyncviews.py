@@ -0,0 +1,119 @@
+import asyncio
+import inspect
+
+from asgiref.sync import sync_to_async
+from decouple import config
+from django.db import close_old_connections
+from django.shortcuts import render, get_object_or_404
+
+from . import views
+from .conditional import conditional, list_validators, detail_validators
+from .forms import CommentForm, EmailPostForm
+from .mailqueue import enqueue_mail
+from .models import Post
+from .pagecache import cache_page_by_tags
+from .popularity import track_views
+from .querybudget import inherited_wrappers, query_budget
+from .templatetags import blog_tags
+
+# Async versions of the views, used by BlogApp/urls.py when BLOG_ASYNC_VIEWS
+# is True and the site runs under ASGI (BlogProject/asgi.py). The pieces of a
+# page that don't depend on each other (the comments, the similar posts, the
+# sidebar) are fetched at the same time, each in its own thread with its own
+# database connection, and the event loop is free while they run.
+#
+# Django runs async views since 3.1.
+
+
+def in_thread(function):
+    # It runs a sync function in a worker thread. The thread's connection is
+    # closed when it's too old (like at the end of a request), and its queries
+    # count for the request (see querybudget.py and metrics.py).
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            with inherited_wrappers():
+                return function(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def fetch(function, *args, **kwargs):
+    return in_thread(function)(*args, **kwargs)
+
+
+def sidebar():
+    # The sidebar tags cache their results, so once these ran the template
+    # renders them without queries.
+    blog_tags.total_posts()
+    blog_tags.show_latest_posts(3)
+    blog_tags.get_most_commented_posts()
+    blog_tags.get_popular_posts()
+
+
+@query_budget(7, post_list_by_tag=9)
+@cache_page_by_tags
+@conditional(list_validators)
+async def post_list(request, tag_slug=None):
+    context, _ = await asyncio.gather(fetch(views.post_list_context, request, tag_slug),
+                                      fetch(sidebar))
+    return await fetch(render, request, 'BlogApp/post/list.html', context)
+
+
+@query_budget(10)
+@track_views
+@cache_page_by_tags
+@conditional(detail_validators)
+async def post_detail(request, year, month, day, post):
+    if request.method == 'POST':
+        # posting a comment saves, then reads again: one step after the
+        # other, so the sync view does it.
+        return await fetch(inspect.unwrap(views.post_detail), request, year, month, day, post)
+
+    post = await fetch(views.get_published_post, year, month, day, post)
+    comments, similar_posts, _ = await asyncio.gather(
+        fetch(views.comments_page, post, request.GET.get('comments')),
+        fetch(views.similar_posts_of, post),
+        fetch(sidebar))
+    views.detail_depends_on(request, post, similar_posts)
+    return await fetch(render, request, 'BlogApp/post/detail.html',
+                       {'post': post,
+                        'comments': comments,
+                        'new_comment': None,
+                        'comment_form': CommentForm(),
+                        'similar_posts': similar_posts})
+
+
+@query_budget(5, POST=6)
+async def post_share(request, post_id):
+    post, _ = await asyncio.gather(fetch(get_object_or_404, Post, id=post_id, status='published'),
+                                   fetch(sidebar))
+    sent = False
+    if request.method == 'POST':
+        form = EmailPostForm(request.POST)
+        if form.is_valid():
+            cd = form.cleaned_data
+            post_url = request.build_absolute_uri(post.get_absolute_url())
+            subject = f"{cd['name']} recommends you read {post.title}"
+            message = f"Read {post.title} at {post_url}\n\n{cd['name']}'s comments: {cd['comments']}"
+            # writing to the outbox is a query, so it runs in a thread too; the
+            # mail server is only ever talked to by the mail workers.
+            await fetch(enqueue_mail, subject, message, config('EMAIL_HOST_USER'), [cd['to']])
+            sent = True
+    else:
+        form = EmailPostForm()
+    return await fetch(render, request, 'BlogApp/post/share.html', {'post': post,
+                                                                     'form': form,
+                                                                     'sent': sent})
+
+
+@query_budget(5)
+async def post_search(request):
+    context, _ = await asyncio.gather(fetch(views.search_context, request), fetch(sidebar))
+    return await fetch(render, request, 'BlogApp/post/search.html', context)
+
+
+# they're short, the sync views are enough.
+post_comments = views.post_comments
+post_suggest = views.post_suggest
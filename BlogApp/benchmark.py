@@ -0,0 +1,461 @@
+import asyncio
+import datetime
+import gc
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import django
+from django.core.cache import cache
+from django.db import connection
+from django.core.asgi import get_asgi_application
+from django.core.wsgi import get_wsgi_application
+from django.test import Client
+from django.test.utils import (override_settings, setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+from django.urls import reverse
+
+from .bulk import BlogImporter
+from .internal import HEADER, internal_headers, internal_token
+from .models import Post
+from .pagination import KeysetPaginator
+from .popularity import view_score
+from .querybudget import count_queries
+from .suggest import Suggestions
+from .templatetags import blog_tags
+
+# A benchmark of every route: it fills a database with synthetic posts, asks
+# each URL many times, and writes the latency percentiles, the queries and the
+# memory of each one to a JSON file. Two files can be compared to find
+# regressions (see the benchmark command).
+
+WORDS = ('django python search index cache query page post blog tag comment feed '
+         'sitemap server client model view template database cursor stream batch '
+         'latency memory worker signal request response').split()
+
+
+# --- synthetic data ---
+
+def zipf_weights(count, skew=1.1):
+    # a few tags are on most posts and most tags are on a few, as in real blogs.
+    return [1 / (rank + 1) ** skew for rank in range(count)]
+
+
+def paragraph(rng, words=60):
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return f'{text[:1].upper()}{text[1:]}.'
+
+
+def synthetic_rows(posts, tags, comments_per_post, seed=0):
+    # The rows of the export_blog format, so they're loaded by BlogImporter
+    # (bulk_create) like a real import.
+    rng = random.Random(seed)
+    tag_names = [f'tag-{number}' for number in range(tags)]
+    weights = zipf_weights(tags)
+    start = datetime.datetime(2015, 1, 1)
+    span = (datetime.datetime(2020, 1, 1) - start).total_seconds()
+    comment_id = 0
+    for post_id in range(1, posts + 1):
+        publish = (start + datetime.timedelta(seconds=span * post_id / posts)).isoformat()
+        post_tags = sorted(set(rng.choices(tag_names, weights, k=rng.randint(1, 4))))
+        yield {'type': 'post', 'id': post_id, 'title': f'{rng.choice(WORDS).title()} post {post_id}',
+               'slug': f'post-{post_id}', 'author': 'benchmark',
+               'body': '\n\n'.join(paragraph(rng) for _ in range(rng.randint(2, 8))),
+               'publish': publish, 'created': publish, 'updated': publish,
+               'status': 'draft' if rng.random() < 0.05 else 'published', 'tags': post_tags}
+        # comments per post follow an exponential distribution around the mean.
+        for _ in range(int(rng.expovariate(1 / comments_per_post)) if comments_per_post else 0):
+            comment_id += 1
+            yield {'type': 'comment', 'id': comment_id, 'post': post_id, 'name': 'reader',
+                   'email': 'reader@example.com', 'body': paragraph(rng, 20),
+                   'created': publish, 'updated': publish, 'active': rng.random() < 0.9}
+
+
+def generate(posts, tags, comments_per_post, seed=0, batch_size=1000):
+    importer = BlogImporter()
+    batch = []
+    for row in synthetic_rows(posts, tags, comments_per_post, seed):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            importer.import_batch(batch)
+            batch = []
+    importer.import_batch(batch)
+    importer.finish()
+    return importer.imported
+
+
+@contextmanager
+def benchmark_database(**overrides):
+    # Everything happens in a test database, created and dropped here, so
+    # the real data is never touched.
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    index_dir = tempfile.mkdtemp()
+    # no mail workers, and no flusher thread writing views (and throwing the
+    # sidebar away) in the middle of the measures.
+    overrides = dict({'BLOG_QUERY_BUDGET_STRICT': False, 'BLOG_MAIL_WORKERS': 0,
+                      'BLOG_VIEW_FLUSH_SECONDS': 0}, **overrides)
+    if connection.vendor != 'postgresql':
+        # PostgreSQL's full-text search isn't there, so our own index is used.
+        overrides.update(BLOG_SEARCH_BACKEND='BlogApp.search.inverted.InvertedIndexBackend',
+                         BLOG_SEARCH_INDEX_PATH=os.path.join(index_dir, 'search.idx'))
+    try:
+        with override_settings(**overrides):
+            yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        teardown_test_environment()
+
+
+# --- measuring ---
+
+def percentile(values, fraction):
+    # nearest rank, on sorted values.
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(run, iterations, cold):
+    # cold: the cache is cleared before each run, so nothing comes from the
+    # page cache nor from the sidebar cache.
+    timings = []
+    queries = []
+    for _ in range(iterations):
+        if cold:
+            cache.clear()
+        with count_queries() as counter:
+            started = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - started) * 1000)
+        queries.append(counter.count)
+
+    # the memory is measured in one more run, tracemalloc slows everything down.
+    if cold:
+        cache.clear()
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'p50_ms': percentile(timings, 0.5),
+            'p90_ms': percentile(timings, 0.9),
+            'p99_ms': percentile(timings, 0.99),
+            'mean_ms': sum(timings) / len(timings),
+            'queries': max(queries),
+            'peak_kb': peak / 1024}
+
+
+def get(client, url):
+    def run():
+        response = client.get(url)
+        if response.status_code != 200:
+            raise AssertionError(f'{url} answered {response.status_code}')
+        # streamed responses (the sitemaps) are only made when they're read.
+        if response.streaming:
+            b''.join(response.streaming_content)
+    return run
+
+
+def routes(client):
+    # Every route of BlogApp/urls.py (and the sitemaps), with URLs picked
+    # from the data: the middle post, the most and least used tags...
+    post = Post.published.order_by('pk')[Post.published.count() // 2]
+    popular = 'tag-0'
+    rare = (Post.tags.most_common().order_by('num_times', 'slug').values_list('slug', flat=True).first()
+            or popular)
+    list_url = reverse('BlogApp:post_list')
+    second_page = KeysetPaginator(Post.published.all(), 2).page().next_cursor
+    month = post.publish
+    return {
+        'post_list': get(client, list_url),
+        'post_list (page 2)': get(client, f'{list_url}?cursor={second_page}'),
+        'post_list_by_tag (popular)': get(client, reverse('BlogApp:post_list_by_tag', args=[popular])),
+        'post_list_by_tag (rare)': get(client, reverse('BlogApp:post_list_by_tag', args=[rare])),
+        'post_detail': get(client, post.get_absolute_url()),
+        'post_share': get(client, reverse('BlogApp:post_share', args=[post.pk])),
+        'post_comments': get(client, reverse('BlogApp:post_comments', args=[post.pk])),
+        'post_feed': get(client, reverse('BlogApp:post_feed')),
+        'post_feed_atom': get(client, reverse('BlogApp:post_feed_atom')),
+        'post_feed_by_tag': get(client, reverse('BlogApp:post_feed_by_tag', args=[popular])),
+        'post_feed_by_tag_atom': get(client, reverse('BlogApp:post_feed_by_tag_atom', args=[popular])),
+        'post_search': get(client, reverse('BlogApp:post_search') + '?query=django+python'),
+        'post_suggest': get(client, reverse('BlogApp:post_suggest') + '?q=dja'),
+        'api_posts': get(client, reverse('BlogApp:api_posts')),
+        'api_posts (titles)': get(client, reverse('BlogApp:api_posts') + '?fields=title,url'),
+        'api_post_detail': get(client, reverse('BlogApp:api_post_detail',
+                                               args=[post.publish.year, post.publish.month,
+                                                     post.publish.day, post.slug])),
+        'api_post_comments': get(client, reverse('BlogApp:api_post_comments', args=[post.pk])),
+        'api_tags': get(client, reverse('BlogApp:api_tags')),
+        'api_posts_by_tag (popular)': get(client, reverse('BlogApp:api_posts_by_tag', args=[popular])),
+        'api_search': get(client, reverse('BlogApp:api_search') + '?q=django+python'),
+        'sitemap': get(client, reverse('sitemap')),
+        'sitemap_section': get(client, reverse('sitemap_section', args=[month.year, month.month])),
+        'total_posts tag': blog_tags.total_posts,
+        'show_latest_posts tag': lambda: blog_tags.show_latest_posts(3),
+        'get_most_commented_posts tag': lambda: list(blog_tags.get_most_commented_posts()),
+        'get_popular_posts tag': lambda: list(blog_tags.get_popular_posts()),
+    }
+
+
+def run_benchmark(iterations, dataset):
+    # the benchmark's requests aren't visits (see internal.py).
+    client = Client(**internal_headers())
+    measured = routes(client)
+    # the first request of each route loads what is loaded once per process.
+    for run in measured.values():
+        run()
+
+    results = {}
+    for name, run in measured.items():
+        results[name] = {'cold': measure(run, iterations, cold=True),
+                         'warm': measure(run, iterations, cold=False)}
+    return {'meta': {'database': connection.vendor,
+                     'python': platform.python_version(),
+                     'django': django.get_version(),
+                     'iterations': iterations,
+                     'dataset': dataset,
+                     'date': datetime.datetime.now().isoformat()},
+            'results': results}
+
+
+# --- WSGI and ASGI under concurrent load ---
+
+def load_paths():
+    # what a crowd of readers asks for: the list, the tag lists and the posts.
+    posts = list(Post.published.order_by('-publish')[:50])
+    tags = Post.tags.most_common()[:10].values_list('slug', flat=True)
+    return ([reverse('BlogApp:post_list')] * 10
+            + [reverse('BlogApp:post_list_by_tag', args=[tag]) for tag in tags]
+            + [post.get_absolute_url() for post in posts])
+
+
+def load_summary(timings, errors, elapsed):
+    return {'requests': len(timings),
+            'errors': errors,
+            'requests_per_second': len(timings) / elapsed if elapsed else 0,
+            'p50_ms': percentile(timings, 0.5) if timings else 0,
+            'p99_ms': percentile(timings, 0.99) if timings else 0}
+
+
+def threaded_load(call, paths, concurrency, requests):
+    # `concurrency` threads share `requests` requests; call(path) -> status.
+    timings = []
+    errors = 0
+    lock = threading.Lock()
+    left = iter(range(requests))
+
+    def worker():
+        nonlocal errors
+        for number in left:
+            path = paths[number % len(paths)]
+            started = time.perf_counter()
+            ok = call(path) == 200
+            with lock:
+                timings.append((time.perf_counter() - started) * 1000)
+                errors += not ok
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return load_summary(timings, errors, time.perf_counter() - started)
+
+
+def wsgi_load(paths, concurrency, requests, host='localhost'):
+    # the WSGI application, called by threads like a threaded WSGI server does.
+    application = get_wsgi_application()
+
+    def call(path):
+        status = []
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '',
+                   'SERVER_NAME': host, 'SERVER_PORT': '80', 'HTTP_HOST': host, **internal_headers(),
+                   'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(), 'wsgi.errors': BytesIO()}
+        body = application(environ, lambda code, headers, exc_info=None: status.append(code))
+        for _ in body:
+            pass
+        body.close()
+        return int(status[0].split()[0])
+    return threaded_load(call, paths, concurrency, requests)
+
+
+def asgi_load(paths, concurrency, requests, host='localhost'):
+    # the ASGI application, with `concurrency` requests at once on one event loop.
+    application = get_asgi_application()
+
+    async def call(path):
+        status = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                 'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+                 'root_path': '', 'server': (host, 80),
+                 'headers': [(b'host', host.encode()), (HEADER.lower().encode(), internal_token().encode())]}
+        await application(scope, receive, send)
+        return status[0]
+
+    async def run():
+        timings = []
+        errors = 0
+        left = iter(range(requests))
+
+        async def worker():
+            nonlocal errors
+            for number in left:
+                started = time.perf_counter()
+                ok = await call(paths[number % len(paths)]) == 200
+                timings.append((time.perf_counter() - started) * 1000)
+                errors += not ok
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return load_summary(timings, errors, time.perf_counter() - started)
+    return asyncio.run(run())
+
+
+def http_load(base_url, paths, concurrency, requests):
+    # a running server (gunicorn, uvicorn...): one keep-alive connection per thread.
+    url = urlsplit(base_url)
+    local = threading.local()
+
+    def call(path):
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+        try:
+            local.connection.request('GET', url.path.rstrip('/') + path, headers={HEADER: internal_token()})
+            response = local.connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            local.connection.close()
+            del local.connection
+            return None
+    return threaded_load(call, paths, concurrency, requests)
+
+
+# --- comparing ---
+
+def compare(old, new, threshold=1.25, noise_ms=0.5):
+    # It gives back the lines of a report and the regressions found: slower
+    # p50/p99 by more than `threshold` (and more than noise_ms), more
+    # queries, or a memory peak higher by more than `threshold`.
+    lines = []
+    regressions = []
+    for name, scenarios in new['results'].items():
+        for scenario, after in scenarios.items():
+            before = old['results'].get(name, {}).get(scenario)
+            if before is None:
+                lines.append(f'{name} [{scenario}]: new')
+                continue
+            problems = []
+            for metric in ('p50_ms', 'p99_ms'):
+                if (after[metric] > before[metric] * threshold
+                        and after[metric] - before[metric] > noise_ms):
+                    problems.append(f'{metric} {before[metric]:.2f} -> {after[metric]:.2f}')
+            if after['queries'] > before['queries']:
+                problems.append(f"queries {before['queries']} -> {after['queries']}")
+            if after['peak_kb'] > before['peak_kb'] * threshold:
+                problems.append(f"peak {before['peak_kb']:.0f}KB -> {after['peak_kb']:.0f}KB")
+            ratio = after['p50_ms'] / before['p50_ms'] if before['p50_ms'] else 1
+            line = f"{name} [{scenario}]: p50 {before['p50_ms']:.2f} -> {after['p50_ms']:.2f} ms ({ratio:.2f}x)"
+            if problems:
+                line += '  REGRESSION: ' + ', '.join(problems)
+                regressions.append(f'{name} [{scenario}]')
+            lines.append(line)
+    return lines, regressions
+
+
+# --- suggestions ---
+
+SYLLABLES = 'ba co da fe gi ho ju ka le mi no pu ra se ti vo xa ze qui tra ple'.split()
+
+
+def suggest_rows(titles, tags, seed=0):
+    # Titles of 2 to 6 words from a vocabulary where a few words are in many
+    # titles (one letter matches most of them), popularity following a power
+    # law, and tags of every size.
+    rng = random.Random(seed)
+    vocabulary = WORDS + [''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+                          for _ in range(5000)]
+    weights = zipf_weights(len(vocabulary))
+    start = datetime.datetime(2015, 1, 1)
+    span = (datetime.datetime(2020, 1, 1) - start).total_seconds()
+    posts = []
+    for pk in range(1, titles + 1):
+        publish = start + datetime.timedelta(seconds=span * pk / titles)
+        words = rng.choices(vocabulary, weights, k=rng.randint(2, 6))
+        popularity = view_score(publish.timestamp()) + math.log2(rng.paretovariate(1.2))
+        posts.append((pk, f'{" ".join(words).capitalize()} {pk}', f'post-{pk}', publish, popularity))
+    tag_rows = [(f'tag-{number}', f'{rng.choice(vocabulary)} {number}', int(titles * weight))
+                for number, weight in enumerate(zipf_weights(tags))]
+    return posts, tag_rows
+
+
+def run_suggest_benchmark(titles, tags, queries, limit, seed=0):
+    # The suggestions index by itself, in memory: how long it takes to build,
+    # how big it is, and the latency of `queries` prefixes typed from the
+    # titles (1 to 8 letters from the start of one of their words).
+    posts, tag_rows = suggest_rows(titles, tags, seed)
+    # the size is measured on a second index, tracemalloc slows the build down.
+    gc.collect()
+    tracemalloc.start()
+    sized = Suggestions()
+    sized.load_rows(posts, tag_rows)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del sized
+    gc.collect()
+    suggestions = Suggestions()
+    started = time.perf_counter()
+    suggestions.load_rows(posts, tag_rows)
+    build_seconds = time.perf_counter() - started
+
+    rng = random.Random(seed + 1)
+    prefixes = []
+    for _ in range(queries):
+        words = rng.choice(posts)[1].split(' ')
+        prefixes.append(' '.join(words[rng.randrange(len(words)):])[:rng.randint(1, 8)])
+    timings = []
+    found = 0
+    for prefix in prefixes:
+        started = time.perf_counter()
+        answer = suggestions.suggest(prefix, limit)
+        timings.append((time.perf_counter() - started) * 1000)
+        found += len(answer['posts'])
+    return {'titles': titles, 'tags': tags, 'queries': queries, 'limit': limit,
+            'entries': len(suggestions.index),
+            'build_seconds': build_seconds,
+            'index_kb': size / 1024,
+            'suggestions_per_query': found / queries,
+            'p50_ms': percentile(timings, 0.5),
+            'p90_ms': percentile(timings, 0.9),
+            'p99_ms': percentile(timings, 0.99),
+            'max_ms': max(timings)}
+
+
+def write_results(results, path):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=1)
+
+
+def read_results(path):
+    with open(path) as file:
+        return json.load(file)
@@ -0,0 +1,209 @@
+import datetime
+import json
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+from taggit.models import Tag, TaggedItem
+
+from .cache import invalidate_sidebar
+from .counters import recount_comments
+from .models import Post, Comment
+from .pagecache import purge_pages
+from .related import post_tagged_items, rebuild_all
+from .rendering import render_rows
+from .search import get_backend
+from .sitemaps import forget_sitemaps
+from .suggest import suggestions
+
+# The blog as newline-delimited JSON: one object per line, first the posts
+# (with their tags), then the comments. Both sides work in batches, so a file
+# of any size is read and written with the same memory.
+#
+#   {"type": "post", "id": 1, "title": ..., "author": "username", "tags": ["django"], ...}
+#   {"type": "comment", "id": 1, "post": 1, "name": ..., ...}
+
+POST_FIELDS = ('id', 'title', 'slug', 'body', 'publish', 'created', 'updated', 'status')
+COMMENT_FIELDS = ('id', 'post', 'name', 'email', 'body', 'created', 'updated', 'active')
+DATE_FIELDS = ('publish', 'created', 'updated')
+
+
+def dump(row):
+    return json.dumps(row, default=lambda value: value.isoformat()) + '\n'
+
+
+def keyset_batches(queryset, fields, batch_size):
+    # we walk the table by primary key instead of using OFFSET.
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values(*fields)[:batch_size])
+        if not rows:
+            return
+        last_pk = rows[-1]['id']
+        yield rows
+
+
+def export_lines(batch_size=1000):
+    for posts in keyset_batches(Post.objects, POST_FIELDS + ('author__username',), batch_size):
+        # the tags of the whole batch in one query.
+        tags = {}
+        for post_id, name in (post_tagged_items()
+                              .filter(object_id__in=[post['id'] for post in posts])
+                              .order_by('id')
+                              .values_list('object_id', 'tag__name')):
+            tags.setdefault(post_id, []).append(name)
+        for post in posts:
+            post['author'] = post.pop('author__username')
+            yield dump(dict(type='post', tags=tags.get(post['id'], []), **post))
+
+    for comments in keyset_batches(Comment.objects, COMMENT_FIELDS, batch_size):
+        for comment in comments:
+            yield dump(dict(type='comment', **comment))
+
+
+class BlogImporter:
+    # It receives the lines in batches, and each batch is saved in its own
+    # transaction with a few bulk queries. Rows whose id is already in the
+    # database are skipped, so a batch can be imported twice (after a crash
+    # between the commit and the checkpoint, for example).
+    #
+    # What finish() has to refresh is kept in state(), which import_blog
+    # saves in its checkpoint: an import resumed after the last batch still
+    # refreshes what the first run imported.
+    def __init__(self, state=None):
+        self.imported = 0
+        self.skipped = 0
+        state = state or {}
+        self.posts_imported = state.get('posts', False)
+        self.tag_slugs = set(state.get('tags', []))
+        # the first day of each month with new published posts.
+        self.months = {datetime.date(*map(int, month.split('-')), 1) for month in state.get('months', [])}
+
+    def state(self):
+        return {'posts': self.posts_imported,
+                'tags': sorted(self.tag_slugs),
+                'months': sorted(f'{month.year}-{month.month}' for month in self.months)}
+
+    def import_batch(self, rows):
+        posts = [row for row in rows if row['type'] == 'post']
+        comments = [row for row in rows if row['type'] == 'comment']
+        with transaction.atomic():
+            self.import_posts(posts)
+            self.import_comments(comments)
+
+    def new_rows(self, model, rows):
+        existing = set(model.objects.filter(pk__in=[row['id'] for row in rows])
+                       .values_list('pk', flat=True))
+        self.skipped += len(existing)
+        return [row for row in rows if row['id'] not in existing]
+
+    def create(self, model, objects, dates):
+        # bulk_create fills created/updated with "now" (auto_now), so the
+        # dates of the file are written back with one bulk_update.
+        model.objects.bulk_create(objects)
+        for obj, (created, updated) in zip(objects, dates):
+            obj.created, obj.updated = created, updated
+        model.objects.bulk_update(objects, ['created', 'updated'])
+        self.imported += len(objects)
+
+    def import_posts(self, rows):
+        rows = self.new_rows(Post, rows)
+        if not rows:
+            return
+        authors = self.authors({row['author'] for row in rows})
+        rendered = {pk: (html, excerpt) for pk, html, excerpt
+                    in render_rows([(row['id'], row['body']) for row in rows])}
+        posts = []
+        for row in rows:
+            values = {field: row[field] for field in POST_FIELDS}
+            for field in DATE_FIELDS:
+                values[field] = parse_datetime(values[field])
+            post = Post(author_id=authors[row['author']], **values)
+            post.body_html, post.excerpt_html = rendered[row['id']]
+            posts.append(post)
+            if post.status == 'published':
+                self.months.add(post.publish.date().replace(day=1))
+        self.create(Post, posts, [(post.created, post.updated) for post in posts])
+        self.posts_imported = True
+
+        tag_ids = self.tags({name for row in rows for name in row['tags']})
+        TaggedItem.objects.bulk_create(
+            TaggedItem(content_type_id=self.content_type_id(),
+                       object_id=row['id'], tag_id=tag_ids[name])
+            for row in rows for name in row['tags'])
+
+    def import_comments(self, rows):
+        rows = self.new_rows(Comment, rows)
+        if not rows:
+            return
+        posts = set(Post.objects.filter(pk__in={row['post'] for row in rows}).values_list('pk', flat=True))
+        comments = []
+        for row in rows:
+            if row['post'] not in posts:
+                # its post isn't in the database nor in the file.
+                self.skipped += 1
+                continue
+            comments.append(Comment(id=row['id'], post_id=row['post'], name=row['name'],
+                                    email=row['email'], body=row['body'], active=row['active']))
+        self.create(Comment, comments,
+                    [(parse_datetime(row['created']), parse_datetime(row['updated']))
+                     for row in rows if row['post'] in posts])
+        # bulk_create sends no signals, so the counters are counted here.
+        recount_posts = {comment.post_id for comment in comments}
+        if recount_posts:
+            recount_comments(recount_posts)
+
+    def authors(self, usernames):
+        # the authors that don't exist yet are created, without a password.
+        found = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+        missing = [User(username=username) for username in usernames if username not in found]
+        for user in missing:
+            user.set_unusable_password()
+        User.objects.bulk_create(missing)
+        found.update(User.objects.filter(username__in=[user.username for user in missing])
+                     .values_list('username', 'pk'))
+        return found
+
+    def tags(self, names):
+        # name -> tag id, creating the missing tags with a few queries.
+        found = dict(Tag.objects.filter(name__in=names).values_list('name', 'pk'))
+        missing = {name: Tag().slugify(name) for name in names if name not in found}
+        taken = set(Tag.objects.filter(slug__in=missing.values()).values_list('slug', flat=True))
+        fresh, clashing, slugs = [], [], set()
+        for name, slug in missing.items():
+            if slug in taken or slug in slugs:
+                clashing.append(name)
+            else:
+                fresh.append(Tag(name=name, slug=slug))
+                slugs.add(slug)
+        Tag.objects.bulk_create(fresh)
+        # taggit finds a free slug for these ones, one by one.
+        for name in clashing:
+            Tag.objects.create(name=name)
+        found.update(Tag.objects.filter(name__in=list(missing)).values_list('name', 'pk'))
+        self.tag_slugs.update(Tag.objects.filter(pk__in=found.values()).values_list('slug', flat=True))
+        return found
+
+    def content_type_id(self):
+        return ContentType.objects.get_for_model(Post).pk
+
+    def finish(self):
+        # The ids came from the file, so the sequences must go past them
+        # (PostgreSQL), as loaddata does.
+        statements = connection.ops.sequence_reset_sql(no_style(), [Post, Comment, Tag, TaggedItem])
+        if statements:
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+        # bulk_create sends no signals, so the similar posts, the search index,
+        # the suggestions and the caches are refreshed here.
+        if self.posts_imported:
+            rebuild_all()
+            get_backend().rebuild()
+            # they're read from the database again on the next suggestion.
+            suggestions.clear()
+        invalidate_sidebar()
+        purge_pages('post-list', *[f'tag:{slug}' for slug in self.tag_slugs])
+        forget_sitemaps(*self.months)
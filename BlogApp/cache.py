@@ -0,0 +1,59 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+# While one request rebuilds a value, the others wait for it up to LOCK_WAIT
+# seconds instead of all hitting the database at once (the "stampede").
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 2
+
+SIDEBAR_VERSION_KEY = 'blog:sidebar:version'
+
+
+def get_or_compute(key, compute, timeout):
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    # cache.add only works for the first one who asks, so it's our lock.
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, True, LOCK_TIMEOUT):
+        try:
+            value = compute()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.01)
+        value = cache.get(key)
+        if value is not None:
+            return value
+    # whoever had the lock is taking too long, so we compute it ourselves.
+    return compute()
+
+
+# Every sidebar key carries the current version, so changing the version
+# throws all of them away at once.
+def sidebar_version():
+    version = cache.get(SIDEBAR_VERSION_KEY)
+    if version is None:
+        cache.add(SIDEBAR_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(SIDEBAR_VERSION_KEY)
+    return version
+
+
+def invalidate_sidebar():
+    cache.set(SIDEBAR_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def cached_sidebar(name, compute, *args, timeout=None):
+    key = ':'.join(['blog:sidebar', sidebar_version(), name] + [str(arg) for arg in args])
+    # the TTL is only a safety net, signals already invalidate it.
+    if timeout is None:
+        timeout = getattr(settings, 'BLOG_SIDEBAR_CACHE_TIMEOUT', 300)
+    return get_or_compute(key, compute, timeout)
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+from calendar import timegm
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db.models import Count, Max, Q, Sum
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils import timezone
+from django.utils.http import http_date
+from django.views.decorators.http import condition
+
+from .cache import cached_sidebar
+from .models import Post, RelatedPost
+from .postlookup import lookup_post
+
+# Validators let browsers, CDNs and feed readers ask "did it change?" and get
+# a 304 Not Modified, without us rendering any template. They're built from
+# the `updated` of the objects a page shows (and their counts, so a deleted
+# object changes them too).
+
+
+def as_utc(value):
+    # with USE_TZ = False the dates are local, HTTP dates are UTC.
+    if value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_current_timezone())
+    return value
+
+
+def latest(*dates):
+    dates = [as_utc(date) for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def make_etag(*parts):
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def sidebar_state():
+    # The newest change of a published post, and how many there are. It's
+    # cached with the sidebar, so it costs no query in steady state.
+    def compute():
+        return Post.published.aggregate(last=Max('updated'),
+                                        posts=Count('id'),
+                                        comments=Sum('active_comments'))
+    return cached_sidebar('state', compute)
+
+
+def sidebar_signature():
+    # What the sidebar of base.html shows. A change that doesn't show there
+    # (a comment that doesn't change the "most commented" list, for example)
+    # keeps the validators of the other pages.
+    from .templatetags.blog_tags import (total_posts, show_latest_posts, get_most_commented_posts,
+                                         get_popular_posts)
+
+    def compute():
+        shown = [total_posts()]
+        for post in (list(show_latest_posts(3)['latest_posts']) + list(get_most_commented_posts())
+                     + list(get_popular_posts())):
+            shown.append((post.pk, post.title, post.slug, post.publish.isoformat()))
+        return make_etag(*shown)
+    return cached_sidebar('signature', compute)
+
+
+def list_validators(request, tag_slug=None):
+    sidebar = sidebar_state()
+    if tag_slug is None:
+        # the list shows the same posts the sidebar state already covers.
+        return (make_etag('list', sidebar['last'], sidebar['posts'], sidebar_signature()),
+                sidebar['last'])
+    scope = (Post.published.filter(tags__slug=tag_slug)
+             .aggregate(last=Max('updated'), posts=Count('id')))
+    return (make_etag('tag', tag_slug, scope, sidebar_signature()),
+            latest(scope['last'], sidebar['last']))
+
+
+def feed_validators(request, tag_slug=None, **kwargs):
+    # the feeds and the sitemaps don't show the sidebar.
+    if tag_slug is None:
+        sidebar = sidebar_state()
+        return make_etag('feed', sidebar['last'], sidebar['posts']), sidebar['last']
+    scope = (Post.published.filter(tags__slug=tag_slug)
+             .aggregate(last=Max('updated'), posts=Count('id')))
+    return make_etag('feed', tag_slug, scope), latest(scope['last'])
+
+
+def detail_validators(request, year, month, day, post):
+    found = lookup_post(Post.published
+                        .annotate(comments_updated=Max('comments__updated', filter=Q(comments__active=True)))
+                        .values('pk', 'updated', 'active_comments', 'comments_updated'),
+                        year, month, day, post)
+    if found is None:
+        # the view answers 404 itself.
+        return None, None
+    similar = list(RelatedPost.objects.filter(post_id=found['pk'])
+                   .values_list('related_id', 'related__updated')[:4])
+    sidebar = sidebar_state()
+    return (make_etag('detail', found, similar, sidebar_signature()),
+            latest(found['updated'], found['comments_updated'], sidebar['last'],
+                   *[updated for _, updated in similar]))
+
+
+def conditional(validators):
+    # It works like Django's @condition, but the validators are computed once
+    # per request, and only for GET and HEAD (a POST always runs the view).
+    def decorator(view):
+        def get_validators(request, *args, **kwargs):
+            if not hasattr(request, 'blog_validators'):
+                request.blog_validators = validators(request, *args, **kwargs)
+            return request.blog_validators
+
+        def etag(request, *args, **kwargs):
+            return get_validators(request, *args, **kwargs)[0]
+
+        def last_modified(request, *args, **kwargs):
+            return get_validators(request, *args, **kwargs)[1]
+
+        if asyncio.iscoroutinefunction(view):
+            return async_conditional(view, get_validators)
+
+        conditional_view = condition(etag_func=etag, last_modified_func=last_modified)(view)
+
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            return conditional_view(request, *args, **kwargs)
+        return inner
+    return decorator
+
+
+def async_conditional(view, get_validators):
+    # What @condition does, for an async view: the validators are computed in
+    # a thread and the view is only awaited when the page changed.
+    @wraps(view)
+    async def inner(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return await view(request, *args, **kwargs)
+        etag, last_modified = await sync_to_async(get_validators)(request, *args, **kwargs)
+        etag = quote_etag(etag) if etag is not None else None
+        last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = await view(request, *args, **kwargs)
+        if last_modified and not response.has_header('Last-Modified'):
+            response['Last-Modified'] = http_date(last_modified)
+        if etag:
+            response.setdefault('ETag', etag)
+        return response
+    return inner
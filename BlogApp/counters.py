@@ -0,0 +1,59 @@
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Post, Comment
+
+
+# Post.active_comments is a copy of "how many active comments this post has".
+# These functions keep it right without counting the comments again.
+def add_to_counter(post_id, delta):
+    if post_id is None or not delta:
+        return
+    # F() makes the database do the math, so two comments at the same time
+    # don't overwrite each other.
+    Post.objects.filter(pk=post_id).update(
+        active_comments=Greatest(F('active_comments') + delta, Value(0))
+    )
+
+
+def comment_saved(comment, created):
+    active = 1 if comment.active else 0
+    if created:
+        add_to_counter(comment.post_id, active)
+        return
+    was_active = 1 if comment.loaded_value('active', comment.active) else 0
+    old_post_id = comment.loaded_value('post_id', comment.post_id)
+    if old_post_id != comment.post_id:
+        add_to_counter(old_post_id, -was_active)
+        add_to_counter(comment.post_id, active)
+    else:
+        add_to_counter(comment.post_id, active - was_active)
+
+
+def comment_deleted(comment):
+    if comment.loaded_value('active', comment.active):
+        add_to_counter(comment.loaded_value('post_id', comment.post_id), -1)
+
+
+# The real number, counted by the database, for each post of an outer query.
+def actual_active_comments():
+    active = (Comment.objects.filter(post=OuterRef('pk'), active=True)
+              .order_by()
+              .values('post')
+              .annotate(total=Count('id'))
+              .values('total'))
+    return Coalesce(Subquery(active), Value(0))
+
+
+def find_drift(queryset):
+    # it gives back (post id, stored counter, real count) for the wrong ones.
+    return list(queryset.annotate(actual=actual_active_comments())
+                .exclude(actual=F('active_comments'))
+                .values_list('pk', 'active_comments', 'actual'))
+
+
+def recount_comments(post_ids):
+    # one set-based UPDATE for all the given posts.
+    return Post.objects.filter(pk__in=list(post_ids)).update(
+        active_comments=actual_active_comments()
+    )
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import re
+import tempfile
+from urllib.parse import parse_qs
+
+from asgiref.sync import async_to_sync
+from django.http import Http404, HttpResponseNotFound
+from django.test import RequestFactory
+from django.urls import Resolver404, resolve, reverse
+
+from .models import Post
+from .pagination import load_cursor
+from .related import post_tagged_items
+from .sitemaps import section_url, sitemap_sections
+
+# The static export calls the views for every page, as a request would, and
+# writes what they answer to files. So the pages come from BlogApp/urls.py and
+# the usual templates, with nothing to keep in sync.
+#
+# Each "unit" is a URL: a post, the feed, the sitemap, or a list with all its
+# pages. With the ETag of the last export, an unchanged unit answers 304 and
+# isn't rendered again (the ETags come from Post.updated, see conditional.py).
+
+# The links from a list page to its other pages: href="?cursor=..." or href="?page=2".
+QUERY_LINK_RE = re.compile(r'href="\?([^"]*)"')
+UNSAFE_RE = re.compile(r'[^\w-]')
+
+
+def export_units():
+    # every unit of the blog: (kind, url)
+    units = [('list', reverse('BlogApp:post_list')),
+             ('page', reverse('BlogApp:post_feed')),
+             ('page', reverse('BlogApp:post_feed_atom')),
+             ('page', reverse('sitemap'))]
+    units.extend(('page', section_url(year, month, page)) for year, month, page, _ in sitemap_sections())
+    slugs = (post_tagged_items()
+             .filter(object_id__in=Post.published.values('pk'))
+             .values_list('tag__slug', flat=True)
+             .distinct())
+    for slug in slugs:
+        units.extend([('list', reverse('BlogApp:post_list_by_tag', args=[slug])),
+                      ('page', reverse('BlogApp:post_feed_by_tag', args=[slug])),
+                      ('page', reverse('BlogApp:post_feed_by_tag_atom', args=[slug]))])
+    for slug, publish in Post.published.values_list('slug', 'publish').iterator():
+        units.append(('page', Post(slug=slug, publish=publish).get_absolute_url()))
+    return units
+
+
+def file_name(url, query='', content_type='text/html'):
+    # /BlogApp/2020/1/2/post/ -> BlogApp/2020/1/2/post/index.html
+    # the other pages of a list -> BlogApp/index.cursor-<token>.html
+    name = url.strip('/')
+    if url.endswith('/'):
+        extension = 'xml' if 'xml' in content_type else 'html'
+        index = f'index.{UNSAFE_RE.sub("-", query)}' if query else 'index'
+        name = os.path.join(name, f'{index}.{extension}')
+    return name
+
+
+def write_file(output, name, chunks):
+    # written aside and swapped, so the CDN never reads half a page.
+    path = os.path.join(output, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(descriptor, 'wb') as file:
+        for chunk in chunks:
+            file.write(chunk)
+    os.replace(temporary, path)
+
+
+def is_previous_link(query):
+    cursor = parse_qs(query).get('cursor')
+    if not cursor:
+        return False
+    try:
+        return load_cursor(cursor[0])[0] == 'p'
+    except (ValueError, TypeError):
+        return False
+
+
+class Exporter:
+    # One for each worker process. It builds the requests with a
+    # RequestFactory and calls the views itself, without the middlewares: an
+    # export isn't a visit, so it's kept out of the metrics, the query budget
+    # logs and the view counts (see internal.py), and reads from the primary.
+    def __init__(self, output, host):
+        self.output = output
+        self.factory = RequestFactory(HTTP_HOST=host)
+
+    def get(self, url, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        request = self.factory.get(url, **headers)
+        request.blog_internal = True
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return HttpResponseNotFound()
+        request.resolver_match = match
+        view = match.func
+        if asyncio.iscoroutinefunction(view):
+            # the async views (BLOG_ASYNC_VIEWS) are awaited in a loop of their own.
+            view = async_to_sync(view)
+        try:
+            response = view(request, *match.args, **match.kwargs)
+        except Http404:
+            return HttpResponseNotFound()
+        # Django's sitemap views answer a TemplateResponse, rendered by the handler.
+        if hasattr(response, 'render') and callable(response.render):
+            response = response.render()
+        return response
+
+    def export(self, kind, url, etag=None):
+        # it gives back {'url', 'status', 'etag', 'files'}, where status is
+        # 'written', 'unchanged' (the 304s) or 'gone'.
+        response = self.get(url, etag)
+        if response.status_code == 304:
+            return {'url': url, 'status': 'unchanged', 'etag': etag, 'files': None}
+        if response.status_code != 200:
+            return {'url': url, 'status': 'gone', 'etag': None, 'files': []}
+        if kind == 'list':
+            files = self.write_list(url, response)
+        else:
+            name = file_name(url, content_type=response['Content-Type'])
+            # the sitemaps are streamed, and so they're written.
+            write_file(self.output, name,
+                       response.streaming_content if response.streaming else [response.content])
+            files = [name]
+        return {'url': url, 'status': 'written', 'etag': response.get('ETag'), 'files': files}
+
+    def write_list(self, url, first_response):
+        # It walks the pages through their "Next" links. The links are
+        # rewritten to the files, and a "Previous" cursor points to the page
+        # we came from (it shows the same posts).
+        files = []
+        pending = [('', first_response, None)]
+        seen = {''}
+        while pending:
+            query, response, previous = pending.pop(0)
+            name = file_name(url, query)
+            here = os.path.basename(name) if query else './'
+            if response is None:
+                response = self.get(f'{url}?{query}')
+                if response.status_code != 200:
+                    continue
+
+            def link(match):
+                target = match.group(1)
+                if not target:
+                    return 'href="./"'
+                if is_previous_link(target):
+                    return f'href="{previous or "./"}"'
+                if target not in seen:
+                    seen.add(target)
+                    pending.append((target, None, here))
+                return f'href="{os.path.basename(file_name(url, target))}"'
+
+            content = QUERY_LINK_RE.sub(link, response.content.decode(response.charset))
+            write_file(self.output, name, [content.encode(response.charset)])
+            files.append(name)
+        return files
+
+
+_exporter = None
+
+
+def export_batch(output, host, units):
+    # It runs inside a worker process: units is a list of (kind, url, etag).
+    global _exporter
+    if _exporter is None:
+        _exporter = Exporter(output, host)
+    return [_exporter.export(kind, url, etag) for kind, url, etag in units]
@@ -0,0 +1,25 @@
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+# The requests the blog makes to itself (export_static, the benchmarks) aren't
+# visits: they mustn't count as views of a post. They're marked with the
+# `blog_internal` attribute when the request object is ours, or with this
+# header when it goes through a client or a server. The header's value is
+# signed with SECRET_KEY, so a visitor can't send it.
+HEADER = 'X-Blog-Internal'
+META_KEY = 'HTTP_X_BLOG_INTERNAL'
+
+
+def internal_token():
+    return salted_hmac('BlogApp.internal', 'internal request').hexdigest()
+
+
+def internal_headers():
+    # for django.test.Client and WSGI environs.
+    return {META_KEY: internal_token()}
+
+
+def is_internal(request):
+    if getattr(request, 'blog_internal', False):
+        return True
+    token = request.META.get(META_KEY)
+    return bool(token) and constant_time_compare(token, internal_token())
@@ -0,0 +1,234 @@
+import logging
+import os
+import threading
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction, close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .metrics import time_smtp
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+# A worker holds the messages it took for this long. If it dies meanwhile,
+# another worker takes them when the time is over.
+LEASE = timedelta(minutes=5)
+
+
+def setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enqueue_mail(subject, message, from_email, recipient_list):
+    # It works like send_mail, but it only writes the message in the outbox.
+    email = OutboundEmail.objects.create(subject=subject,
+                                         body=message,
+                                         from_email=from_email,
+                                         to=','.join(recipient_list))
+    # the workers only see the message after the transaction is committed.
+    transaction.on_commit(wake_workers)
+    return email
+
+
+def backoff(attempts):
+    # 30s, 1min, 2min, 4min... up to BLOG_MAIL_MAX_BACKOFF seconds.
+    seconds = setting('BLOG_MAIL_RETRY_DELAY', 30) * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, setting('BLOG_MAIL_MAX_BACKOFF', 3600)))
+
+
+def claim_batch(size):
+    # It takes up to `size` due messages for this worker. The UPDATE checks
+    # again that they're still due and that nobody holds them: another worker
+    # may have sent one (or put it back to wait) since we read the ids, so two
+    # workers can't take the same one, and a message is never sent twice.
+    now = timezone.now()
+    token = uuid.uuid4().hex
+    available = Q(status='queued', next_attempt__lte=now) & (Q(locked_until__isnull=True)
+                                                             | Q(locked_until__lt=now))
+    due = (OutboundEmail.objects
+           .filter(available)
+           .order_by('next_attempt')
+           .values_list('pk', flat=True)[:size])
+    claimed = (OutboundEmail.objects
+               .filter(available, pk__in=list(due))
+               .update(claimed_by=token, locked_until=now + LEASE))
+    if not claimed:
+        return []
+    return list(OutboundEmail.objects.filter(claimed_by=token))
+
+
+def retry_later(email, error):
+    email.attempts += 1
+    email.last_error = repr(error)
+    if email.attempts >= setting('BLOG_MAIL_MAX_ATTEMPTS', 8):
+        email.status = 'failed'
+        logger.error('Giving up on e-mail %s: %r', email.pk, error)
+    else:
+        email.next_attempt = timezone.now() + backoff(email.attempts)
+    email.locked_until = None
+    email.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt', 'locked_until'])
+
+
+def deliver(connection, email):
+    message = EmailMessage(email.subject, email.body, email.from_email,
+                           email.to.split(','), connection=connection)
+    try:
+        time_smtp(message.send)
+    except Exception as error:
+        retry_later(email, error)
+        return False
+
+    email.attempts += 1
+    email.status = 'sent'
+    email.sent = timezone.now()
+    email.locked_until = None
+    email.save(update_fields=['attempts', 'status', 'sent', 'locked_until'])
+    return True
+
+
+class MailWorker:
+    # It sends the outbox in batches through one SMTP connection, which stays
+    # open between batches while there's work, so we don't pay the handshake
+    # and TLS negotiation for every message.
+    def __init__(self, batch_size=None, idle_timeout=None):
+        self.batch_size = batch_size or setting('BLOG_MAIL_BATCH_SIZE', 20)
+        self.idle_timeout = idle_timeout or setting('BLOG_MAIL_IDLE_TIMEOUT', 30)
+        self.connection = None
+        self.idle_since = None
+
+    def run_once(self):
+        # it sends one batch and gives back how many messages it took.
+        emails = claim_batch(self.batch_size)
+        if not emails:
+            if self.connection is not None and self.idle_since is None:
+                self.idle_since = timezone.now()
+            if self.idle_since and timezone.now() - self.idle_since > timedelta(seconds=self.idle_timeout):
+                self.close()
+            return 0
+
+        self.idle_since = None
+        for email in emails:
+            try:
+                self.connect()
+            except Exception as error:
+                logger.warning('Mail server unavailable: %r', error)
+                self.close()
+                retry_later(email, error)
+                continue
+            if not deliver(self.connection, email):
+                # the connection may be broken, the next message opens a new one.
+                self.close()
+        return len(emails)
+
+    def connect(self):
+        # open() does nothing when the connection is already open.
+        if self.connection is None:
+            self.connection = get_connection(fail_silently=False)
+        self.connection.open()
+
+    def drain(self):
+        total = 0
+        while True:
+            sent = self.run_once()
+            if not sent:
+                self.close()
+                return total
+            total += sent
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+        self.idle_since = None
+
+
+class MailWorkerPool:
+    # Threads inside the web process that send the outbox. They sleep until
+    # enqueue_mail wakes them, or BLOG_MAIL_POLL_INTERVAL seconds go by (for
+    # retries and messages left by another process).
+    def __init__(self, size):
+        self.size = size
+        self.wakeup = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for number in range(self.size):
+                thread = threading.Thread(target=self.run, name=f'mail-worker-{number}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def wake(self):
+        self.start()
+        self.wakeup.set()
+
+    def run(self):
+        worker = MailWorker()
+        interval = setting('BLOG_MAIL_POLL_INTERVAL', 10)
+        while True:
+            self.wakeup.wait(interval)
+            self.wakeup.clear()
+            try:
+                while worker.run_once():
+                    pass
+            except Exception:
+                logger.exception('Mail worker failed')
+                worker.close()
+            finally:
+                # this thread isn't a request, so it cleans its connection itself.
+                close_old_connections()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    # With BLOG_MAIL_WORKERS = 0 nothing runs here, and the outbox is sent by
+    # "python manage.py send_queued_mail --loop" in another process.
+    global _pool
+    size = setting('BLOG_MAIL_WORKERS', 2)
+    if not size:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = MailWorkerPool(size)
+    return _pool
+
+
+def wake_workers():
+    pool = get_pool()
+    if pool is not None:
+        pool.wake()
+
+
+def start_workers():
+    # Called by BlogProject/wsgi.py and asgi.py, so only the web server's
+    # processes run the workers (not the tests, nor the management commands),
+    # and the messages left in the outbox by a restart are sent within
+    # BLOG_MAIL_POLL_INTERVAL, without waiting for a new one.
+    pool = get_pool()
+    if pool is not None:
+        pool.start()
+
+
+def forget_pool():
+    # The threads don't survive a fork (gunicorn --preload), so a forked
+    # process starts its own workers when it needs them.
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=forget_pool)
@@ -0,0 +1,56 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from BlogApp.benchmark import (benchmark_database, compare, generate, read_results, run_benchmark,
+                               write_results)
+
+
+class Command(BaseCommand):
+    help = ('Measures every route with synthetic data, in a test database (SQLite or a local '
+            'PostgreSQL), or compares two results files.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=2000)
+        parser.add_argument('--tags', type=int, default=200)
+        parser.add_argument('--comments', type=float, default=5,
+                            help='The average number of comments of a post.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--iterations', type=int, default=30,
+                            help='How many times each route is measured, cold and warm.')
+        parser.add_argument('--output', default='benchmark.json',
+                            help='The JSON file the results are written to.')
+        parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                            help='Compare two results files instead of measuring.')
+        parser.add_argument('--threshold', type=float, default=1.25,
+                            help='How much slower (or bigger) is a regression.')
+
+    def handle(self, *args, **options):
+        if options['compare']:
+            return self.compare(*options['compare'], options['threshold'])
+
+        # over-budget warnings would only hide the report.
+        logging.getLogger('BlogApp.querybudget').setLevel(logging.ERROR)
+        with benchmark_database():
+            dataset = {'posts': options['posts'], 'tags': options['tags'],
+                       'comments': options['comments'], 'seed': options['seed']}
+            self.stdout.write(f'Generating {options["posts"]} posts...')
+            rows = generate(options['posts'], options['tags'], options['comments'], options['seed'])
+            self.stdout.write(f'{rows} rows generated, measuring...')
+            results = run_benchmark(options['iterations'], dataset)
+
+        write_results(results, options['output'])
+        for name, scenarios in results['results'].items():
+            for scenario, result in scenarios.items():
+                self.stdout.write(
+                    f"{name} [{scenario}]: p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+                    f"{result['queries']} queries, peak {result['peak_kb']:.0f} KB")
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}.'))
+
+    def compare(self, old_path, new_path, threshold):
+        lines, regressions = compare(read_results(old_path), read_results(new_path), threshold)
+        for line in lines:
+            self.stdout.write(line)
+        if regressions:
+            raise CommandError(f'{len(regressions)} regressions: {", ".join(regressions)}')
+        self.stdout.write(self.style.SUCCESS('No regressions.'))
@@ -0,0 +1,65 @@
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from BlogApp.benchmark import asgi_load, benchmark_database, generate, http_load, load_paths, wsgi_load
+
+
+class Command(BaseCommand):
+    help = ('Compares the throughput of the WSGI and ASGI applications under concurrent load, '
+            'in-process with synthetic data, or against two running servers. Both run the views '
+            'BLOG_ASYNC_VIEWS chooses (it needs Django 3.1): without it the asgi column measures '
+            'the sync views under ASGIHandler.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=2000)
+        parser.add_argument('--tags', type=int, default=200)
+        parser.add_argument('--comments', type=float, default=5)
+        parser.add_argument('--concurrency', type=int, default=20,
+                            help='How many requests are in flight at once.')
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='How many requests each deployment gets.')
+        parser.add_argument('--no-page-cache', action='store_true',
+                            help='Measure the views themselves, not the page cache.')
+        parser.add_argument('--wsgi-url', help='A running WSGI server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--asgi-url', help='A running ASGI server, e.g. http://127.0.0.1:8001')
+        parser.add_argument('--output', help='A JSON file the results are written to.')
+
+    def handle(self, *args, **options):
+        concurrency, requests = options['concurrency'], options['requests']
+        if options['wsgi_url'] or options['asgi_url']:
+            if not (options['wsgi_url'] and options['asgi_url']):
+                raise CommandError('Give both --wsgi-url and --asgi-url.')
+            # the servers use their own database: the paths come from ours.
+            paths = load_paths()
+            results = {'wsgi': http_load(options['wsgi_url'], paths, concurrency, requests),
+                       'asgi': http_load(options['asgi_url'], paths, concurrency, requests)}
+        else:
+            logging.getLogger('BlogApp.querybudget').setLevel(logging.ERROR)
+            logging.getLogger('BlogApp.metrics').setLevel(logging.ERROR)
+            overrides = {'BLOG_PAGE_CACHE_TIMEOUT': 0} if options['no_page_cache'] else {}
+            with benchmark_database(**overrides):
+                self.stdout.write(f'Generating {options["posts"]} posts...')
+                generate(options['posts'], options['tags'], options['comments'])
+                paths = load_paths()
+                host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else 'localhost'
+                # one pass loads the templates and the rest of what a process loads once.
+                wsgi_load(paths, 1, len(paths), host)
+                results = {}
+                for name, load in (('wsgi', wsgi_load), ('asgi', asgi_load)):
+                    # both start with an empty page cache.
+                    cache.clear()
+                    results[name] = load(paths, concurrency, requests, host)
+
+        views = 'async' if getattr(settings, 'BLOG_ASYNC_VIEWS', False) else 'sync'
+        self.stdout.write(f'{requests} requests, {concurrency} at once, {views} views under ASGI:')
+        for name, result in results.items():
+            self.stdout.write(f"{name}: {result['requests_per_second']:.1f} requests/s, "
+                              f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms, "
+                              f"{result['errors']} errors")
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(results, file, indent=1)
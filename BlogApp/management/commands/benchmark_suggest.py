@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from BlogApp.benchmark import run_suggest_benchmark, write_results
+
+
+class Command(BaseCommand):
+    help = ('Measures the search box suggestions (BlogApp/suggest.py) in memory, with synthetic '
+            'titles: the time to build the index, its size and the latency percentiles.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--titles', type=int, default=100000)
+        parser.add_argument('--tags', type=int, default=1000)
+        parser.add_argument('--queries', type=int, default=20000)
+        parser.add_argument('--limit', type=int, default=8,
+                            help='How many posts and tags each suggestion asks for.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='A JSON file the results are written to.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Building the index of {options["titles"]} titles...')
+        result = run_suggest_benchmark(options['titles'], options['tags'], options['queries'],
+                                       options['limit'], options['seed'])
+        self.stdout.write(f"{result['entries']} entries built in {result['build_seconds']:.2f} s, "
+                          f"{result['index_kb'] / 1024:.1f} MB")
+        self.stdout.write(f"{result['queries']} queries: p50 {result['p50_ms']:.3f} ms, "
+                          f"p90 {result['p90_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms, "
+                          f"max {result['max_ms']:.3f} ms, "
+                          f"{result['suggestions_per_query']:.1f} posts per answer")
+        if options['output']:
+            write_results(result, options['output'])
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from BlogApp.search.inverted import InvertedIndexBackend
+
+
+class Command(BaseCommand):
+    help = 'Builds the search index file used by the inverted index search backend.'
+
+    def handle(self, *args, **options):
+        backend = InvertedIndexBackend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(backend.index)} posts indexed in {settings.BLOG_SEARCH_INDEX_PATH}.'))
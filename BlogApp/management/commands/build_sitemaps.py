@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from BlogApp.sitemaps import write_sitemaps
+
+
+class Command(BaseCommand):
+    help = 'Writes sitemap.xml and all its sections to BLOG_SITEMAP_DIR.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scheme', default='https',
+                            help='The scheme of the URLs (the domain is the current Site).')
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'BLOG_SITEMAP_DIR', None):
+            raise CommandError('Set BLOG_SITEMAP_DIR to the folder the sitemaps are kept in.')
+        base = f"{options['scheme']}://{Site.objects.get_current().domain}"
+        files = write_sitemaps(base)
+        self.stdout.write(self.style.SUCCESS(f'{files} sitemap files written to {settings.BLOG_SITEMAP_DIR}.'))
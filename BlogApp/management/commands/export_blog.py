@@ -0,0 +1,31 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from BlogApp.bulk import export_lines
+
+
+class Command(BaseCommand):
+    help = 'Writes every post (with its tags) and comment as newline-delimited JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='The file to write, or - for the standard output.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many rows are read by each query.')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        rows = 0
+        output = sys.stdout if options['output'] == '-' else open(options['output'], 'w', encoding='utf-8')
+        try:
+            for line in export_lines(options['batch_size']):
+                output.write(line)
+                rows += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        elapsed = time.monotonic() - started
+        # the report goes to stderr, so it doesn't mix with the rows on stdout.
+        self.stderr.write(self.style.SUCCESS(
+            f'{rows} rows exported in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.0f} rows/s).'))
@@ -0,0 +1,91 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import django
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from BlogApp.export import export_batch, export_units
+
+MANIFEST = 'manifest.json'
+
+
+class Command(BaseCommand):
+    help = 'Writes the published blog (posts, lists, tags, feed and sitemap) as static files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default='static_site',
+                            help='The folder the files are written to.')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only render the pages that changed since the last export.')
+        parser.add_argument('--host', default='localhost',
+                            help='The host the pages are asked for (it must be in ALLOWED_HOSTS).')
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='How many URLs each worker exports at once.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='How many processes render pages.')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        os.makedirs(output, exist_ok=True)
+        # the manifest says which files each URL wrote, and with which ETag.
+        previous = self.read_manifest(output)
+        etags = {url: entry['etag'] for url, entry in previous.items()} if options['incremental'] else {}
+
+        units = [(kind, url, etags.get(url)) for kind, url in export_units()]
+        batches = [units[start:start + options['batch_size']]
+                   for start in range(0, len(units), options['batch_size'])]
+
+        started = time.monotonic()
+        pages = {}
+        written = unchanged = 0
+        pending = set()
+        # the workers are spawned (not forked), so they never share our database connection.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=options['workers'], mp_context=context,
+                                 initializer=django.setup) as executor:
+            for batch in batches:
+                pending.add(executor.submit(export_batch, output, options['host'], batch))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for result in future.result():
+                        if result['status'] == 'unchanged':
+                            pages[result['url']] = previous[result['url']]
+                            unchanged += 1
+                        elif result['status'] == 'written':
+                            pages[result['url']] = {'etag': result['etag'], 'files': result['files']}
+                            written += len(result['files'])
+        elapsed = time.monotonic() - started
+
+        removed = self.remove_stale(output, previous, pages)
+        self.write_manifest(output, pages)
+        rate = written / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'{written} pages written, {unchanged} URLs unchanged, {removed} files removed '
+            f'in {elapsed:.1f}s ({rate:.1f} pages/s).'))
+
+    def read_manifest(self, output):
+        try:
+            with open(os.path.join(output, MANIFEST)) as file:
+                return json.load(file)['pages']
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def write_manifest(self, output, pages):
+        with open(os.path.join(output, MANIFEST), 'w') as file:
+            json.dump({'exported': timezone.now().isoformat(), 'pages': pages}, file, indent=1)
+
+    def remove_stale(self, output, previous, pages):
+        # the files of unpublished posts, and list pages that don't exist anymore.
+        kept = {name for entry in pages.values() for name in entry['files']}
+        removed = 0
+        for entry in previous.values():
+            for name in entry['files']:
+                if name not in kept and os.path.exists(os.path.join(output, name)):
+                    os.remove(os.path.join(output, name))
+                    removed += 1
+        return removed
@@ -0,0 +1,73 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from BlogApp.bulk import BlogImporter
+
+
+class Command(BaseCommand):
+    help = 'Loads posts, tags and comments from a file written by export_blog.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='The newline-delimited JSON file.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many rows are saved by each transaction.')
+        parser.add_argument('--from-start', action='store_true',
+                            help='Ignore the checkpoint of an import that stopped halfway.')
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        # After each batch is committed, the checkpoint file says where the
+        # file was, so an import that failed goes on from there next time.
+        checkpoint = options['input'] + '.checkpoint'
+        saved = {} if options['from_start'] else self.read_checkpoint(checkpoint)
+        offset = saved.get('offset', 0)
+        if offset:
+            self.stdout.write(f'Going on from byte {offset} of {options["input"]}.')
+            # a checkpoint written before the state was kept in it: what was
+            # imported is unknown, so everything is refreshed at the end.
+            saved.setdefault('posts', True)
+
+        # the checkpoint also keeps what the batches imported so far, so
+        # finish() refreshes it even when only the end is run again.
+        importer = BlogImporter(saved)
+        started = time.monotonic()
+        with open(options['input'], 'rb') as file:
+            file.seek(offset)
+            batch = []
+            for number, line in enumerate(file, 1):
+                offset += len(line)
+                if line.strip():
+                    try:
+                        batch.append(json.loads(line))
+                    except ValueError as error:
+                        raise CommandError(f'Line {number} (after the checkpoint) is not JSON: {error}')
+                if len(batch) >= options['batch_size']:
+                    self.save(importer, batch, checkpoint, offset, started)
+                    batch = []
+            self.save(importer, batch, checkpoint, offset, started)
+
+        importer.finish()
+        os.remove(checkpoint)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'{importer.imported} rows imported, {importer.skipped} skipped, in {elapsed:.1f}s '
+            f'({importer.imported / elapsed if elapsed else 0:.0f} rows/s).'))
+
+    def save(self, importer, batch, checkpoint, offset, started):
+        importer.import_batch(batch)
+        with open(checkpoint, 'w') as file:
+            json.dump(dict(importer.state(), offset=offset), file)
+        if self.verbosity >= 2:
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'{importer.imported} rows ({importer.imported / elapsed:.0f} rows/s)')
+
+    def read_checkpoint(self, checkpoint):
+        try:
+            with open(checkpoint) as file:
+                saved = json.load(file)
+            return saved if isinstance(saved.get('offset'), int) else {}
+        except (OSError, ValueError, AttributeError):
+            return {}
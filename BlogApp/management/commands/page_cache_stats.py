@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from BlogApp.pagecache import page_cache_stats, reset_page_cache_stats
+
+
+class Command(BaseCommand):
+    # The counters are kept in the cache, so this only sees the web processes'
+    # numbers with a shared cache (Memcached, Redis...), not with LocMemCache.
+    help = 'Shows the hits, misses, bypasses and purges of the page cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help='Set the counters back to zero after showing them.')
+
+    def handle(self, *args, **options):
+        stats = page_cache_stats()
+        for name in ('hits', 'misses', 'bypasses', 'purges'):
+            self.stdout.write(f'{name}: {stats[name]}')
+        self.stdout.write(self.style.SUCCESS(f"hit ratio: {stats['hit_ratio']:.1%}"))
+        if options['reset']:
+            reset_page_cache_stats()
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from BlogApp.related import rebuild_all
+
+
+class Command(BaseCommand):
+    help = 'Builds again the similar posts list of every published post.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many rows are inserted at once.')
+
+    def handle(self, *args, **options):
+        total = rebuild_all(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{total} similar posts stored.'))
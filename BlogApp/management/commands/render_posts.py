@@ -0,0 +1,59 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import django
+from django.core.management.base import BaseCommand
+
+from BlogApp.models import Post
+from BlogApp.rendering import render_rows
+
+
+class Command(BaseCommand):
+    help = 'Renders again the stored HTML and excerpt of every post, in parallel batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='How many posts each worker renders at once.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='How many processes render Markdown.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        workers = options['workers']
+
+        total = 0
+        pending = set()
+        # the workers are spawned (not forked), so they never share our database connection.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=django.setup) as executor:
+            for rows in self.batches(batch_size):
+                pending.add(executor.submit(render_rows, rows))
+                # we keep only a few batches in flight, so memory stays flat.
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    total += self.save(done)
+            total += self.save(pending)
+
+        self.stdout.write(self.style.SUCCESS(f'{total} posts rendered.'))
+
+    def batches(self, batch_size):
+        # we walk the table by primary key instead of using OFFSET.
+        last_pk = 0
+        while True:
+            rows = list(Post.objects.filter(pk__gt=last_pk)
+                        .order_by('pk')
+                        .values_list('pk', 'body')[:batch_size])
+            if not rows:
+                return
+            last_pk = rows[-1][0]
+            yield rows
+
+    def save(self, futures):
+        posts = []
+        for future in futures:
+            for pk, html, excerpt in future.result():
+                posts.append(Post(pk=pk, body_html=html, excerpt_html=excerpt))
+        Post.objects.bulk_update(posts, ['body_html', 'excerpt_html'])
+        return len(posts)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from BlogApp.counters import find_drift, recount_comments
+from BlogApp.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Counts the active comments of every post again and fixes Post.active_comments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many posts are checked by each query.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report the posts that drifted.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        checked = 0
+        drifted = 0
+        last_pk = 0
+
+        while True:
+            ids = list(Post.objects.filter(pk__gt=last_pk)
+                       .order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_pk = ids[-1]
+            checked += len(ids)
+
+            drift = find_drift(Post.objects.filter(pk__in=ids))
+            for pk, stored, actual in drift:
+                self.stdout.write(f'Post {pk}: stored {stored}, actual {actual}')
+            if drift and not options['dry_run']:
+                recount_comments(pk for pk, stored, actual in drift)
+            drifted += len(drift)
+
+        verb = 'found' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{checked} posts checked, {drifted} counters {verb}.'))
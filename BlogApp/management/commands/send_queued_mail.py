@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from BlogApp.mailqueue import MailWorker
+
+
+class Command(BaseCommand):
+    help = 'Sends the e-mails waiting in the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and check the outbox every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=5)
+        parser.add_argument('--batch-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        worker = MailWorker(batch_size=options['batch_size'])
+        if not options['loop']:
+            total = worker.drain()
+            self.stdout.write(self.style.SUCCESS(f'{total} e-mails processed.'))
+            return
+
+        try:
+            while True:
+                while worker.run_once():
+                    pass
+                close_old_connections()
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            worker.close()
@@ -0,0 +1,35 @@
+from django.contrib.postgres.search import SearchVector
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from BlogApp.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Fills Post.search_vector of the existing posts, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='How many posts are updated by each query.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('The stored search vector needs PostgreSQL.')
+
+        # the same expression as the trigger, so old and new rows match.
+        vector = SearchVector('title', weight='A') + SearchVector('body', weight='B')
+        batch_size = options['batch_size']
+        total = 0
+        last_pk = 0
+        while True:
+            ids = list(Post.objects.filter(pk__gt=last_pk)
+                       .order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_pk = ids[-1]
+            # each batch is its own short UPDATE, so it doesn't lock the table for long.
+            total += Post.objects.filter(pk__in=ids).update(search_vector=vector)
+            self.stdout.write(f'{total} posts updated...')
+
+        self.stdout.write(self.style.SUCCESS(f'{total} search vectors stored.'))
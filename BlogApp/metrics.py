@@ -0,0 +1,228 @@
+import bisect
+import heapq
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.template.backends.django import DjangoTemplates
+
+from .querybudget import wrap_queries
+
+logger = logging.getLogger(__name__)
+
+# Where the time of each request goes: the whole view, the SQL queries, the
+# templates, the markdown filter and (in the mail workers) the SMTP server.
+# Every number goes into a histogram, and /metrics shows them in the
+# Prometheus text format. The histograms live in the memory of each process,
+# so Prometheus should scrape every worker (or run one process per port).
+#
+# Recording one request costs a few perf_counter() calls and additions, so
+# it's on all the time.
+
+# seconds, and numbers of queries.
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# the timings of the request being served (None outside of a request).
+current = ContextVar('blog_request_timings', default=None)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # label value -> [counts of each bucket (+Inf last), sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label=''):
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label)
+            if series is None:
+                series = self.series[label] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+    def lines(self, label_name):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self.lock:
+            series = {label: ([*counts], total, count) for label, (counts, total, count) in self.series.items()}
+        for label, (counts, total, count) in sorted(series.items()):
+            labels = f'{label_name}="{escape_label(label)}"' if label_name else ''
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                yield f'{self.name}_bucket{{{labels + "," if labels else ""}le="{bound}"}} {cumulative}'
+            labels = f'{{{labels}}}' if labels else ''
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# histograms by view name.
+VIEW_HISTOGRAMS = {
+    'request': Histogram('blog_request_seconds', 'Time spent in the view and the middlewares.', TIME_BUCKETS),
+    'queries': Histogram('blog_sql_queries', 'SQL queries run by a request.', COUNT_BUCKETS),
+    'sql': Histogram('blog_sql_seconds', 'Time spent in SQL queries by a request.', TIME_BUCKETS),
+    'template': Histogram('blog_template_seconds', 'Time spent rendering templates by a request.', TIME_BUCKETS),
+    'markdown': Histogram('blog_markdown_seconds', 'Time spent rendering Markdown by a request.', TIME_BUCKETS),
+}
+SMTP = Histogram('blog_smtp_seconds', 'Time spent sending one e-mail to the mail server.', TIME_BUCKETS)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.queries = 0
+        # seconds, by kind: 'sql', 'template', 'markdown'...
+        self.seconds = {}
+        # the slowest queries, as (seconds, sql), for the slow request log.
+        self.slowest = []
+
+    def add(self, kind, seconds):
+        self.seconds[kind] = self.seconds.get(kind, 0) + seconds
+
+
+def slow_queries_kept():
+    return getattr(settings, 'BLOG_SLOW_REQUEST_QUERIES', 5)
+
+
+@contextmanager
+def timed(kind):
+    # with timed('markdown'): ... adds the time to the request being served.
+    timings = current.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.add(kind, time.perf_counter() - started)
+
+
+def time_smtp(send):
+    # the mail workers aren't in a request, so the time goes straight to its histogram.
+    started = time.perf_counter()
+    try:
+        return send()
+    finally:
+        SMTP.observe(time.perf_counter() - started)
+
+
+class QueryTimer:
+    # connection.execute_wrapper calls it around every query.
+    def __init__(self, timings):
+        self.timings = timings
+        self.kept = slow_queries_kept()
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            seconds = time.perf_counter() - started
+            # async views run queries from several threads at once.
+            with self.lock:
+                self.timings.queries += 1
+                self.timings.add('sql', seconds)
+                # a small heap: only the slowest queries are kept.
+                if len(self.timings.slowest) < self.kept:
+                    heapq.heappush(self.timings.slowest, (seconds, sql))
+                elif self.kept and seconds > self.timings.slowest[0][0]:
+                    heapq.heapreplace(self.timings.slowest, (seconds, sql))
+
+
+class MetricsMiddleware:
+    # It records the time, the queries and the rendering of every request in
+    # the histograms, and logs the requests slower than BLOG_SLOW_REQUEST_MS
+    # with their slowest queries.
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = current.set(timings)
+        started = time.perf_counter()
+        try:
+            with wrap_queries(QueryTimer(timings)):
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        VIEW_HISTOGRAMS['request'].observe(elapsed, view)
+        VIEW_HISTOGRAMS['queries'].observe(timings.queries, view)
+        for kind in ('sql', 'template', 'markdown'):
+            VIEW_HISTOGRAMS[kind].observe(timings.seconds.get(kind, 0), view)
+
+        if elapsed * 1000 > getattr(settings, 'BLOG_SLOW_REQUEST_MS', 500):
+            log_slow_request(request, view, elapsed, timings)
+        return response
+
+
+def log_slow_request(request, view, elapsed, timings):
+    parts = ', '.join(f'{kind} {seconds * 1000:.1f}ms' for kind, seconds in sorted(timings.seconds.items()))
+    queries = '\n'.join(f'  {seconds * 1000:.1f}ms  {sql}'
+                        for seconds, sql in sorted(timings.slowest, reverse=True))
+    logger.warning('Slow request %s %s (%s): %.1fms, %d queries (%s)\n%s',
+                   request.method, request.get_full_path(), view, elapsed * 1000,
+                   timings.queries, parts or 'no breakdown', queries)
+
+
+class TimedTemplate:
+    # A template of the Django backend that adds its render time to the request.
+    def __init__(self, template):
+        self.template = template
+        self.origin = template.origin
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self.template.render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    # The Django template backend, with TimedTemplate templates (see
+    # TEMPLATES in settings.py). Templates included by other templates are
+    # rendered by the engine itself, so they're counted once, in their parent.
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+def exposition():
+    lines = []
+    for histogram in VIEW_HISTOGRAMS.values():
+        lines.extend(histogram.lines('view'))
+    lines.extend(SMTP.lines(None))
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    for histogram in (*VIEW_HISTOGRAMS.values(), SMTP):
+        histogram.reset()
+
+
+def metrics(request):
+    # Only for DEBUG or the addresses in INTERNAL_IPS: the view names and
+    # timings are not for everyone.
+    if not (settings.DEBUG or request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS):
+        raise Http404
+    return HttpResponse(exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
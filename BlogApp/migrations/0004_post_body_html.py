@@ -0,0 +1,55 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:58
+
+import markdown
+from django.db import migrations, models
+from django.template.defaultfilters import truncatewords_html
+
+
+# The posts written before these columns existed get their HTML now, so the
+# pages never show an empty excerpt. The rendering is copied here rather than
+# imported from BlogApp/rendering.py, so the migration keeps doing the same
+# thing when the app's code changes. It uses no Markdown extension: with
+# BLOG_MARKDOWN_EXTENSIONS set, run `manage.py render_posts` after migrating.
+EXCERPT_WORDS = 30
+
+
+def render_rows(rows):
+    rendered = []
+    for pk, body in rows:
+        html = markdown.markdown(body, extensions=[])
+        rendered.append((pk, html, truncatewords_html(html, EXCERPT_WORDS)))
+    return rendered
+
+
+def render_existing_posts(apps, schema_editor):
+    Post = apps.get_model('BlogApp', 'Post')
+    last_pk = 0
+    while True:
+        rows = list(Post.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'body')[:200])
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        Post.objects.bulk_update([Post(pk=pk, body_html=html, excerpt_html=excerpt)
+                                  for pk, html, excerpt in render_rows(rows)],
+                                 ['body_html', 'excerpt_html'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BlogApp', '0003_post_tags'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='body_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='excerpt_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(render_existing_posts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.3 on 2026-10-18 13:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BlogApp', '0004_post_body_html'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='post',
+            options={'ordering': ('-publish', '-id')},
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['status', '-publish', '-id'], name='post_status_publish_id_idx'),
+        ),
+    ]
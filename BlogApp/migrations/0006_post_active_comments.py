@@ -0,0 +1,36 @@
+# Generated by Django 3.0.3 on 2026-10-18 14:01
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_active_comments(apps, schema_editor):
+    Post = apps.get_model('BlogApp', 'Post')
+    Comment = apps.get_model('BlogApp', 'Comment')
+    active = (Comment.objects.filter(post=OuterRef('pk'), active=True)
+              .order_by()
+              .values('post')
+              .annotate(total=Count('id'))
+              .values('total'))
+    Post.objects.update(active_comments=Coalesce(Subquery(active), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BlogApp', '0005_post_publish_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='active_comments',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['status', '-active_comments'], name='post_status_comments_idx'),
+        ),
+        migrations.RunPython(count_active_comments, migrations.RunPython.noop),
+    ]
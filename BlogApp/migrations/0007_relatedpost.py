@@ -0,0 +1,28 @@
+# Generated by Django 3.0.3 on 2026-10-18 14:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BlogApp', '0006_post_active_comments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedPost',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.PositiveIntegerField()),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_entries', to='BlogApp.Post')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='BlogApp.Post')),
+            ],
+            options={
+                'ordering': ('post', 'rank'),
+                'unique_together': {('post', 'rank')},
+            },
+        ),
+    ]
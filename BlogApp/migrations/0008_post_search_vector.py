@@ -0,0 +1,55 @@
+# Generated by Django 3.0.3 on 2026-10-18 14:31
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# On PostgreSQL the search vector is filled by a trigger, so it's right even
+# for rows written by raw SQL or bulk_create, and it's searched through a GIN index.
+CREATE_SQL = """
+CREATE FUNCTION blogapp_post_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector(COALESCE(NEW.title, '')), 'A') ||
+        setweight(to_tsvector(COALESCE(NEW.body, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER blogapp_post_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, body ON "BlogApp_post"
+    FOR EACH ROW EXECUTE PROCEDURE blogapp_post_search_vector_update();
+
+CREATE INDEX post_search_vector_gin ON "BlogApp_post" USING gin (search_vector);
+"""
+
+DROP_SQL = """
+DROP INDEX IF EXISTS post_search_vector_gin;
+DROP TRIGGER IF EXISTS blogapp_post_search_vector_trigger ON "BlogApp_post";
+DROP FUNCTION IF EXISTS blogapp_post_search_vector_update();
+"""
+
+
+def create_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_SQL)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BlogApp', '0007_relatedpost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
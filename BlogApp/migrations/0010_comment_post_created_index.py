@@ -0,0 +1,21 @@
+# Generated by Django 3.0.3 on 2026-10-18 14:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BlogApp', '0009_outboundemail'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='comment',
+            options={'ordering': ('created', 'id')},
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'active', 'created', 'id'], name='comment_post_created_idx'),
+        ),
+    ]
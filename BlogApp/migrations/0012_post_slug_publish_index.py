@@ -0,0 +1,17 @@
+# Generated by Django 3.0.3 on 2026-10-18 14:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BlogApp', '0011_post_views_popularity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['slug', 'publish'], name='post_slug_publish_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+import math
+
+from django.db import migrations
+
+
+# Post.popularity becomes log2 of the sum of the views' worths (see
+# popularity.py), which doesn't overflow.
+def to_log_scores(apps, schema_editor):
+    Post = apps.get_model('BlogApp', 'Post')
+    for pk, popularity in Post.objects.filter(popularity__gt=0).values_list('pk', 'popularity').iterator():
+        Post.objects.filter(pk=pk).update(popularity=math.log2(popularity))
+
+
+def to_sums(apps, schema_editor):
+    Post = apps.get_model('BlogApp', 'Post')
+    for pk, popularity in Post.objects.filter(views__gt=0).values_list('pk', 'popularity').iterator():
+        # the biggest float, for the scores that didn't fit.
+        Post.objects.filter(pk=pk).update(popularity=2 ** min(popularity, 1023))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('BlogApp', '0012_post_slug_publish_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_log_scores, to_sums),
+    ]
@@ -1,19 +1,54 @@
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.utils import timezone
 from django.urls import reverse
 from taggit.managers import TaggableManager
 
+from .rendering import render_markdown, render_excerpt
+
 
 # Now lets create a manager, this manager allow you
 # to retrieve posts using like: Post.published.all()
 class PublishedManager(models.Manager):
     def get_queryset(self):
-        return super().get_queryset().filter(status='published')
+        # search_vector can be as big as the body and only search needs it.
+        return super().get_queryset().filter(status='published').defer('search_vector')
+
+
+# It remembers the values loaded from the database, so save() and the signal
+# receivers can ask which fields were changed.
+class TrackChangesMixin:
+    # Django calls from_db when it loads an object, so we keep the values that came
+    # from the database to know later which fields were changed.
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def field_changed(self, name):
+        # a deferred field that was never touched can't have changed.
+        if name not in self.__dict__:
+            return False
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None or name not in loaded:
+            return True
+        return loaded[name] != self.__dict__[name]
+
+    def loaded_value(self, name, default=None):
+        return getattr(self, '_loaded_values', {}).get(name, default)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # what we've just saved is what the database has now.
+        self._loaded_values = {field.attname: self.__dict__[field.attname]
+                               for field in self._meta.concrete_fields
+                               if field.attname in self.__dict__}
 
 
 # This is a model data for blog posts
-class Post(models.Model):
+class Post(TrackChangesMixin, models.Model):
     STATUS_CHOICES = (
         ('draft', 'Draft'),
         ('published', 'Published'),
@@ -41,6 +76,11 @@ class Post(models.Model):
     # It's body's post.
     body = models.TextField()
 
+    # The body already converted from Markdown to HTML and its first words.
+    # They're filled by save(), so templates don't run Markdown on every request.
+    body_html = models.TextField(blank=True, editable=False)
+    excerpt_html = models.TextField(blank=True, editable=False)
+
     # It uses Django's timezone.now() as default value
     # indicating when post was published.
     publish = models.DateTimeField(default=timezone.now)
@@ -52,11 +92,28 @@ class Post(models.Model):
     # The date will be updated automatically when you save an object.
     updated = models.DateTimeField(auto_now=True)
 
+    # How many active comments the post has. It's kept up to date by the
+    # signals in signals.py, so nobody has to COUNT comments to show it.
+    active_comments = models.PositiveIntegerField(default=0, editable=False)
+
+    # Title (weight A) and body (weight B) already split in words for full-text
+    # search. On PostgreSQL a trigger keeps it up to date (see migration 0008),
+    # so Django never writes it.
+    search_vector = SearchVectorField(null=True, editable=False)
+
     # You can only choose STATUS_CHOICES who are pre-defined.
     status = models.CharField(max_length=10,
                               choices=STATUS_CHOICES,
                               default='draft')
 
+    # How many times the post was read, and a score where recent views weigh
+    # more. Both are written in batches by popularity.py, never by save().
+    views = models.PositiveIntegerField(default=0, editable=False)
+    popularity = models.FloatField(default=0, editable=False)
+
+    # Fields that only the database writes.
+    DATABASE_FIELDS = ('active_comments', 'search_vector', 'views', 'popularity')
+
     # This is the default manager.
     objects = models.Manager()
 
@@ -68,15 +125,54 @@ class Post(models.Model):
 
     # This class contains meta data. When you use the negative prefix
     # means that once you query the database it will sort by descending
-    # order all the publish fields.
+    # order all the publish fields. The id breaks ties between posts
+    # published at the same time, what cursor pagination needs.
     class Meta:
-        ordering = ('-publish',)
+        ordering = ('-publish', '-id')
+        indexes = [
+            # it lets Post.published walk (publish, id) straight from the index.
+            models.Index(fields=['status', '-publish', '-id'],
+                         name='post_status_publish_id_idx'),
+            # it makes "most commented posts" an index scan.
+            models.Index(fields=['status', '-active_comments'],
+                         name='post_status_comments_idx'),
+            # and "popular posts" one too.
+            models.Index(fields=['status', '-popularity'],
+                         name='post_status_popularity_idx'),
+            # the detail page finds its post by slug and a range of publish.
+            models.Index(fields=['slug', 'publish'],
+                         name='post_slug_publish_idx'),
+        ]
 
     # It makes representation human-readable. It'll be useful in
     # the administration site.
     def __str__(self):
         return self.title
 
+    def render_body(self):
+        self.body_html = render_markdown(self.body)
+        self.excerpt_html = render_excerpt(self.body_html)
+
+    def save(self, *args, **kwargs):
+        # active_comments, views and popularity are only changed with F()
+        # updates, so an old copy of the post (like the one the admin edits)
+        # mustn't write them back.
+        # search_vector belongs to the database trigger.
+        if (not self._state.adding and not kwargs.get('force_insert')
+                and kwargs.get('update_fields') is None):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key
+                                       and field.name not in self.DATABASE_FIELDS
+                                       and field.attname not in deferred]
+        # Markdown is only rendered again when the body really changed.
+        if self.field_changed('body') or not self.body_html:
+            self.render_body()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'body_html', 'excerpt_html'}
+        super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('BlogApp:post_detail',
                        args=[self.publish.year,
@@ -85,7 +181,7 @@ class Post(models.Model):
                              self.slug])
 
 
-class Comment(models.Model):
+class Comment(TrackChangesMixin, models.Model):
     # This is comment's class
 
     # - Post's ForeignKey is many-to-one relation, it means that a post
@@ -111,8 +207,79 @@ class Comment(models.Model):
 
     # It's giving to Comment the property of sort by 'created'.
     class Meta:
-        ordering = ('created',)
+        ordering = ('created', 'id')
+        indexes = [
+            # a post's comments are read a page at a time, walking (created, id)
+            # from the index, without sorting them all (see comments_page in views.py).
+            models.Index(fields=['post', 'active', 'created', 'id'],
+                         name='comment_post_created_idx'),
+        ]
 
     # This's what'll be printed, when you print a comment obj.
     def __str__(self):
         return f'Comment by {self.name} on {self.post}'
+
+
+class RelatedPost(models.Model):
+    # It's a materialized list of similar posts: for each post we keep its
+    # best neighbours, the ones sharing more tags, already sorted by rank.
+    # It's refreshed by related.py when tags or status change, so the detail
+    # page only reads it.
+    post = models.ForeignKey(Post,
+                             on_delete=models.CASCADE,
+                             related_name='related_entries')
+    related = models.ForeignKey(Post,
+                                on_delete=models.CASCADE,
+                                related_name='+')
+    # how many tags both posts share.
+    score = models.PositiveIntegerField()
+    # 0 is the most similar one.
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ('post', 'rank')
+        # it's also the index that reads a post's list in rank order.
+        unique_together = ('post', 'rank')
+
+    def __str__(self):
+        return f'{self.related} is similar to {self.post}'
+
+
+class OutboundEmail(models.Model):
+    # It's the outbox. post_share only writes the message here and answers
+    # right away, and the workers in mailqueue.py send it later. As it's a
+    # table, no message is lost when the server restarts.
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    )
+
+    subject = models.CharField(max_length=400)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    # the recipients, separated by commas.
+    to = models.TextField()
+    status = models.CharField(max_length=10,
+                              choices=STATUS_CHOICES,
+                              default='queued')
+    # how many times we tried, and when we'll try again.
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # a worker that takes a message holds it until locked_until, so two
+    # workers never send the same message.
+    claimed_by = models.CharField(max_length=32, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('created',)
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'],
+                         name='email_status_next_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} to {self.to}'
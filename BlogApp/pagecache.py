@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import re
+import time
+import uuid
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+from .conditional import sidebar_signature
+from .routers import read_from_replica, sticky_seconds
+
+# A cache of whole pages for anonymous visitors. Each page is stored with the
+# "tags" it depends on, like 'post:12' or 'tag:django', and the version each
+# tag had. Purging a tag gives it a new version, so only the pages depending
+# on it miss next time, the rest of the cache stays warm.
+#
+# Tags used by the views and the signals:
+#   post:<id>      the post's own content (its page, and lists showing it)
+#   comments:<id>  the comments of a post
+#   related:<id>   the similar posts list of a post
+#   post-list      which posts the main list shows
+#   tag:<slug>     which posts a tag list shows
+# The sidebar is on every page, so every page also depends on what it shows.
+#
+# Tag versions, pages and counters all live in the Django cache. With
+# LocMemCache each process has its own: a purge only reaches the process
+# that made it, the others keep serving their copy until it expires. With
+# more than one process, use a shared cache (Memcached, Redis...);
+# check_page_cache warns about it.
+
+PAGE_PREFIX = 'blog:page'
+PURGED_AT_KEY = f'{PAGE_PREFIX}:purged_at'
+STATS = ('hits', 'misses', 'bypasses', 'purges')
+
+# {% csrf_token %} is personal, so it's taken out of the stored HTML and each
+# visitor gets their own when the page is served.
+CSRF_RE = re.compile(r'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+CSRF_PLACEHOLDER = '__blog_csrf_token__'
+
+
+def page_cache_timeout():
+    # 0 turns the page cache off.
+    return getattr(settings, 'BLOG_PAGE_CACHE_TIMEOUT', 600)
+
+
+def check_page_cache(app_configs, **kwargs):
+    # Registered in apps.py. In development (DEBUG) a single process is fine.
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if page_cache_timeout() and not settings.DEBUG and backend.endswith('.LocMemCache'):
+        return [checks.Warning(
+            'The page cache uses LocMemCache, so purges only reach the process that made them.',
+            hint='Use a cache shared by all the processes (Memcached, Redis...) in CACHES, '
+                 'run a single process, or set BLOG_PAGE_CACHE_TIMEOUT = 0.',
+            id='BlogApp.W001',
+        )]
+    return []
+
+
+def tag_key(tag):
+    return f'{PAGE_PREFIX}:tag:{tag}'
+
+
+def stat_key(name):
+    return f'{PAGE_PREFIX}:stats:{name}'
+
+
+def page_key(request):
+    url = request.get_host() + request.get_full_path()
+    return f'{PAGE_PREFIX}:{hashlib.md5(url.encode()).hexdigest()}'
+
+
+def count(name):
+    # the counters live in the cache: with a shared cache every process adds
+    # to the same ones, with LocMemCache each process counts its own.
+    key = stat_key(name)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # it was evicted between add and incr.
+        cache.set(key, 1, None)
+
+
+def page_cache_stats():
+    values = cache.get_many([stat_key(name) for name in STATS])
+    stats = {name: values.get(stat_key(name), 0) for name in STATS}
+    served = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / served if served else 0.0
+    return stats
+
+
+def purge_count():
+    return cache.get(stat_key('purges'), 0)
+
+
+def reset_page_cache_stats():
+    cache.delete_many([stat_key(name) for name in STATS])
+
+
+def tag_versions(tags):
+    keys = {tag: tag_key(tag) for tag in tags}
+    found = cache.get_many(list(keys.values()))
+    versions = {}
+    for tag, key in keys.items():
+        if key not in found:
+            # a tag nobody asked for yet (or just purged) gets a new version.
+            cache.add(key, uuid.uuid4().hex, None)
+            found[key] = cache.get(key)
+        versions[tag] = found[key]
+    return versions
+
+
+def purge_pages(*tags):
+    # Only the version keys go away, the pages are found stale when they're
+    # asked for. It waits for the transaction, or a request could cache the
+    # old data again before it's committed.
+    tags = set(tags)
+    if not tags:
+        return
+
+    def purge():
+        cache.delete_many([tag_key(tag) for tag in tags])
+        cache.set(PURGED_AT_KEY, time.time(), None)
+        count('purges')
+    transaction.on_commit(purge)
+
+
+def depends_on(request, *tags):
+    # the views tell which tags their page depends on.
+    if not hasattr(request, 'page_tags'):
+        request.page_tags = set()
+    request.page_tags.update(tags)
+
+
+def can_cache(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    # someone logged in (or with messages waiting) may see a different page.
+    return settings.SESSION_COOKIE_NAME not in request.COOKIES
+
+
+def serve(request, entry):
+    content = entry['content']
+    if CSRF_PLACEHOLDER in content:
+        # every {% csrf_token %} gets the visitor's token (and so the cookie is set).
+        content = content.replace(CSRF_PLACEHOLDER, get_token(request))
+    response = HttpResponse(content)
+    for header, value in entry['headers'].items():
+        response[header] = value
+    return response
+
+
+def store(request, key, response, purges_before, sidebar):
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return
+    if purge_count() != purges_before:
+        # something was purged while the page was rendered, maybe with old data.
+        return
+    if read_from_replica() and time.time() - cache.get(PURGED_AT_KEY, 0) < sticky_seconds():
+        # the replica may not have the change that was just purged yet (see routers.py).
+        return
+    content = CSRF_RE.sub(rf'\g<1>{CSRF_PLACEHOLDER}\g<2>', response.content.decode(response.charset))
+    headers = {header: response[header] for header in ('Content-Type', 'ETag', 'Last-Modified')
+               if response.has_header(header)}
+    cache.set(key, {'content': content,
+                    'headers': headers,
+                    'versions': tag_versions(getattr(request, 'page_tags', ())),
+                    'sidebar': sidebar_signature() if sidebar else None}, page_cache_timeout())
+
+
+def cache_page_by_tags(view=None, sidebar=True):
+    # It serves anonymous GETs from the cache. POSTs (the comment form) and
+    # visitors with a session always run the view. Pages without the sidebar
+    # (the feeds) use @cache_page_by_tags(sidebar=False).
+    if view is None:
+        return lambda view: cache_page_by_tags(view, sidebar)
+
+    if asyncio.iscoroutinefunction(view):
+        # the same, for the async views of asyncviews.py: only the view is
+        # awaited, the cache is read and written in a thread.
+        @wraps(view)
+        async def async_inner(request, *args, **kwargs):
+            state, value = await sync_to_async(lookup)(request, sidebar)
+            if state == 'hit':
+                return value
+            response = await view(request, *args, **kwargs)
+            return await sync_to_async(finish)(request, response, state, value, sidebar)
+        return async_inner
+
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        state, value = lookup(request, sidebar)
+        if state == 'hit':
+            return value
+        return finish(request, view(request, *args, **kwargs), state, value, sidebar)
+    return inner
+
+
+def lookup(request, sidebar):
+    # ('hit', response), ('miss', (key, purges before the view)) or ('bypass', None).
+    if not page_cache_timeout() or not can_cache(request):
+        count('bypasses')
+        return 'bypass', None
+
+    key = page_key(request)
+    entry = cache.get(key)
+    if (entry is not None
+            and tag_versions(entry['versions']) == entry['versions']
+            and (not sidebar or sidebar_signature() == entry['sidebar'])):
+        count('hits')
+        response = serve(request, entry)
+        # a cached page answers conditional GETs too.
+        conditional = get_conditional_response(
+            request,
+            etag=response.get('ETag'),
+            last_modified=parse_http_date_safe(response.get('Last-Modified', '')),
+            response=response)
+        conditional['X-Page-Cache'] = 'hit'
+        return 'hit', conditional
+
+    count('misses')
+    return 'miss', (key, purge_count())
+
+
+def finish(request, response, state, value, sidebar):
+    # after the view ran: the page is stored if it was a miss.
+    if state == 'miss' and request.method == 'GET':
+        key, purges_before = value
+        store(request, key, response, purges_before, sidebar)
+    response['X-Page-Cache'] = state
+    return response
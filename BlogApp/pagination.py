@@ -0,0 +1,233 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+def load_cursor(cursor):
+    # it gives back [direction, key], where direction is 'n' (next) or 'p' (previous).
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()))
+
+
+# Keyset (or cursor) pagination doesn't use OFFSET nor COUNT(*). Each page
+# remembers the sort key of its first and last rows, and the next page just
+# asks for the rows that come after that key. So page 5000 costs the same as page 1.
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class KeysetPaginator:
+    # ordering must end with a unique field (like id), so no two rows share a key.
+    def __init__(self, queryset, per_page, ordering=('-publish', '-id')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = tuple(ordering)
+        self.fields = [name.lstrip('-') for name in self.ordering]
+
+    def page(self, cursor=None):
+        direction, key = self.decode(cursor)
+
+        if direction == 'previous':
+            # we walk backwards and flip the rows, so they keep the usual order.
+            reverse = tuple(name[1:] if name.startswith('-') else '-' + name
+                            for name in self.ordering)
+            rows = list(self.queryset.filter(self.after(key, reverse))
+                        .order_by(*reverse)[:self.per_page + 1])
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            has_next = True
+        else:
+            queryset = self.queryset
+            if key is not None:
+                queryset = queryset.filter(self.after(key, self.ordering))
+            rows = list(queryset.order_by(*self.ordering)[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_previous = key is not None
+
+        if not rows:
+            return KeysetPage([])
+        return KeysetPage(rows,
+                          self.encode('next', rows[-1]) if has_next else None,
+                          self.encode('previous', rows[0]) if has_previous else None)
+
+    def after(self, key, ordering):
+        # (a, b) after (x, y) means: a after x, or a equals x and b after y.
+        condition = Q()
+        equal = {}
+        for name, value in zip(ordering, key):
+            field = name.lstrip('-')
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{field}__{lookup}': value})
+            equal[field] = value
+        return condition
+
+    def encode(self, direction, obj):
+        key = [getattr(obj, field) for field in self.fields]
+        payload = json.dumps([direction[0], key], default=self.serialize)
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def serialize(value):
+        # isoformat keeps the microseconds, so the key matches the row exactly.
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        return str(value)
+
+    def decode(self, cursor):
+        # a broken cursor just gives the first page, as a wrong page number did.
+        if not cursor:
+            return 'next', None
+        try:
+            direction, key = load_cursor(cursor)
+            if direction not in ('n', 'p') or len(key) != len(self.fields):
+                raise ValueError
+            meta = self.queryset.model._meta
+            key = [meta.get_field(field).to_python(value)
+                   for field, value in zip(self.fields, key)]
+        except (ValueError, TypeError, binascii.Error, ValidationError):
+            return 'next', None
+        return ('previous' if direction == 'p' else 'next'), key
+
+
+class KeysetStream:
+    # One page of a KeysetPaginator, read in batches of chunk_size rows
+    # (with a server-side cursor on PostgreSQL) instead of all at once, for the
+    # big pages of the API. It only walks forward, and next_cursor is known
+    # once the batches were read.
+    def __init__(self, paginator, cursor=None, chunk_size=100):
+        self.paginator = paginator
+        self.chunk_size = chunk_size
+        direction, self.key = paginator.decode(cursor)
+        if direction == 'previous':
+            self.key = None
+        self.next_cursor = None
+
+    def __iter__(self):
+        paginator = self.paginator
+        queryset = paginator.queryset
+        if self.key is not None:
+            queryset = queryset.filter(paginator.after(self.key, paginator.ordering))
+        rows = (queryset.order_by(*paginator.ordering)[:paginator.per_page + 1]
+                .iterator(chunk_size=self.chunk_size))
+        batch, seen, last = [], 0, None
+        for row in rows:
+            if seen == paginator.per_page:
+                # the extra row only tells there's a next page.
+                self.next_cursor = paginator.encode('next', last)
+                break
+            batch.append(row)
+            seen, last = seen + 1, row
+            if len(batch) == self.chunk_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+# Numbered pages that don't count the results. We ask for one row more than
+# the page size just to know if there's a next page. max_pages keeps the
+# OFFSET small, for results ordered by rank where a cursor doesn't fit.
+class NumberedPage:
+    def __init__(self, object_list, number, has_next):
+        self.object_list = object_list
+        self.number = number
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def page_without_count(queryset, number, per_page, max_pages=None):
+    try:
+        number = max(int(number), 1)
+    except (TypeError, ValueError):
+        number = 1
+    if max_pages:
+        number = min(number, max_pages)
+
+    offset = (number - 1) * per_page
+    rows = list(queryset[offset:offset + per_page + 1])
+    has_next = len(rows) > per_page and (not max_pages or number < max_pages)
+    return NumberedPage(rows[:per_page], number, has_next)
+
+
+# A Paginator for the admin, where COUNT(*) over a big table is the slowest
+# part of a page. It counts at most BLOG_ADMIN_EXACT_COUNT_LIMIT rows; past
+# that, PostgreSQL gives an estimate (the table size it keeps in pg_class, or
+# the planner's guess for a filtered list) and other databases just say "the
+# limit". The last pages may then be a bit off, or not linked.
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        limit = getattr(settings, 'BLOG_ADMIN_EXACT_COUNT_LIMIT', 10000)
+        # a sliced count reads `limit` rows at most.
+        counted = self.object_list[:limit].count()
+        if counted < limit:
+            return counted
+        return max(estimated_count(self.object_list) or 0, limit)
+
+
+def estimated_count(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [connection.ops.quote_name(queryset.model._meta.db_table)])
+            row = cursor.fetchone()
+            return int(row[0]) if row else None
+        sql, params = queryset.order_by().query.get_compiler(queryset.db).as_sql()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
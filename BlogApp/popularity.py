@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+from functools import reduce, wraps
+from operator import or_
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Case, F, FloatField, IntegerField, Q, Value, When
+
+from .cache import invalidate_sidebar
+from .internal import is_internal
+from .models import Post
+from .postlookup import url_filters
+
+logger = logging.getLogger(__name__)
+
+# Post views are counted in the memory of each process and written to the
+# database every BLOG_VIEW_FLUSH_SECONDS by a background thread, with one
+# UPDATE for a whole batch of posts. The UPDATE adds to the columns
+# (views = views + n), so any number of processes can flush at the same time
+# without losing each other's views. If a process dies, it loses at most the
+# views of the last BLOG_VIEW_FLUSH_SECONDS.
+#
+# Post.popularity is a "forward decay" score: a view at time t is worth
+# 2 ** ((t - BLOG_POPULARITY_EPOCH) / half-life), so a view is worth twice as
+# much as one a half-life older. Old scores are never rewritten, newer views
+# simply weigh more, and "popular posts" is just ORDER BY popularity on an
+# index.
+#
+# Those worths grow without end (a float overflows past 2 ** 1024, which a
+# one-day half-life reaches in under 3 years), so popularity keeps log2 of
+# their sum: a view adds view_score(t) "in log space" (add_scores), and the
+# order of the posts is the same. A post without views has 0.
+
+FLUSH_BATCH_SIZE = 500
+
+
+def half_life_seconds():
+    return getattr(settings, 'BLOG_POPULARITY_HALF_LIFE_DAYS', 7) * 86400
+
+
+def epoch():
+    return getattr(settings, 'BLOG_POPULARITY_EPOCH', datetime(2020, 1, 1)).timestamp()
+
+
+def view_score(when=None):
+    # log2 of what a view at `when` is worth.
+    when = time.time() if when is None else when
+    return (when - epoch()) / half_life_seconds()
+
+
+def add_scores(first, second):
+    # log2(2 ** first + 2 ** second), without computing the powers.
+    if first < second:
+        first, second = second, first
+    if second == -math.inf:
+        return first
+    return first + math.log2(1 + 2 ** (second - first))
+
+
+class ViewBuffer:
+    # (year, month, day, slug) -> [views, score]. The posts are found by
+    # their URL, so counting a view needs no query (not even on a page cache hit).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flusher = None
+
+    def add(self, key, when=None):
+        score = view_score(when)
+        with self.lock:
+            counts = self.pending.get(key)
+            if counts is None:
+                self.pending[key] = [1, score]
+            else:
+                counts[0] += 1
+                counts[1] = add_scores(counts[1], score)
+        self.start_flusher()
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def give_back(self, pending):
+        # a failed flush: the views are merged with the new ones, for the next try.
+        with self.lock:
+            for key, (views, score) in pending.items():
+                counts = self.pending.setdefault(key, [0, -math.inf])
+                counts[0] += views
+                counts[1] = add_scores(counts[1], score)
+
+    def flush(self):
+        pending = self.take()
+        if not pending:
+            return 0
+        try:
+            updated = write_views(pending)
+        except Exception:
+            logger.exception('Could not write %d post views', sum(views for views, _ in pending.values()))
+            self.give_back(pending)
+            return 0
+        if updated:
+            refresh_popular_posts()
+        return updated
+
+    def start_flusher(self):
+        interval = getattr(settings, 'BLOG_VIEW_FLUSH_SECONDS', 10)
+        if not interval or self.flusher is not None:
+            return
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run, args=(interval,),
+                                                name='view-flusher', daemon=True)
+                self.flusher.start()
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            finally:
+                # this thread isn't a request, so it cleans its connection itself.
+                close_old_connections()
+
+
+def write_views(pending):
+    # It gives back how many posts were updated.
+    keys = list(pending)
+    updated = 0
+    for start in range(0, len(keys), FLUSH_BATCH_SIZE):
+        batch = keys[start:start + FLUSH_BATCH_SIZE]
+        urls = [Q(**url_filters(year, month, day, slug)) for year, month, day, slug in batch]
+        found = Post.published.filter(reduce(or_, urls)).values_list('pk', 'slug', 'publish')
+        deltas = {}
+        for pk, slug, publish in found:
+            counts = pending.get((publish.year, publish.month, publish.day, slug))
+            if counts is not None:
+                deltas[pk] = counts
+        if not deltas:
+            continue
+        with transaction.atomic():
+            # The scores are added in Python, so the rows are locked until the
+            # UPDATE: another process flushing the same posts waits for this one.
+            # (SQLite has no row locks, but only one of them writes at a time.)
+            current = {pk: (views, popularity) for pk, views, popularity in
+                       Post.objects.select_for_update().filter(pk__in=list(deltas))
+                       .values_list('pk', 'views', 'popularity')}
+            scores = {pk: add_scores(popularity if views else -math.inf, deltas[pk][1])
+                      for pk, (views, popularity) in current.items()}
+            if not scores:
+                continue
+            updated += Post.objects.filter(pk__in=list(scores)).update(
+                views=F('views') + Case(*[When(pk=pk, then=Value(deltas[pk][0])) for pk in scores],
+                                        output_field=IntegerField()),
+                popularity=Case(*[When(pk=pk, then=Value(score)) for pk, score in scores.items()],
+                                output_field=FloatField()))
+    return updated
+
+
+def refresh_popular_posts():
+    # The "Popular posts" sidebar only changes when views are written, so it
+    # is cached like the rest of the sidebar. After a flush, if the top posts
+    # aren't the ones shown any more, the sidebar is thrown away, and with it
+    # the cached pages and validators (they carry its signature).
+    from .templatetags.blog_tags import get_popular_posts
+
+    shown = [post.pk for post in get_popular_posts()]
+    top = list(Post.published.order_by('-popularity').values_list('pk', flat=True)[:len(shown)])
+    if top != shown:
+        invalidate_sidebar()
+
+
+views_buffer = ViewBuffer()
+
+
+def count_view(request, year, month, day, post):
+    views_buffer.add((int(year), int(month), int(day), post))
+
+
+def track_views(view):
+    # It counts the views of post_detail: pages served from the page cache
+    # and 304s count too, but only for GETs, and not the blog's own requests
+    # (see internal.py).
+    def counted(request, response, args, kwargs):
+        if request.method == 'GET' and response.status_code in (200, 304) and not is_internal(request):
+            count_view(request, *args, **kwargs)
+        return response
+
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def async_inner(request, *args, **kwargs):
+            return counted(request, await view(request, *args, **kwargs), args, kwargs)
+        return async_inner
+
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        return counted(request, view(request, *args, **kwargs), args, kwargs)
+    return inner
@@ -0,0 +1,79 @@
+import datetime
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import Http404
+
+# A post's URL is /<year>/<month>/<day>/<slug>/. The day becomes a range,
+# publish >= day and publish < next day, which the (slug, publish) index
+# answers directly (publish__year and friends are functions of the column,
+# so they can't use it).
+#
+# Once found, the post's id is remembered for that URL in a small LRU cache in
+# each process, and the next lookups are "pk = id AND slug = ... AND publish in
+# the day": a primary key fetch, which still finds nothing if the post moved
+# or was unpublished since (a signal also forgets it in this process).
+
+
+def url_filters(year, month, day, slug):
+    try:
+        start = datetime.datetime(int(year), int(month), int(day))
+    except (ValueError, OverflowError):
+        raise Http404('No post at this date.')
+    return {'slug': slug, 'publish__gte': start, 'publish__lt': start + datetime.timedelta(days=1)}
+
+
+class PostIdCache:
+    # (year, month, day, slug) -> post id, dropping the least recently used.
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.ids = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            pk = self.ids.get(key)
+            if pk is not None:
+                self.ids.move_to_end(key)
+            return pk
+
+    def set(self, key, pk):
+        with self.lock:
+            self.ids[key] = pk
+            self.ids.move_to_end(key)
+            while len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+
+    def forget(self, key):
+        with self.lock:
+            self.ids.pop(key, None)
+
+    def forget_post(self, pk):
+        with self.lock:
+            for key in [key for key, value in self.ids.items() if value == pk]:
+                del self.ids[key]
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+
+
+post_ids = PostIdCache(getattr(settings, 'BLOG_POST_ID_CACHE_SIZE', 1000))
+
+
+def lookup_post(queryset, year, month, day, slug):
+    # The first row of `queryset` (objects or values) for that URL, or None.
+    filters = url_filters(year, month, day, slug)
+    key = (int(year), int(month), int(day), slug)
+    pk = post_ids.get(key)
+    if pk is not None:
+        found = queryset.filter(pk=pk, **filters).first()
+        if found is not None:
+            return found
+        post_ids.forget(key)
+
+    found = queryset.filter(**filters).first()
+    if found is not None:
+        post_ids.set(key, found['pk'] if isinstance(found, dict) else found.pk)
+    return found
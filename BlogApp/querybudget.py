@@ -0,0 +1,108 @@
+import logging
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# A view declares how many SQL queries it may run, for example:
+#
+#     @query_budget(6, POST=9)
+#     def post_detail(request, ...):
+#
+# The first number is the default, the keywords change it for some methods
+# or for some URL names (when one view serves many URLs).
+def query_budget(limit, **per_method):
+    def decorator(view):
+        view.query_budget = dict(per_method, default=limit)
+        return view
+    return decorator
+
+
+def budget_for(view, method, url_name=None):
+    budget = getattr(view, 'query_budget', None)
+    if budget is None:
+        return None
+    if method in budget:
+        return budget[method]
+    return budget.get(url_name, budget['default'])
+
+
+class QueryCounter:
+    # connection.execute_wrapper calls it around every query.
+    def __init__(self):
+        self.count = 0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+
+# The wrappers of the request being served. The threads that fetch data for
+# an async view install them too (see asyncviews.py), so their queries count.
+active_wrappers = ContextVar('blog_query_wrappers', default=())
+
+
+def wrap_all(stack, wrappers):
+    for wrapper in wrappers:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(wrapper))
+
+
+@contextmanager
+def wrap_queries(wrapper):
+    # connection.execute_wrapper(wrapper) on every database.
+    token = active_wrappers.set(active_wrappers.get() + (wrapper,))
+    try:
+        with ExitStack() as stack:
+            wrap_all(stack, [wrapper])
+            yield
+    finally:
+        active_wrappers.reset(token)
+
+
+@contextmanager
+def inherited_wrappers():
+    # in another thread: the wrappers of the request this thread works for.
+    with ExitStack() as stack:
+        wrap_all(stack, active_wrappers.get())
+        yield
+
+
+@contextmanager
+def count_queries():
+    # with count_queries() as counter: ... counts the queries on every database.
+    counter = QueryCounter()
+    with wrap_queries(counter):
+        yield counter
+
+
+class QueryBudgetMiddleware:
+    # It counts the queries of each request and compares them with the view's
+    # budget. Over budget it logs a warning, or raises QueryBudgetExceeded
+    # when BLOG_QUERY_BUDGET_STRICT is on (what the tests do).
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with count_queries() as counter:
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        budget = budget_for(match.func, request.method, match.url_name) if match else None
+        if budget is not None and counter.count > budget:
+            message = (f'{request.method} {request.path} ran {counter.count} queries, '
+                       f'its budget is {budget}:\n' + '\n'.join(counter.queries))
+            if getattr(settings, 'BLOG_QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
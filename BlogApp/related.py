@@ -0,0 +1,146 @@
+import heapq
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Count, Min
+from taggit.models import TaggedItem
+
+from .models import Post, RelatedPost
+from .pagecache import purge_pages
+
+
+# How many neighbours we keep for each post. The detail page shows only a few
+# of them, the rest is a margin so lists don't need to be rebuilt so often.
+def related_size():
+    return getattr(settings, 'BLOG_RELATED_POSTS', 10)
+
+
+def post_tagged_items():
+    return TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Post))
+
+
+def post_tag_ids(post_id):
+    return list(post_tagged_items().filter(object_id=post_id).values_list('tag_id', flat=True))
+
+
+def best_neighbours(post_id, tag_ids, tag_posts, publish, size):
+    # It's the order post_detail used to ask the database for: the published
+    # posts sharing more tags, and the newest ones first when it's a tie.
+    # tag_posts: tag id -> ids of its published posts; publish: post id -> date.
+    shared = Counter()
+    for tag_id in tag_ids:
+        shared.update(tag_posts[tag_id])
+    del shared[post_id]
+    return heapq.nsmallest(size, shared.items(),
+                           key=lambda item: (-item[1], -publish[item[0]].timestamp(), -item[0]))
+
+
+def refresh_posts(post_ids):
+    # It rebuilds the lists of the given posts all at once, with the same few
+    # queries for one post or a thousand: their tags, the published posts
+    # sharing those tags, and one DELETE and one INSERT.
+    post_ids = list(set(post_ids))
+    if not post_ids:
+        return
+    published = Post.published.values('pk')
+    post_tags = defaultdict(list)
+    for post_id, tag_id in (post_tagged_items()
+                            .filter(object_id__in=post_ids)
+                            .filter(object_id__in=published)
+                            .values_list('object_id', 'tag_id')):
+        post_tags[post_id].append(tag_id)
+
+    tag_ids = {tag_id for tags in post_tags.values() for tag_id in tags}
+    tag_posts = defaultdict(list)
+    candidates = post_tagged_items().filter(tag_id__in=tag_ids, object_id__in=published)
+    for post_id, tag_id in candidates.values_list('object_id', 'tag_id').iterator():
+        tag_posts[tag_id].append(post_id)
+    publish = dict(Post.published.filter(pk__in=candidates.values('object_id'))
+                   .values_list('pk', 'publish'))
+
+    size = related_size()
+    entries = [RelatedPost(post_id=post_id, related_id=related_id, score=score, rank=rank)
+               for post_id, tags in post_tags.items()
+               for rank, (related_id, score) in enumerate(best_neighbours(post_id, tags, tag_posts,
+                                                                          publish, size))]
+    with transaction.atomic():
+        RelatedPost.objects.filter(post_id__in=post_ids).delete()
+        RelatedPost.objects.bulk_create(entries)
+
+
+def refresh_post(post_id):
+    refresh_posts([post_id])
+
+
+def refresh_around(post_id):
+    # When a post changes, its own list changes, and so may the lists of the
+    # other posts: the ones that already show it, and the ones where it may
+    # come in now. Only those lists are rebuilt, together in refresh_posts.
+    affected = set(RelatedPost.objects.filter(related_id=post_id)
+                   .values_list('post_id', flat=True))
+
+    tag_ids = post_tag_ids(post_id)
+    if tag_ids and Post.published.filter(pk=post_id).exists():
+        size = related_size()
+        # how many tags each published post shares with this one.
+        shared = dict(post_tagged_items()
+                      .filter(tag_id__in=tag_ids,
+                              object_id__in=Post.published.values('pk'))
+                      .exclude(object_id=post_id)
+                      .values('object_id')
+                      .annotate(total=Count('id'))
+                      .values_list('object_id', 'total'))
+        # the worst score and the size of the lists of those posts.
+        bounds = {row['post_id']: row for row in
+                  RelatedPost.objects.filter(post_id__in=list(shared))
+                  .values('post_id')
+                  .annotate(worst=Min('score'), size=Count('id'))}
+        for other_id, score in shared.items():
+            row = bounds.get(other_id)
+            if row is None or row['size'] < size or score >= row['worst']:
+                affected.add(other_id)
+
+    affected.add(post_id)
+    refresh_posts(affected)
+    return affected
+
+
+def schedule_refresh(post_id):
+    # it waits for the transaction, so the tags and status we read are the saved ones.
+    # The cached pages showing the rebuilt lists are purged.
+    def refresh():
+        purge_pages(*[f'related:{other_id}' for other_id in refresh_around(post_id)])
+    transaction.on_commit(refresh)
+
+
+def rebuild_all(batch_size=1000):
+    # It computes every list in memory from the tagged items, which is much
+    # faster than one query per post, and writes them in batches.
+    publish = dict(Post.published.values_list('pk', 'publish'))
+    post_tags = defaultdict(list)
+    tag_posts = defaultdict(list)
+    for post_id, tag_id in (post_tagged_items()
+                            .filter(object_id__in=list(publish))
+                            .values_list('object_id', 'tag_id')
+                            .iterator()):
+        post_tags[post_id].append(tag_id)
+        tag_posts[tag_id].append(post_id)
+
+    size = related_size()
+    total = 0
+    with transaction.atomic():
+        RelatedPost.objects.all().delete()
+        entries = []
+        for post_id, tag_ids in post_tags.items():
+            best = best_neighbours(post_id, tag_ids, tag_posts, publish, size)
+            entries.extend(RelatedPost(post_id=post_id, related_id=related_id, score=score, rank=rank)
+                           for rank, (related_id, score) in enumerate(best))
+            if len(entries) >= batch_size:
+                RelatedPost.objects.bulk_create(entries)
+                total += len(entries)
+                entries = []
+        RelatedPost.objects.bulk_create(entries)
+        total += len(entries)
+    return total
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.template.defaultfilters import truncatewords_html
+import markdown
+
+from .metrics import timed
+
+# How many words the excerpt shown on list and search pages keeps.
+EXCERPT_WORDS = 30
+
+
+def render_markdown(text):
+    # BLOG_MARKDOWN_EXTENSIONS lets you turn on things like 'tables' or 'fenced_code'.
+    # If you change it, run: python manage.py render_posts
+    extensions = getattr(settings, 'BLOG_MARKDOWN_EXTENSIONS', [])
+    with timed('markdown'):
+        return markdown.markdown(text, extensions=extensions)
+
+
+def render_excerpt(html):
+    return truncatewords_html(html, EXCERPT_WORDS)
+
+
+def render_rows(rows):
+    # It receives a list of (pk, body) and gives back a list of (pk, html, excerpt).
+    # It doesn't touch the database, so it can run inside a worker process.
+    rendered = []
+    for pk, body in rows:
+        html = render_markdown(body)
+        rendered.append((pk, html, render_excerpt(html)))
+    return rendered
@@ -0,0 +1,137 @@
+import logging
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, Error, connections
+from django.urls import reverse
+
+logger = logging.getLogger(__name__)
+
+# Read replicas. The aliases in BLOG_REPLICAS (copies of 'default' kept by the
+# database's own replication) get the reads of GET requests: the lists, the
+# posts, the search, the feeds and the sitemaps. Everything else goes to the
+# primary ('default'):
+#   - the writes, and the reads of a request after it wrote,
+#   - POSTs (comments, shares), the admin, and reads inside a transaction,
+#   - management commands and the mail workers (they're not in a request),
+#   - for BLOG_PRIMARY_STICKY_SECONDS after a visitor wrote, every request of
+#     that visitor (a cookie says so), so their new comment shows up at once
+#     even if the replicas are a bit behind.
+# A replica that can't be connected to is left out for BLOG_REPLICA_CHECK_SECONDS,
+# and with none left the primary serves the reads.
+
+PIN_COOKIE = 'blog_primary'
+
+# what the request being served may use (None outside of a request).
+current = ContextVar('blog_routing', default=None)
+
+# alias -> (healthy, when it was checked), in each process.
+health = {}
+
+
+class Routing:
+    def __init__(self, use_primary):
+        self.use_primary = use_primary
+        self.wrote = False
+        # the replica this request reads from, chosen once so every query
+        # sees the same copy.
+        self.replica = None
+
+
+def replicas():
+    return getattr(settings, 'BLOG_REPLICAS', [])
+
+
+def sticky_seconds():
+    return getattr(settings, 'BLOG_PRIMARY_STICKY_SECONDS', 10)
+
+
+def is_healthy(alias):
+    healthy, checked = health.get(alias, (True, None))
+    now = time.monotonic()
+    if checked is not None and now - checked < getattr(settings, 'BLOG_REPLICA_CHECK_SECONDS', 30):
+        return healthy
+
+    connection = connections[alias]
+    try:
+        connection.ensure_connection()
+        healthy = connection.is_usable()
+    except Error:
+        healthy = False
+    if not healthy:
+        logger.warning('Replica %s is unavailable, its reads go to the primary.', alias)
+        try:
+            connection.close()
+        except Error:
+            pass
+    health[alias] = (healthy, now)
+    return healthy
+
+
+def read_from_replica():
+    # did the request being served read from a replica?
+    routing = current.get()
+    return routing is not None and routing.replica not in (None, DEFAULT_DB_ALIAS)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = current.get()
+        if routing is None or routing.use_primary or routing.wrote:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        if routing.replica is None:
+            healthy = [alias for alias in replicas() if is_healthy(alias)]
+            routing.replica = random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+        return routing.replica
+
+    def db_for_write(self, model, **hints):
+        routing = current.get()
+        if routing is not None:
+            routing.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # a replica holds the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replicas get the tables from the primary.
+        if db in replicas():
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware:
+    # It decides, for each request, if its reads may go to a replica, and
+    # pins the visitor to the primary for a while after they wrote.
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routing = Routing(use_primary=self.needs_primary(request))
+        token = current.set(routing)
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+
+        if routing.wrote and replicas():
+            seconds = sticky_seconds()
+            response.set_cookie(PIN_COOKIE, str(int(time.time() + seconds)), max_age=seconds,
+                                httponly=True, samesite='Lax')
+        return response
+
+    def needs_primary(self, request):
+        if not replicas() or request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            return True
+        if request.path.startswith(reverse('admin:index')):
+            return True
+        try:
+            pinned_until = float(request.COOKIES.get(PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+        return pinned_until > time.time()
@@ -0,0 +1,27 @@
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+_backend = None
+_lock = threading.Lock()
+
+
+# BLOG_SEARCH_BACKEND picks the backend, like 'BlogApp.search.postgres.PostgresSearchBackend'
+# or 'BlogApp.search.inverted.InvertedIndexBackend'. There's one per process.
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                _backend = import_string(settings.BLOG_SEARCH_BACKEND)()
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    global _backend
+    if setting.startswith('BLOG_SEARCH'):
+        _backend = None
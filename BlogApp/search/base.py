@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.db.models import Q
+
+from ..models import Post
+
+
+# Every search backend gives back the published posts matching a query, the
+# best ones first. The ones that keep their own index also follow the posts
+# through index_post and remove_post, which signals.py calls.
+class SearchBackend:
+    def search(self, query):
+        # it must return something that can be sliced, like a queryset.
+        raise NotImplementedError
+
+    def search_ids(self, query, limit):
+        return [post.pk for post in self.search(query)[:limit]]
+
+    def filter_admin(self, queryset, query):
+        # The admin search: the posts of `queryset` matching the query, found
+        # through the index. The drafts aren't indexed, so they're matched by
+        # title (there are few of them).
+        limit = getattr(settings, 'BLOG_ADMIN_SEARCH_LIMIT', 1000)
+        return queryset.filter(Q(pk__in=self.search_ids(query, limit))
+                               | Q(status='draft', title__icontains=query))
+
+    def index_post(self, post):
+        pass
+
+    def remove_post(self, post_id):
+        pass
+
+    def rebuild(self):
+        # after changes that sent no signals, like the bulk import.
+        pass
+
+
+class RankedResults:
+    # A list of post ids already sorted by rank. Only the slice that is asked
+    # for is loaded, so a page of results costs one query.
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        ids = self.ids[item]
+        posts = Post.published.defer('body', 'body_html').in_bulk(ids)
+        return [posts[pk] for pk in ids if pk in posts]
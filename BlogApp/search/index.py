@@ -0,0 +1,311 @@
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock: the files are still swapped whole, without the lock.
+    fcntl = None
+
+# An inverted index in pure Python: for each word we keep the posts that have it
+# and how many times it shows up in the title and in the body. Posts are ranked
+# with BM25F, which is BM25 with a weight for each field.
+#
+# The index lives in two parts. The base is a file opened with mmap, so loading
+# it doesn't read the postings and every process shares the same pages. Changes
+# made after the file was written go to a small in-memory part, and the posts
+# they replace are marked dead in the base. save() merges both into a new file.
+#
+# File layout (little endian):
+#   b'BLOGIDX1', uint32 meta size, meta JSON
+#   docs:     doc_count  x (uint32 post id, uint32 title length, uint32 body length)
+#   terms:    term_count x (uint32 blob offset, uint32 blob length,
+#                           uint32 postings offset, uint32 postings count)
+#   blob:     the terms in utf-8, sorted, one after the other
+#   postings: (uint32 doc index, uint16 title tf, uint16 body tf) for each term
+
+MAGIC = b'BLOGIDX1'
+DOC = struct.Struct('<III')
+TERM = struct.Struct('<IIII')
+POSTING = struct.Struct('<IHH')
+MAX_TF = 0xFFFF
+
+WORD_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+@contextmanager
+def file_lock(path):
+    # Every process merges into the same file, so they take turns with a lock
+    # on a file next to it (closing it releases the lock, even on a crash).
+    with open(f'{path}.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+class InvertedIndex:
+    def __init__(self, title_weight=2.0, body_weight=1.0, k1=1.2, b=0.75):
+        self.title_weight = title_weight
+        self.body_weight = body_weight
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.RLock()
+        self.meta = {}
+        self._clear_base()
+        # the in-memory part: post id -> (title length, body length, {term: (title tf, body tf)})
+        self.live = {}
+        self.live_postings = {}
+
+    def _clear_base(self):
+        self.file = None
+        self.buffer = None
+        self.doc_count = 0
+        self.term_count = 0
+        self.positions = {}
+        self.dead = set()
+        self.title_total = 0
+        self.body_total = 0
+
+    # --- reading the base file ---
+
+    def open(self, path):
+        with self.lock:
+            self.close()
+            self.file = open(path, 'rb')
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.buffer[:len(MAGIC)] != MAGIC:
+                self.close()
+                raise ValueError(f'{path} is not a search index.')
+            start = len(MAGIC)
+            (meta_size,) = struct.unpack_from('<I', self.buffer, start)
+            start += 4
+            self.meta = json.loads(self.buffer[start:start + meta_size].decode())
+            start += meta_size
+
+            self.doc_count = self.meta['docs']
+            self.term_count = self.meta['terms']
+            self.title_total = self.meta['title_total']
+            self.body_total = self.meta['body_total']
+            self.docs_start = start
+            self.terms_start = self.docs_start + self.doc_count * DOC.size
+            self.blob_start = self.terms_start + self.term_count * TERM.size
+            self.postings_start = self.blob_start + self.meta['blob']
+
+            # post id -> position in the docs table, to mark replaced posts as dead.
+            self.positions = {post_id: position for position, (post_id, _, _)
+                              in enumerate(DOC.iter_unpack(self.buffer[self.docs_start:self.terms_start]))}
+            self.live = {}
+            self.live_postings = {}
+
+    def close(self):
+        with self.lock:
+            if self.buffer is not None:
+                self.buffer.close()
+            if self.file is not None:
+                self.file.close()
+            self._clear_base()
+
+    def _term(self, position):
+        offset, length, postings_offset, count = TERM.unpack_from(
+            self.buffer, self.terms_start + position * TERM.size)
+        start = self.blob_start + offset
+        return self.buffer[start:start + length].decode(), postings_offset, count
+
+    def _find_term(self, term):
+        # the terms are sorted, so it's a binary search straight on the file.
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            found, postings_offset, count = self._term(middle)
+            if found == term:
+                return postings_offset, count
+            if found < term:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _base_postings(self, term):
+        if self.buffer is None:
+            return
+        found = self._find_term(term)
+        if found is None:
+            return
+        postings_offset, count = found
+        start = self.postings_start + postings_offset * POSTING.size
+        for position, title_tf, body_tf in POSTING.iter_unpack(
+                self.buffer[start:start + count * POSTING.size]):
+            if position in self.dead:
+                continue
+            post_id, title_length, body_length = DOC.unpack_from(
+                self.buffer, self.docs_start + position * DOC.size)
+            yield post_id, title_tf, body_tf, title_length, body_length
+
+    def _postings(self, term):
+        yield from self._base_postings(term)
+        for post_id in self.live_postings.get(term, ()):
+            title_length, body_length, terms = self.live[post_id]
+            title_tf, body_tf = terms[term]
+            yield post_id, title_tf, body_tf, title_length, body_length
+
+    # --- changes ---
+
+    def __len__(self):
+        return self.doc_count - len(self.dead) + len(self.live)
+
+    def __contains__(self, post_id):
+        return post_id in self.live or (post_id in self.positions
+                                        and self.positions[post_id] not in self.dead)
+
+    def add(self, post_id, title, body):
+        title_words = tokenize(title)
+        body_words = tokenize(body)
+        title_counts = Counter(title_words)
+        body_counts = Counter(body_words)
+        terms = {term: (min(title_counts[term], MAX_TF), min(body_counts[term], MAX_TF))
+                 for term in title_counts.keys() | body_counts.keys()}
+        with self.lock:
+            self.remove(post_id)
+            self.live[post_id] = (len(title_words), len(body_words), terms)
+            for term in terms:
+                self.live_postings.setdefault(term, set()).add(post_id)
+
+    def remove(self, post_id):
+        with self.lock:
+            if post_id in self.live:
+                _, _, terms = self.live.pop(post_id)
+                for term in terms:
+                    posts = self.live_postings[term]
+                    posts.discard(post_id)
+                    if not posts:
+                        del self.live_postings[term]
+            position = self.positions.get(post_id)
+            if position is not None and position not in self.dead:
+                self.dead.add(position)
+                _, title_length, body_length = DOC.unpack_from(
+                    self.buffer, self.docs_start + position * DOC.size)
+                self.title_total -= title_length
+                self.body_total -= body_length
+
+    # --- ranking ---
+
+    def search(self, query, limit=None):
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self.lock:
+            total = len(self)
+            if not total:
+                return []
+            live_title = sum(title_length for title_length, _, _ in self.live.values())
+            live_body = sum(body_length for _, body_length, _ in self.live.values())
+            average_title = max((self.title_total + live_title) / total, 1)
+            average_body = max((self.body_total + live_body) / total, 1)
+
+            scores = {}
+            matched = Counter()
+            for term in terms:
+                postings = list(self._postings(term))
+                if not postings:
+                    # every word must be there, as PostgreSQL's plainto_tsquery does.
+                    return []
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for post_id, title_tf, body_tf, title_length, body_length in postings:
+                    tf = (self.title_weight * title_tf
+                          / (1 - self.b + self.b * title_length / average_title)
+                          + self.body_weight * body_tf
+                          / (1 - self.b + self.b * body_length / average_body))
+                    scores[post_id] = scores.get(post_id, 0) + idf * tf * (self.k1 + 1) / (self.k1 + tf)
+                    matched[post_id] += 1
+
+        ranked = sorted((post_id for post_id, count in matched.items() if count == len(terms)),
+                        key=lambda post_id: (-scores[post_id], -post_id))
+        return ranked[:limit] if limit is not None else ranked
+
+    # --- writing the file ---
+
+    def documents(self):
+        # every post in the index: (post id, title length, body length, {term: (title tf, body tf)})
+        with self.lock:
+            documents = {}
+            if self.buffer is not None:
+                for position, (post_id, title_length, body_length) in enumerate(
+                        DOC.iter_unpack(self.buffer[self.docs_start:self.terms_start])):
+                    if position not in self.dead:
+                        documents[position] = [post_id, title_length, body_length, {}]
+                for term_position in range(self.term_count):
+                    term, postings_offset, count = self._term(term_position)
+                    start = self.postings_start + postings_offset * POSTING.size
+                    for position, title_tf, body_tf in POSTING.iter_unpack(
+                            self.buffer[start:start + count * POSTING.size]):
+                        if position in documents:
+                            documents[position][3][term] = (title_tf, body_tf)
+            result = [tuple(document) for document in documents.values()]
+            result.extend((post_id, title_length, body_length, terms)
+                          for post_id, (title_length, body_length, terms) in self.live.items())
+            return result
+
+    def save(self, path, meta=None):
+        with self.lock:
+            documents = sorted(self.documents())
+            postings = {}
+            for position, (_, _, _, terms) in enumerate(documents):
+                for term, (title_tf, body_tf) in terms.items():
+                    postings.setdefault(term, []).append((position, title_tf, body_tf))
+
+            blob = bytearray()
+            term_table = bytearray()
+            posting_table = bytearray()
+            posting_count = 0
+            for term in sorted(postings):
+                encoded = term.encode()
+                term_table += TERM.pack(len(blob), len(encoded), posting_count, len(postings[term]))
+                blob += encoded
+                for posting in postings[term]:
+                    posting_table += POSTING.pack(*posting)
+                posting_count += len(postings[term])
+
+            meta = dict(meta or {},
+                        docs=len(documents),
+                        terms=len(postings),
+                        blob=len(blob),
+                        title_total=sum(document[1] for document in documents),
+                        body_total=sum(document[2] for document in documents))
+            encoded_meta = json.dumps(meta).encode()
+
+            # we write a temporary file and swap it, so readers never see half a
+            # file. It's on disk (fsync) before the rename, so a crash leaves
+            # the old index or the new one, and a failed write leaves no trash.
+            directory = os.path.dirname(os.path.abspath(path))
+            with file_lock(path):
+                descriptor, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                try:
+                    with os.fdopen(descriptor, 'wb') as output:
+                        output.write(MAGIC)
+                        output.write(struct.pack('<I', len(encoded_meta)))
+                        output.write(encoded_meta)
+                        for post_id, title_length, body_length, _ in documents:
+                            output.write(DOC.pack(post_id, title_length, body_length))
+                        output.write(term_table)
+                        output.write(blob)
+                        output.write(posting_table)
+                        output.flush()
+                        os.fsync(output.fileno())
+                    os.replace(temporary, path)
+                except BaseException:
+                    if os.path.exists(temporary):
+                        os.remove(temporary)
+                    raise
+            self.open(path)
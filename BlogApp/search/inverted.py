@@ -0,0 +1,117 @@
+import os
+import threading
+
+from django.conf import settings
+from django.db.models import Max
+
+from ..models import Post
+from .base import SearchBackend, RankedResults
+from .index import InvertedIndex
+
+# After this many changes the in-memory part is merged into a new file.
+MERGE_AFTER = 1000
+# The posts missing from the file are read by this many ids at a time, so the
+# query never gets more parameters than the database takes (999 on old SQLite).
+CATCH_UP_CHUNK = 500
+
+
+class InvertedIndexBackend(SearchBackend):
+    # It searches with an index kept by the application itself, so it works on
+    # any database (SQLite, for example). The index file is in
+    # BLOG_SEARCH_INDEX_PATH; when it's missing it's built from the database.
+    def __init__(self):
+        self.path = settings.BLOG_SEARCH_INDEX_PATH
+        weights = getattr(settings, 'BLOG_SEARCH_FIELD_WEIGHTS', {})
+        self.index = InvertedIndex(title_weight=weights.get('title', 2.0),
+                                   body_weight=weights.get('body', 1.0))
+        self.loaded = False
+        self.changes = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            if os.path.exists(self.path):
+                self.index.open(self.path)
+                self.catch_up()
+            else:
+                self.build()
+            self.loaded = True
+
+    def build(self):
+        # It reads every published post again and writes a new file.
+        self.index.close()
+        watermark = self.watermark()
+        for post_id, title, body in Post.published.values_list('pk', 'title', 'body').iterator():
+            self.index.add(post_id, title, body)
+        self.save(watermark)
+
+    def rebuild(self):
+        with self.lock:
+            self.build()
+            self.loaded = True
+
+    def catch_up(self):
+        # Other processes may have changed posts since the file was written.
+        # The posts updated after the file's watermark are indexed again, and
+        # the ones that aren't published anymore are removed.
+        watermark = self.watermark()
+        published = set(Post.published.values_list('pk', flat=True))
+        changes = 0
+        for post_id in list(self.index.positions):
+            if post_id not in published and post_id in self.index:
+                self.index.remove(post_id)
+                changes += 1
+        batches = [Post.published.all()]
+        if self.index.meta.get('watermark'):
+            batches = [Post.published.filter(updated__gte=self.index.meta['watermark'])]
+            missing = sorted(post_id for post_id in published if post_id not in self.index)
+            batches.extend(Post.published.filter(pk__in=missing[start:start + CATCH_UP_CHUNK])
+                           for start in range(0, len(missing), CATCH_UP_CHUNK))
+        for batch in batches:
+            for post_id, title, body in batch.values_list('pk', 'title', 'body').iterator():
+                self.index.add(post_id, title, body)
+                changes += 1
+        if changes:
+            self.save(watermark)
+
+    def watermark(self):
+        # it's read before the posts, so whatever changes meanwhile is caught next time.
+        latest = Post.objects.aggregate(latest=Max('updated'))['latest']
+        return latest.isoformat() if latest else None
+
+    def save(self, watermark):
+        self.index.save(self.path, {'watermark': watermark})
+        self.changes = 0
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= MERGE_AFTER:
+            self.save(self.index.meta.get('watermark'))
+
+    def search(self, query):
+        self.load()
+        return RankedResults(self.index.search(query))
+
+    def search_ids(self, query, limit):
+        self.load()
+        return self.index.search(query, limit)
+
+    def index_post(self, post):
+        if not self.loaded:
+            # it'll be read from the database when the index is loaded.
+            return
+        if post.status == 'published':
+            self.index.add(post.pk, post.title, post.body)
+        else:
+            self.index.remove(post.pk)
+        self.changed()
+
+    def remove_post(self, post_id):
+        if not self.loaded:
+            return
+        self.index.remove(post_id)
+        self.changed()
@@ -0,0 +1,181 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from taggit.models import Tag
+
+from .cache import invalidate_sidebar
+from .counters import comment_saved, comment_deleted
+from .models import Post, Comment, RelatedPost
+from .pagecache import purge_pages
+from .postlookup import post_ids
+from .related import schedule_refresh, refresh_posts
+from .search import get_backend
+from .sitemaps import forget_sitemaps
+from .suggest import suggestions
+
+
+# Post.active_comments follows every comment that is created, deleted,
+# or activated/deactivated (in CommentAdmin, for example).
+@receiver(post_save, sender=Comment)
+def update_counter_on_save(sender, instance, created, **kwargs):
+    comment_saved(instance, created)
+
+
+@receiver(post_delete, sender=Comment)
+def update_counter_on_delete(sender, instance, **kwargs):
+    comment_deleted(instance)
+
+
+# Tags are part of a post's content, but changing them doesn't save the
+# post. So we touch Post.updated, which the HTTP validators are built from.
+@receiver(m2m_changed, sender=Post.tags.through)
+def touch_post_on_tags(sender, instance, action, pk_set, **kwargs):
+    if action == 'post_clear' or (action in ('post_add', 'post_remove') and pk_set):
+        Post.objects.filter(pk=instance.pk).update(updated=timezone.now())
+
+
+# The sidebar shows posts and comment counts, so any change on them
+# throws the cached sidebar away. It's connected after the counters,
+# so the sidebar is never rebuilt with an old counter.
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(m2m_changed, sender=Post.tags.through)
+def sidebar_changed(sender, **kwargs):
+    invalidate_sidebar()
+
+
+# The similar posts lists depend on tags and on which posts are published.
+@receiver(post_save, sender=Post)
+def refresh_related_on_save(sender, instance, created, **kwargs):
+    if created or instance.field_changed('status') or instance.field_changed('publish'):
+        schedule_refresh(instance.pk)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def refresh_related_on_tags(sender, instance, action, pk_set, **kwargs):
+    if action == 'post_clear' or (action in ('post_add', 'post_remove') and pk_set):
+        schedule_refresh(instance.pk)
+
+
+@receiver(pre_delete, sender=Post)
+def remember_related_lists(sender, instance, **kwargs):
+    # its rows go away with the post, so we note whose lists have to be filled again.
+    instance.related_lists = list(RelatedPost.objects.filter(related=instance)
+                                  .values_list('post_id', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def refresh_related_on_delete(sender, instance, **kwargs):
+    related_lists = getattr(instance, 'related_lists', [])
+    if related_lists:
+        transaction.on_commit(lambda: refresh_posts(related_lists))
+    purge_pages(*[f'related:{post_id}' for post_id in related_lists])
+
+
+# The page cache purges only the pages showing what changed (see pagecache.py).
+@receiver(post_save, sender=Post)
+def purge_post_pages(sender, instance, created, **kwargs):
+    tags = [f'post:{instance.pk}']
+    if created or instance.field_changed('status') or instance.field_changed('publish'):
+        # the post may come in, go out or move in the lists.
+        tags.append('post-list')
+        if not created:
+            tags.extend(f'tag:{slug}' for slug in instance.tags.values_list('slug', flat=True))
+    purge_pages(*tags)
+
+
+@receiver(pre_delete, sender=Post)
+def remember_tag_slugs(sender, instance, **kwargs):
+    instance.tag_slugs = list(instance.tags.values_list('slug', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def purge_deleted_post_pages(sender, instance, **kwargs):
+    purge_pages(f'post:{instance.pk}', 'post-list',
+                *[f'tag:{slug}' for slug in getattr(instance, 'tag_slugs', [])])
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def purge_comment_pages(sender, instance, **kwargs):
+    purge_pages(f'comments:{instance.post_id}')
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def purge_tagged_pages(sender, instance, action, pk_set, **kwargs):
+    if action == 'pre_clear':
+        instance.cleared_slugs = list(instance.tags.values_list('slug', flat=True))
+    elif action == 'post_clear':
+        purge_pages(f'post:{instance.pk}',
+                    *[f'tag:{slug}' for slug in getattr(instance, 'cleared_slugs', [])])
+    elif action in ('post_add', 'post_remove') and pk_set:
+        slugs = Tag.objects.filter(pk__in=pk_set).values_list('slug', flat=True)
+        purge_pages(f'post:{instance.pk}', *[f'tag:{slug}' for slug in slugs])
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def purge_renamed_tag_pages(sender, instance, **kwargs):
+    # the lists show the tag names of each post.
+    post_ids = Post.objects.filter(tags__pk=instance.pk).values_list('pk', flat=True)
+    purge_pages(f'tag:{instance.slug}', *[f'post:{post_id}' for post_id in post_ids])
+
+
+# The URL -> id cache of this process forgets a post that changed (the other
+# processes find out on their next lookup, see postlookup.py).
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def forget_post_id(sender, instance, **kwargs):
+    post_ids.forget_post(instance.pk)
+
+
+# The sitemap files kept on disk are written again for the months that changed.
+@receiver(post_save, sender=Post)
+def forget_post_sitemaps(sender, instance, **kwargs):
+    if instance.status == 'published' or instance.loaded_value('status') == 'published':
+        months = [instance.publish, instance.loaded_value('publish')]
+        transaction.on_commit(lambda: forget_sitemaps(*months))
+
+
+@receiver(post_delete, sender=Post)
+def forget_deleted_post_sitemaps(sender, instance, **kwargs):
+    publish = instance.publish
+    transaction.on_commit(lambda: forget_sitemaps(publish))
+
+
+# Search backends with their own index follow every post change.
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, **kwargs):
+    transaction.on_commit(lambda: get_backend().index_post(instance))
+
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    post_id = instance.pk
+    transaction.on_commit(lambda: get_backend().remove_post(post_id))
+
+
+# The search box suggestions follow the posts and the tags (see suggest.py).
+@receiver(post_save, sender=Post)
+def suggest_post(sender, instance, created, **kwargs):
+    transaction.on_commit(lambda: suggestions.index_post(instance))
+    if created or instance.field_changed('status'):
+        # the tag counts count published posts.
+        transaction.on_commit(suggestions.tag_changed)
+
+
+@receiver(post_delete, sender=Post)
+def unsuggest_post(sender, instance, **kwargs):
+    post_id = instance.pk
+    transaction.on_commit(lambda: suggestions.remove_post(post_id))
+    transaction.on_commit(suggestions.tag_changed)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def suggest_tags(sender, **kwargs):
+    transaction.on_commit(suggestions.tag_changed)
@@ -1,14 +1,187 @@
-from django.contrib.sitemaps import Sitemap
+import datetime
+import glob
+import math
+import os
+import tempfile
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.contrib.sites.shortcuts import get_current_site
+from django.db.models import Count, Max
+from django.db.models.functions import TruncMonth
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.urls import reverse
 
 from .models import Post
 
+# A sitemap can't have more than 50,000 URLs, so sitemap.xml is an index of
+# sections, one for each month of posts (split in pages if a month has more).
+# The sections are streamed: the posts are read in chunks, only the columns
+# the URL and lastmod need, and written out as they come, so the memory used
+# is the same for 100 or 10 million posts.
+#
+# With BLOG_SITEMAP_DIR set, each file is also kept on disk while it's sent,
+# and served from there next time. Changing a post removes the files of its
+# month (see signals.py), so they're written again on the next request.
+
+CHUNK_SIZE = 2000
+
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+URLSET_START = '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+URLSET_END = '</urlset>\n'
+INDEX_START = '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+INDEX_END = '</sitemapindex>\n'
+
+# what each post's <url> says.
+CHANGEFREQ = 'weekly'
+PRIORITY = 0.9
+# the most URLs a section has.
+MAX_SECTION_URLS = 50000
+
+
+def section_size():
+    return min(getattr(settings, 'BLOG_SITEMAP_SECTION_SIZE', MAX_SECTION_URLS), MAX_SECTION_URLS)
+
+
+def month_range(year, month):
+    # [first day of the month, first day of the next one), so the index on publish is used.
+    start = datetime.datetime(year, month, 1)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+def section_url(year, month, page=1):
+    if page == 1:
+        return reverse('sitemap_section', args=[year, month])
+    return reverse('sitemap_section_page', args=[year, month, page])
+
+
+def section_name(year, month, page=1):
+    # the file name in BLOG_SITEMAP_DIR.
+    return f'sitemap-posts-{year}-{month:02d}' + (f'-{page}' if page > 1 else '') + '.xml'
+
+
+def sitemap_sections():
+    # every section: (year, month, page, lastmod). It's one GROUP BY query.
+    months = (Post.published
+              .annotate(month=TruncMonth('publish'))
+              .values('month')
+              .annotate(posts=Count('id'), lastmod=Max('updated'))
+              .order_by('month'))
+    size = section_size()
+    for row in months:
+        for page in range(1, math.ceil(row['posts'] / size) + 1):
+            yield row['month'].year, row['month'].month, page, row['lastmod']
+
+
+def section_rows(year, month, page):
+    start, end = month_range(year, month)
+    size = section_size()
+    rows = (Post.published
+            .filter(publish__gte=start, publish__lt=end)
+            .order_by('publish', 'id')
+            .values_list('slug', 'publish', 'updated'))[size * (page - 1):size * page]
+    return rows.iterator(chunk_size=CHUNK_SIZE)
+
+
+def lastmod(value):
+    return f'<lastmod>{value.date().isoformat()}</lastmod>' if value else ''
+
+
+def index_lines(base):
+    yield HEADER + INDEX_START
+    for year, month, page, updated in sitemap_sections():
+        url = base + section_url(year, month, page)
+        yield f'<sitemap><loc>{escape(url)}</loc>{lastmod(updated)}</sitemap>\n'
+    yield INDEX_END
+
+
+def section_lines(base, year, month, page):
+    yield HEADER + URLSET_START
+    lines = []
+    for slug, publish, updated in section_rows(year, month, page):
+        url = Post(slug=slug, publish=publish).get_absolute_url()
+        lines.append(f'<url><loc>{escape(base + url)}</loc>{lastmod(updated)}'
+                     f'<changefreq>{CHANGEFREQ}</changefreq>'
+                     f'<priority>{PRIORITY}</priority></url>\n')
+        if len(lines) >= CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines) + URLSET_END
+
+
+def sitemap_dir():
+    return getattr(settings, 'BLOG_SITEMAP_DIR', None)
+
+
+def kept_on_disk(name, lines):
+    # It sends the lines and writes them to a temporary file, which takes
+    # the place of the real one only when everything was sent.
+    directory = sitemap_dir()
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+            for line in lines:
+                file.write(line)
+                yield line
+        os.replace(temporary, os.path.join(directory, name))
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def serve(request, name, lines):
+    directory = sitemap_dir()
+    if directory:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            return FileResponse(open(path, 'rb'), content_type='application/xml')
+        lines = kept_on_disk(name, lines)
+    return StreamingHttpResponse(lines, content_type='application/xml')
+
+
+def base_url(request):
+    return f'{request.scheme}://{get_current_site(request).domain}'
+
+
+def write_sitemaps(base):
+    # It writes every file to BLOG_SITEMAP_DIR and gives back how many.
+    files = 0
+    for year, month, page, _ in sitemap_sections():
+        for _ in kept_on_disk(section_name(year, month, page), section_lines(base, year, month, page)):
+            pass
+        files += 1
+    for _ in kept_on_disk('sitemap.xml', index_lines(base)):
+        pass
+    return files + 1
+
+
+def sitemap_index(request):
+    return serve(request, 'sitemap.xml', index_lines(base_url(request)))
+
 
-class PostSitemap(Sitemap):
-    changefreq = 'weekly'
-    priority = 0.9
+def sitemap_section(request, year, month, page=1):
+    if not 1 <= month <= 12 or page < 1:
+        raise Http404
+    # the first line goes out before we know if there are posts, so we check first.
+    start, end = month_range(year, month)
+    if not Post.published.filter(publish__gte=start, publish__lt=end)[section_size() * (page - 1):].exists():
+        raise Http404
+    return serve(request, section_name(year, month, page), section_lines(base_url(request), year, month, page))
 
-    def items(self):
-        return Post.published.all()
 
-    def lastmod(self, obj):
-        return obj.updated
+def forget_sitemaps(*dates):
+    # It removes the files of those months (and the index) from BLOG_SITEMAP_DIR.
+    directory = sitemap_dir()
+    if not directory:
+        return
+    names = [os.path.join(directory, 'sitemap.xml')]
+    for date in dates:
+        if date is not None:
+            names.extend(glob.glob(os.path.join(directory, f'sitemap-posts-{date.year}-{date.month:02d}*.xml')))
+    for name in names:
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
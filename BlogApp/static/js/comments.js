@@ -0,0 +1,59 @@
+// The comments of a post come a page at a time: "More comments" asks
+// post_comments for the next page and adds it below the others, and the
+// comment form posts there too, so the page is never loaded again.
+(function () {
+    var list = document.getElementById('comments');
+    var more = document.getElementById('more-comments');
+    var form = document.getElementById('comment-form');
+
+    if (more) {
+        more.addEventListener('click', function (event) {
+            event.preventDefault();
+            fetch(more.dataset.url)
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    list.insertAdjacentHTML('beforeend', data.html);
+                    if (data.next) {
+                        more.dataset.url = data.next;
+                    } else {
+                        more.remove();
+                        more = null;
+                    }
+                });
+        });
+    }
+
+    if (form) {
+        form.addEventListener('submit', function (event) {
+            event.preventDefault();
+            // the form has its csrfmiddlewaretoken field, so the POST passes the CSRF check.
+            fetch(form.dataset.url, {method: 'POST', body: new FormData(form)})
+                .then(function (response) {
+                    return response.json().then(function (data) { return {ok: response.ok, data: data}; });
+                })
+                .then(function (result) {
+                    var errors = document.getElementById('comment-errors');
+                    if (!result.ok) {
+                        errors.textContent = Object.keys(result.data.errors).map(function (field) {
+                            return field + ': ' + result.data.errors[field].join(' ');
+                        }).join(' ');
+                        return;
+                    }
+                    errors.textContent = '';
+                    // the new comment is the last one, so it's only shown when
+                    // the last page of comments is already on the page.
+                    if (!more) {
+                        list.insertAdjacentHTML('beforeend', result.data.html);
+                    }
+                    var total = result.data.total;
+                    document.getElementById('comments-title').textContent =
+                        total + ' comment' + (total === 1 ? '' : 's');
+                    var empty = document.getElementById('no-comments');
+                    if (empty) {
+                        empty.remove();
+                    }
+                    form.reset();
+                });
+        });
+    }
+})();
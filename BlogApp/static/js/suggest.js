@@ -0,0 +1,42 @@
+// As the visitor types in the search box, post_suggest is asked for titles
+// and tags starting with those letters, and they're offered in a <datalist>.
+// Picking a suggestion searches for it, like typing it whole.
+(function () {
+    var form = document.getElementById('search-form');
+    if (!form) {
+        return;
+    }
+    var input = form.querySelector('input[name="query"]');
+    var list = document.getElementById('suggestions');
+    var timer = null;
+    var asked = '';
+
+    input.setAttribute('list', 'suggestions');
+    input.setAttribute('autocomplete', 'off');
+
+    input.addEventListener('input', function () {
+        // one request once the typing pauses, not one for each key.
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            var query = input.value.trim();
+            if (!query || query === asked) {
+                return;
+            }
+            asked = query;
+            fetch(form.dataset.suggestUrl + '?q=' + encodeURIComponent(query))
+                .then(function (response) { return response.json(); })
+                .then(function (data) {
+                    // an older answer arriving late is thrown away.
+                    if (query !== asked) {
+                        return;
+                    }
+                    list.innerHTML = '';
+                    data.posts.concat(data.tags).forEach(function (suggestion) {
+                        var option = document.createElement('option');
+                        option.value = suggestion.title || suggestion.name;
+                        list.appendChild(option);
+                    });
+                });
+        }, 100);
+    });
+})();
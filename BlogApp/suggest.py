@@ -0,0 +1,299 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from array import array
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count
+from django.urls import get_script_prefix, reverse
+
+from .models import Post
+from .popularity import add_scores, view_score
+from .related import post_tagged_items
+
+# Suggestions for the search box, as the visitor types: the posts whose title
+# has a word starting with what was typed, and the tags too, the best first.
+#
+# Everything is in the memory of each process, in a PrefixIndex: every title
+# is kept once for each of its words ("Django tips" as "django tips" and
+# "tips"), sorted, so the keys starting with a prefix are one range found by
+# bisect. A segment tree over the range gives its best entry in O(log n), so
+# the top k come out without looking at the whole range (a one-letter prefix
+# matches thousands of titles).
+#
+# A post weighs its popularity (see popularity.py) plus one view at the time
+# it was published, so new posts come first until the older ones get read
+# (both are log2 scores, added with add_scores). A tag weighs how many
+# published posts it has.
+#
+# Like the inverted index of the search, changes go to a small part on the
+# side (the signals call index_post and remove_post), which is merged into a
+# new PrefixIndex after MERGE_AFTER changes. The other processes and the new
+# view counts are read again every BLOG_SUGGEST_REFRESH_SECONDS, in a thread,
+# while the old index keeps answering.
+
+MERGE_AFTER = 1000
+# keys are cut here: nobody types 40 letters waiting for a suggestion.
+KEY_LENGTH = 40
+
+WORD_RE = re.compile(r'\w+')
+
+
+# reverse() takes about 50 µs, more than a whole suggestion, so the URLs are
+# filled in patterns made by reverse() once (for each script prefix).
+url_patterns = {}
+
+
+def url_of(name, *args):
+    markers = (1111, 22, 33, 'suggested')[:len(args)]
+    key = (get_script_prefix(), name, len(args))
+    pattern = url_patterns.get(key)
+    if pattern is None:
+        pattern = url_patterns[key] = reverse(name, args=markers).split('/'.join(map(str, markers)), 1)
+    return '/'.join(map(str, args)).join(pattern)
+
+
+def normalize(text):
+    # lower case, without accents, only words and single spaces.
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(WORD_RE.findall(text.lower()))
+
+
+def word_keys(text):
+    words = normalize(text).split(' ')
+    return {' '.join(words[start:])[:KEY_LENGTH] for start in range(len(words)) if words[start]}
+
+
+class PrefixIndex:
+    # A sorted array of (key, item id) with a weight for each entry. It never
+    # changes once built.
+    def __init__(self, entries):
+        # entries: (key, item id, weight)
+        entries = sorted(entries)
+        self.keys = [key for key, _, _ in entries]
+        self.items = array('q', [item for _, item, _ in entries])
+        self.weights = array('d', [weight for _, _, weight in entries])
+        # tree[size + i] is entry i, tree[node] the best entry under node.
+        self.size = len(entries)
+        tree, weights = array('l', [0] * self.size + list(range(self.size))), self.weights
+        for node in range(self.size - 1, 0, -1):
+            left, right = tree[2 * node], tree[2 * node + 1]
+            tree[node] = left if weights[left] >= weights[right] else right
+        self.tree = tree
+
+    def __len__(self):
+        return self.size
+
+    def best(self, low, high):
+        # the entry with the biggest weight in [low, high), climbing the tree
+        # from both ends.
+        tree, weights = self.tree, self.weights
+        found, found_weight = -1, float('-inf')
+        low += self.size
+        high += self.size
+        while low < high:
+            if low & 1:
+                entry = tree[low]
+                if weights[entry] > found_weight:
+                    found, found_weight = entry, weights[entry]
+                low += 1
+            if high & 1:
+                high -= 1
+                entry = tree[high]
+                if weights[entry] > found_weight:
+                    found, found_weight = entry, weights[entry]
+            low //= 2
+            high //= 2
+        return found
+
+    def top(self, prefix, limit, skip=()):
+        # [(weight, item id)] of the best items with a key starting with
+        # prefix, each item once, leaving out the ones in skip.
+        low = bisect.bisect_left(self.keys, prefix)
+        high = bisect.bisect_left(self.keys, prefix + '\U0010ffff')
+        candidates = []
+
+        def push(low, high):
+            if low < high:
+                entry = self.best(low, high)
+                heapq.heappush(candidates, (-self.weights[entry], entry, low, high))
+
+        push(low, high)
+        found, seen = [], set()
+        while candidates and len(found) < limit:
+            weight, entry, low, high = heapq.heappop(candidates)
+            item = self.items[entry]
+            if item not in seen and item not in skip:
+                seen.add(item)
+                found.append((-weight, item))
+            push(low, entry)
+            push(entry + 1, high)
+        return found
+
+
+class Suggestions:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.loaded = False
+        self.loaded_at = 0
+        self.refreshing = False
+        # post id -> (title, slug, publish, weight)
+        self.posts = {}
+        self.index = PrefixIndex([])
+        # changed since the index was built: post id -> keys, and the posts
+        # whose entries in the index are old.
+        self.fresh = {}
+        self.stale = set()
+        # tag index -> (slug, name, posts), and a PrefixIndex over the names.
+        self.tags = []
+        self.tag_index = PrefixIndex([])
+        self.tags_changed = False
+
+    # --- loading ---
+
+    def load(self):
+        if self.loaded:
+            self.refresh_if_old()
+            return
+        # the tags are read once, before the lock, and they're fresh: the
+        # changes signalled before now are in them.
+        self.tags_changed = False
+        tags = list(self.read_tags())
+        with self.lock:
+            if not self.loaded:
+                self.load_rows(self.read_posts(), tags)
+
+    def read_posts(self):
+        return Post.published.values_list('pk', 'title', 'slug', 'publish', 'popularity').iterator()
+
+    def read_tags(self):
+        return (post_tagged_items()
+                .filter(object_id__in=Post.published.values('pk'))
+                .values_list('tag__slug', 'tag__name')
+                .annotate(posts=Count('id'))
+                .order_by())
+
+    def load_rows(self, posts, tags):
+        # posts: (id, title, slug, publish, popularity); tags: (slug, name, posts).
+        self.posts = {pk: (title, slug, publish, add_scores(popularity, view_score(publish.timestamp())))
+                      for pk, title, slug, publish, popularity in posts}
+        self.index = PrefixIndex([(key, pk, post[3])
+                                  for pk, post in self.posts.items() for key in word_keys(post[0])])
+        self.fresh, self.stale = {}, set()
+        self.load_tags(tags)
+        self.loaded, self.loaded_at = True, time.monotonic()
+
+    def load_tags(self, tags):
+        self.tags = list(tags)
+        self.tag_index = PrefixIndex([(key, number, posts) for number, (_, name, posts) in enumerate(self.tags)
+                                      for key in word_keys(name)])
+
+    def refresh_if_old(self):
+        seconds = getattr(settings, 'BLOG_SUGGEST_REFRESH_SECONDS', 300)
+        if not seconds or self.refreshing or time.monotonic() - self.loaded_at < seconds:
+            return
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.refresh, name='suggest-refresh', daemon=True).start()
+
+    def refresh(self):
+        # the new index is built aside, and swapped in once it's complete.
+        try:
+            fresh = Suggestions()
+            fresh.load_rows(fresh.read_posts(), fresh.read_tags())
+            with self.lock:
+                # a tag change signalled meanwhile is still read next time.
+                self.__dict__.update({name: value for name, value in fresh.__dict__.items()
+                                      if name not in ('lock', 'tags_changed')})
+        finally:
+            self.refreshing = False
+            # this thread isn't a request, so it closes its connection itself.
+            close_old_connections()
+
+    # --- changes (signals.py) ---
+
+    def index_post(self, post):
+        if not self.loaded:
+            # it'll be read from the database when the index is loaded.
+            return
+        with self.lock:
+            self.stale.add(post.pk)
+            self.fresh.pop(post.pk, None)
+            self.posts.pop(post.pk, None)
+            if post.status == 'published':
+                weight = add_scores(post.popularity, view_score(post.publish.timestamp()))
+                self.posts[post.pk] = (post.title, post.slug, post.publish, weight)
+                self.fresh[post.pk] = word_keys(post.title)
+            self.changed()
+
+    def remove_post(self, post_id):
+        if not self.loaded:
+            return
+        with self.lock:
+            self.stale.add(post_id)
+            self.fresh.pop(post_id, None)
+            self.posts.pop(post_id, None)
+            self.changed()
+
+    def tag_changed(self):
+        # there are few tags, they're read again on the next suggestion.
+        self.tags_changed = True
+
+    def changed(self):
+        if len(self.stale) >= MERGE_AFTER:
+            self.index = PrefixIndex([(key, pk, post[3])
+                                      for pk, post in self.posts.items() for key in word_keys(post[0])])
+            self.fresh, self.stale = {}, set()
+
+    # --- answers ---
+
+    def suggest(self, query, limit=None):
+        limit = limit or getattr(settings, 'BLOG_SUGGEST_LIMIT', 8)
+        prefix = normalize(query)
+        if not prefix:
+            return {'posts': [], 'tags': []}
+        self.load()
+        if self.tags_changed:
+            # the query runs before taking the lock, so the other requests
+            # keep answering meanwhile. The flag goes down first: a change
+            # made while we read is read again next time.
+            self.tags_changed = False
+            tags = list(self.read_tags())
+            with self.lock:
+                self.load_tags(tags)
+
+        with self.lock:
+            index, posts, fresh, stale = self.index, self.posts, self.fresh, self.stale
+            found = index.top(prefix, limit, skip=stale)
+            found.extend((posts[pk][3], pk) for pk, keys in fresh.items()
+                         if any(key.startswith(prefix) for key in keys))
+            # the posts are taken while the lock is held: index_post may take
+            # them out of self.posts right after.
+            chosen = [posts[pk] for _, pk in heapq.nlargest(limit, found)]
+            tags = [self.tags[number] for _, number in self.tag_index.top(prefix, limit)]
+
+        return {'posts': [self.post_json(post) for post in chosen],
+                'tags': [{'name': name,
+                          'url': url_of('BlogApp:post_list_by_tag', slug),
+                          'posts': count}
+                         for slug, name, count in tags]}
+
+    @staticmethod
+    def post_json(post):
+        title, slug, publish, _ = post
+        # what Post.get_absolute_url() gives.
+        return {'title': title,
+                'url': url_of('BlogApp:post_detail', publish.year, publish.month, publish.day, slug)}
+
+
+suggestions = Suggestions()
@@ -1,31 +1,49 @@
 from django import template
-from django.db.models import Count
 from django.utils.safestring import mark_safe
-import markdown
 
+from ..cache import cached_sidebar
 from ..models import Post
+from ..rendering import render_markdown
 
 register = template.Library()
 
 
+# These tags run on every page, so their results are cached and thrown away
+# by the signals in signals.py whenever a post or a comment changes.
 @register.simple_tag
 def total_posts():
-    return Post.published.count()
+    return cached_sidebar('total_posts', Post.published.count)
 
 
 @register.inclusion_tag('BlogApp/post/latest_post.html')
 def show_latest_posts(count=5):
-    latest_posts = Post.published.order_by('-publish')[:count]
-    return {'latest_posts': latest_posts}
+    def latest_posts():
+        return list(Post.published.only('id', 'title', 'slug', 'publish')
+                    .order_by('-publish')[:count])
+    return {'latest_posts': cached_sidebar('latest_posts', latest_posts, count)}
 
 
 @register.simple_tag
 def get_most_commented_posts(count=5):
-    return Post.published.annotate(
-        total_comments=Count('comments')
-    ).order_by('-total_comments')[:count]
+    def most_commented_posts():
+        return list(Post.published.only('id', 'title', 'slug', 'publish')
+                    .order_by('-active_comments')[:count])
+    return cached_sidebar('most_commented_posts', most_commented_posts, count)
 
 
+@register.simple_tag
+def get_popular_posts(count=5):
+    # Post.popularity already decays (see popularity.py), so it's one ORDER BY
+    # on an index. The scores change with the flushes of the views, not with
+    # signals: the flush throws the sidebar away when this list changes.
+    def popular_posts():
+        return list(Post.published.only('id', 'title', 'slug', 'publish')
+                    .order_by('-popularity')[:count])
+    return cached_sidebar('popular_posts', popular_posts, count)
+
+
+# Posts keep their rendered HTML in body_html and excerpt_html, so this filter
+# is only a fallback for posts that weren't rendered yet.
 @register.filter(name='markdown')
 def markdown_format(text):
-    return mark_safe(markdown.markdown(text))
+    return mark_safe(render_markdown(text))
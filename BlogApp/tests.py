@@ -1,3 +1,1424 @@
-from django.test import TestCase
+import asyncio
+import base64
+import datetime
+import io
+import json
+import math
+import os
+import random
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connections
+from django.http import Http404
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from . import asyncviews, mailqueue, urls, views
+from .benchmark import compare, generate, routes
+from .bulk import BlogImporter
+from .cache import SIDEBAR_VERSION_KEY, get_or_compute
+from .export import Exporter, export_units
+from .internal import internal_headers
+from .mailqueue import MailWorker, MailWorkerPool, claim_batch, enqueue_mail
+from .metrics import exposition, reset_metrics
+from .models import Post, Comment, OutboundEmail, RelatedPost
+from .pagination import EstimatedCountPaginator, KeysetPaginator
+from .pagecache import CSRF_RE, check_page_cache, page_cache_stats
+from .popularity import ViewBuffer, view_score, views_buffer
+from .postlookup import PostIdCache, post_ids
+from .querybudget import count_queries
+from .related import refresh_around
+from .routers import PIN_COOKIE, health
+from .search.index import InvertedIndex
+from .search.inverted import InvertedIndexBackend
+from .suggest import PrefixIndex, suggestions
+from .templatetags import blog_tags
+
+
+# Every route of BlogApp/urls.py runs under the strict query budget, so a
+# view going over its @query_budget fails here. The cache is cleared first,
+# so the budgets include the sidebar queries of a cold cache.
+@override_settings(BLOG_QUERY_BUDGET_STRICT=True,
+                   BLOG_SEARCH_BACKEND='BlogApp.search.inverted.InvertedIndexBackend')
+class QueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        cls.posts = []
+        for number in range(12):
+            post = Post.objects.create(title=f'Post {number}',
+                                       slug=f'post-{number}',
+                                       author=author,
+                                       body=f'Body of the **post** number {number}.',
+                                       status='published')
+            post.tags.add('django', f'tag-{number % 3}')
+            for comment in range(number % 4):
+                Comment.objects.create(post=post, name='reader',
+                                       email='reader@example.com', body='Nice!')
+            cls.posts.append(post)
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        settings_override = override_settings(BLOG_SEARCH_INDEX_PATH=f'{self.index_dir}/search.idx')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        cache.clear()
+
+    def test_post_list(self):
+        response = self.client.get(reverse('BlogApp:post_list'))
+        self.assertEqual(response.status_code, 200)
+        next_page = self.client.get(reverse('BlogApp:post_list'),
+                                    {'cursor': response.context['posts'].next_cursor})
+        self.assertEqual(next_page.status_code, 200)
+
+    def test_post_list_never_loads_the_body(self):
+        # a post without its excerpt costs no extra query (the body is deferred).
+        self.client.get(reverse('BlogApp:post_list'))
+        cache.clear()
+        with count_queries() as rendered:
+            self.client.get(reverse('BlogApp:post_list'))
+        Post.objects.update(excerpt_html='')
+        cache.clear()
+        with count_queries() as blank:
+            self.client.get(reverse('BlogApp:post_list'))
+        self.assertEqual(blank.count, rendered.count)
+
+    def test_post_list_by_tag(self):
+        response = self.client.get(reverse('BlogApp:post_list_by_tag', args=['django']))
+        self.assertEqual(response.status_code, 200)
+
+    def test_post_detail(self):
+        response = self.client.get(self.posts[5].get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+    def test_post_detail_comment(self):
+        response = self.client.post(self.posts[5].get_absolute_url(),
+                                    {'name': 'reader', 'email': 'reader@example.com', 'body': 'Hi'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['post'].active_comments, 2)
+
+    def test_post_share(self):
+        url = reverse('BlogApp:post_share', args=[self.posts[0].id])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        response = self.client.post(url, {'name': 'reader', 'email': 'reader@example.com',
+                                          'to': 'friend@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['sent'])
+        # the view only writes the outbox.
+        self.assertEqual(OutboundEmail.objects.filter(status='queued').count(), 1)
+
+    def test_post_feed(self):
+        response = self.client.get(reverse('BlogApp:post_feed'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_post_feed_by_tag(self):
+        for name in ('BlogApp:post_feed_by_tag', 'BlogApp:post_feed_by_tag_atom'):
+            response = self.client.get(reverse(name, args=['tag-1']))
+            self.assertEqual(response.status_code, 200)
+
+    def test_post_search(self):
+        # the index is built from the database once, outside the request.
+        from .search import get_backend
+        get_backend().search('post')
+        response = self.client.get(reverse('BlogApp:post_search'), {'query': 'post'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['results'])
+        # the stored excerpt is HTML, not escaped text.
+        self.assertContains(response, '<strong>post</strong>')
+        self.assertNotContains(response, '&lt;strong&gt;')
+
+    def test_warm_sidebar_costs_nothing(self):
+        blog_tags.total_posts()
+        blog_tags.show_latest_posts(3)
+        blog_tags.get_most_commented_posts()
+        with count_queries() as counter:
+            blog_tags.total_posts()
+            blog_tags.show_latest_posts(3)
+            list(blog_tags.get_most_commented_posts())
+        self.assertEqual(counter.count, 0)
+
+
+# A local stand-in for the mail server: it speaks just enough SMTP to take
+# messages, and counts connections and messages.
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b'220 localhost\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith('DATA'):
+                self.wfile.write(b'354 Go ahead\r\n')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                self.server.messages.append(b''.join(data))
+                self.wfile.write(b'250 OK\r\n')
+            elif command.startswith('QUIT'):
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.connections = 0
+        self.messages = []
+
+
+class MailQueueTests(TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings_override = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server.server_address[1],
+            EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False, EMAIL_USE_SSL=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_batch_uses_one_connection(self):
+        for number in range(3):
+            enqueue_mail(f'Subject {number}', 'Body', 'blog@example.com', ['friend@example.com'])
+        self.assertEqual(MailWorker().drain(), 3)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(OutboundEmail.objects.filter(status='sent').count(), 3)
+
+    def test_a_stale_claim_takes_nothing(self):
+        sent = enqueue_mail('Sent', 'Body', 'blog@example.com', ['friend@example.com'])
+        waiting = enqueue_mail('Waiting', 'Body', 'blog@example.com', ['friend@example.com'])
+        MailWorker().drain()
+        OutboundEmail.objects.filter(pk=waiting.pk).update(
+            status='queued', next_attempt=datetime.datetime.now() + datetime.timedelta(hours=1))
+        # another worker read their ids before they were sent (or put back to wait).
+        calls = []
+
+        def stale_list(values):
+            calls.append(values)
+            return [sent.pk, waiting.pk] if len(calls) == 1 else list(values)
+
+        with mock.patch('BlogApp.mailqueue.list', side_effect=stale_list, create=True):
+            self.assertEqual(claim_batch(10), [])
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_unavailable_server_retries_later(self):
+        self.server.shutdown()
+        self.server.server_close()
+        email = enqueue_mail('Subject', 'Body', 'blog@example.com', ['friend@example.com'])
+        self.assertEqual(MailWorker().run_once(), 1)
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'queued')
+        self.assertEqual(email.attempts, 1)
+        self.assertTrue(email.last_error)
+        # it isn't due yet, so nobody takes it again now.
+        self.assertEqual(MailWorker().run_once(), 0)
+
+    def test_only_the_web_server_starts_the_workers(self):
+        with mock.patch.object(mailqueue, '_pool', None), \
+                mock.patch.object(MailWorkerPool, 'start') as start:
+            self.client.get(reverse('BlogApp:post_list'))
+            start.assert_not_called()
+            # after a restart, nothing calls enqueue_mail, but the outbox isn't empty.
+            mailqueue.start_workers()
+            start.assert_called_once_with()
+            mailqueue._pool = None
+            with override_settings(BLOG_MAIL_WORKERS=0):
+                mailqueue.start_workers()
+            start.assert_called_once_with()
+
+
+# It's a TransactionTestCase because the purges wait for the transaction to commit.
+@override_settings(BLOG_QUERY_BUDGET_STRICT=True)
+class PageCacheTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        # the flush deletes the posts of other tests without signals, so
+        # their ids would still be remembered for these URLs.
+        post_ids.clear()
+        author = User.objects.create_user('author')
+        self.post = Post.objects.create(title='Cached', slug='cached', author=author,
+                                        body='Cached body.', status='published')
+        self.other = Post.objects.create(title='Other', slug='other', author=author,
+                                         body='Other body.', status='published')
+
+    def get(self, url, **extra):
+        response = self.client.get(url, **extra)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_second_get_is_a_hit(self):
+        self.assertEqual(self.get(self.post.get_absolute_url())['X-Page-Cache'], 'miss')
+        with count_queries() as counter:
+            response = self.get(self.post.get_absolute_url())
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(page_cache_stats()['hits'], 1)
+
+    def test_saving_a_post_purges_only_its_pages(self):
+        self.get(self.post.get_absolute_url())
+        self.get(self.other.get_absolute_url())
+        self.post.body = 'Changed body.'
+        self.post.save()
+        response = self.get(self.post.get_absolute_url())
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertContains(response, 'Changed body.')
+        self.assertEqual(self.get(self.other.get_absolute_url())['X-Page-Cache'], 'hit')
+
+    def test_comment_purges_the_post(self):
+        self.get(self.post.get_absolute_url())
+        Comment.objects.create(post=self.post, name='reader',
+                               email='reader@example.com', body='A new comment')
+        self.assertContains(self.get(self.post.get_absolute_url()), 'A new comment')
+
+    def test_tag_list_follows_tags(self):
+        url = reverse('BlogApp:post_list_by_tag', args=['django'])
+        self.post.tags.add('django')
+        self.assertEqual(list(self.get(url).context['posts']), [self.post])
+        self.other.tags.add('django')
+        self.assertEqual(list(self.get(url).context['posts']), [self.other, self.post])
+
+    def test_csrf_token_is_personal(self):
+        self.get(self.post.get_absolute_url())
+        response = self.get(self.post.get_absolute_url())
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        self.assertNotContains(response, '__blog_csrf_token__')
+        self.assertIn('csrftoken', response.cookies)
+        # and the form posted with it works.
+        client = self.client_class(enforce_csrf_checks=True)
+        token = client.get(self.post.get_absolute_url()).cookies['csrftoken'].value
+        response = client.post(self.post.get_absolute_url(),
+                               {'name': 'reader', 'email': 'reader@example.com',
+                                'body': 'Hi', 'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Page-Cache'], 'bypass')
+
+    def test_feeds_follow_their_scope(self):
+        self.post.tags.add('django')
+        url = reverse('BlogApp:post_feed_by_tag_atom', args=['django'])
+        response = self.get(url)
+        self.assertEqual(response['Content-Type'], 'application/atom+xml; charset=utf-8')
+        self.assertContains(response, 'Cached')
+        self.assertNotContains(response, 'Other')
+        # a post outside the tag doesn't purge it, and a poll costs no query.
+        self.other.body = 'Changed.'
+        self.other.save()
+        with count_queries() as counter:
+            self.assertEqual(self.get(url)['X-Page-Cache'], 'hit')
+        self.assertEqual(counter.count, 0)
+        # unpublishing a post of the tag does.
+        self.post.status = 'draft'
+        self.post.save()
+        response = self.get(url)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        self.assertNotContains(response, 'Cached')
+
+    def test_session_bypasses_the_cache(self):
+        self.get(self.post.get_absolute_url())
+        self.client.cookies['sessionid'] = 'someone'
+        self.assertEqual(self.get(self.post.get_absolute_url())['X-Page-Cache'], 'bypass')
+
+    def test_warns_about_a_cache_per_process(self):
+        with override_settings(DEBUG=False):
+            self.assertEqual([warning.id for warning in check_page_cache(None)], ['BlogApp.W001'])
+            with override_settings(BLOG_PAGE_CACHE_TIMEOUT=0):
+                self.assertEqual(check_page_cache(None), [])
+        with override_settings(DEBUG=True):
+            self.assertEqual(check_page_cache(None), [])
+
+
+# The validators alone, without the page cache in front of them.
+@override_settings(BLOG_PAGE_CACHE_TIMEOUT=0)
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        cls.post = Post.objects.create(title='Validated', slug='validated', author=author,
+                                       body='Body.', status='published',
+                                       publish=datetime.datetime(2020, 2, 3, 10, 0))
+        cls.post.tags.add('django')
+        Post.objects.create(title='Other', slug='other', author=author, body='Body.',
+                            status='published', publish=datetime.datetime(2020, 2, 4, 10, 0))
+
+    def setUp(self):
+        cache.clear()
+
+    def urls(self):
+        return {'detail': self.post.get_absolute_url(),
+                'list': reverse('BlogApp:post_list'),
+                'tag list': reverse('BlogApp:post_list_by_tag', args=['django']),
+                'feed': reverse('BlogApp:post_feed'),
+                'tag feed': reverse('BlogApp:post_feed_by_tag', args=['django']),
+                'sitemap': reverse('sitemap'),
+                'sitemap section': reverse('sitemap_section', args=[2020, 2])}
+
+    def etags(self):
+        etags = {}
+        for name, url in self.urls().items():
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, name)
+            etags[name] = response['ETag']
+        return etags
+
+    def test_unchanged_pages_answer_304(self):
+        for name, etag in self.etags().items():
+            response = self.client.get(self.urls()[name], HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, name)
+            self.assertEqual(response.content, b'', name)
+
+    def test_editing_a_post_changes_every_etag(self):
+        before = self.etags()
+        self.post.body = 'Edited body.'
+        self.post.save()
+        after = self.etags()
+        for name, etag in before.items():
+            self.assertNotEqual(after[name], etag, name)
+            self.assertEqual(self.client.get(self.urls()[name], HTTP_IF_NONE_MATCH=etag).status_code, 200, name)
+
+    def test_a_comment_changes_the_detail_etag(self):
+        url = self.post.get_absolute_url()
+        etag = self.client.get(url)['ETag']
+        comment = Comment.objects.create(post=self.post, name='reader', email='reader@example.com', body='Hi')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Hi')
+        # hiding it changes it again.
+        etag = response['ETag']
+        comment.active = False
+        comment.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        for number in range(5):
+            post = Post.objects.create(title=f'Post {number}', slug=f'post-{number}', author=author,
+                                       body='Body.', status='published')
+            post.tags.add('django')
+
+    def setUp(self):
+        cache.clear()
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output)
+        self.exporter = Exporter(self.output, 'testserver')
+
+    def test_list_pages_link_to_files(self):
+        result = self.exporter.export('list', reverse('BlogApp:post_list'))
+        # 5 posts, 2 on each page.
+        self.assertEqual(len(result['files']), 3)
+        with open(os.path.join(self.output, result['files'][1])) as file:
+            page = file.read()
+        self.assertNotIn('href="?', page)
+        self.assertIn('href="./"', page)
+        self.assertIn(f'href="{os.path.basename(result["files"][2])}"', page)
+
+    def test_unchanged_pages_are_skipped(self):
+        units = export_units()
+        # the list, the feeds, the sitemap index, one tag (list and feeds),
+        # one sitemap month and the posts.
+        self.assertEqual(len(units), 4 + 3 + 1 + 5)
+        kind, url = units[-1]
+        first = self.exporter.export(kind, url)
+        self.assertEqual(first['status'], 'written')
+        self.assertEqual(self.exporter.export(kind, url, first['etag'])['status'], 'unchanged')
+
+    def test_an_export_is_not_a_visit(self):
+        reset_metrics()
+        views_buffer.flush()
+        url = Post.objects.get(slug='post-0').get_absolute_url()
+        self.assertEqual(self.exporter.export('page', url)['status'], 'written')
+        self.assertEqual(views_buffer.flush(), 0)
+        self.assertNotIn('BlogApp:post_detail', exposition())
+
+
+class SitemapTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        for number in range(5):
+            Post.objects.create(title=f'Post {number}', slug=f'post-{number}', author=author,
+                                body='Body.', status='published', publish=datetime.datetime(2020, 1, 10))
+        Post.objects.create(title='Draft', slug='draft', author=author, body='Body.',
+                            publish=datetime.datetime(2020, 1, 10))
+        Post.objects.create(title='March', slug='march', author=author, body='Body.',
+                            status='published', publish=datetime.datetime(2020, 3, 1))
+
+    def read(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    @override_settings(BLOG_SITEMAP_SECTION_SIZE=3)
+    def test_index_splits_months_in_sections(self):
+        index = self.read(reverse('sitemap'))
+        self.assertEqual(index.count('<sitemap>'), 3)
+        first = self.read(reverse('sitemap_section', args=[2020, 1]))
+        second = self.read(reverse('sitemap_section_page', args=[2020, 1, 2]))
+        self.assertEqual(first.count('<url>'), 3)
+        self.assertEqual(second.count('<url>'), 2)
+        self.assertNotIn('draft', first + second)
+        self.assertEqual(self.client.get(reverse('sitemap_section_page', args=[2020, 1, 3])).status_code, 404)
+
+
+class ImportExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        for number in range(5):
+            post = Post.objects.create(title=f'Post {number}', slug=f'post-{number}', author=author,
+                                       body=f'Body **{number}**.', status='published',
+                                       publish=datetime.datetime(2020, 1, number + 1))
+            post.tags.add('django', f'tag-{number % 2}')
+            for comment in range(number):
+                Comment.objects.create(post=post, name='reader', email='reader@example.com',
+                                       body='Nice!', active=comment % 2 == 0)
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'blog.ndjson')
+
+    def snapshot(self):
+        return ([(post.pk, post.title, post.author.username, post.publish, post.created, post.updated,
+                  post.body_html, post.active_comments, sorted(post.tags.names()))
+                 for post in Post.objects.order_by('pk')],
+                list(Comment.objects.order_by('pk').values_list('pk', 'post', 'active', 'created')))
+
+    def test_round_trip(self):
+        before = self.snapshot()
+        call_command('export_blog', self.path, batch_size=2, stderr=io.StringIO())
+        Post.objects.all().delete()
+        User.objects.all().delete()
+        call_command('import_blog', self.path, batch_size=3, stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), before)
+        self.assertFalse(os.path.exists(self.path + '.checkpoint'))
+
+    def test_resume_skips_what_was_imported(self):
+        call_command('export_blog', self.path, stderr=io.StringIO())
+        Comment.objects.all().delete()
+        # as if it had stopped after the first 2 lines.
+        with open(self.path, 'rb') as file:
+            offset = len(file.readline()) + len(file.readline())
+        with open(self.path + '.checkpoint', 'w') as file:
+            file.write(f'{{"offset": {offset}}}')
+        out = io.StringIO()
+        call_command('import_blog', self.path, stdout=out)
+        self.assertIn('10 rows imported, 3 skipped', out.getvalue())
+        self.assertEqual(Comment.objects.count(), 10)
+
+    def test_resume_after_a_failed_finish_still_refreshes(self):
+        call_command('export_blog', self.path, stderr=io.StringIO())
+        Post.objects.all().delete()
+        with mock.patch.object(BlogImporter, 'finish', side_effect=RuntimeError('killed')):
+            with self.assertRaises(RuntimeError):
+                call_command('import_blog', self.path, stdout=io.StringIO())
+        self.assertEqual(Post.objects.count(), 5)
+        self.assertFalse(RelatedPost.objects.exists())
+        # the second run imports nothing, but knows what the first one did.
+        out = io.StringIO()
+        call_command('import_blog', self.path, stdout=out)
+        self.assertIn('0 rows imported', out.getvalue())
+        self.assertTrue(RelatedPost.objects.exists())
+
+    @override_settings(BLOG_SEARCH_BACKEND='BlogApp.search.inverted.InvertedIndexBackend')
+    def test_imported_posts_are_searchable(self):
+        from .search import get_backend
+        with override_settings(BLOG_SEARCH_INDEX_PATH=os.path.join(os.path.dirname(self.path), 'search.idx')):
+            call_command('export_blog', self.path, stderr=io.StringIO())
+            Post.objects.all().delete()
+            # the index is built now, from an empty blog.
+            self.assertEqual(len(get_backend().search('post')), 0)
+            call_command('import_blog', self.path, stdout=io.StringIO())
+            self.assertEqual(len(get_backend().search('post')), 5)
+
+    def test_imported_posts_are_suggested(self):
+        call_command('export_blog', self.path, stderr=io.StringIO())
+        Post.objects.all().delete()
+        suggestions.clear()
+        self.addCleanup(suggestions.clear)
+        self.assertEqual(suggestions.suggest('post')['posts'], [])
+        call_command('import_blog', self.path, stdout=io.StringIO())
+        self.assertEqual(len(suggestions.suggest('post')['posts']), 5)
+        self.assertEqual(suggestions.suggest('tag')['tags'][0]['posts'], 3)
+
+
+@override_settings(BLOG_COMMENTS_PER_PAGE=10, BLOG_QUERY_BUDGET_STRICT=True)
+class CommentPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        cls.post = Post.objects.create(title='Popular', slug='popular', author=author,
+                                       body='Everyone comments.', status='published')
+        for number in range(25):
+            Comment.objects.create(post=cls.post, name=f'reader {number}',
+                                   email='reader@example.com', body=f'Comment {number}',
+                                   active=number != 3)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_detail_shows_first_page(self):
+        response = self.client.get(self.post.get_absolute_url())
+        comments = response.context['comments']
+        self.assertEqual([comment.body for comment in comments],
+                         [f'Comment {number}' for number in range(11) if number != 3])
+        self.assertTrue(comments.has_next())
+        self.assertContains(response, 'More comments')
+
+    def test_json_pages_walk_every_comment(self):
+        bodies = []
+        url = reverse('BlogApp:post_comments', args=[self.post.pk])
+        while url:
+            with count_queries() as counter:
+                data = self.client.get(url).json()
+            self.assertLessEqual(counter.count, 2)
+            bodies.extend(comment['body'] for comment in data['comments'])
+            url = data['next']
+        self.assertEqual(bodies, [f'Comment {number}' for number in range(25) if number != 3])
+
+    def test_posting_a_comment(self):
+        url = reverse('BlogApp:post_comments', args=[self.post.pk])
+        response = self.client.post(url, {'name': 'new', 'email': 'new@example.com', 'body': 'Hello'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['total'], 25)
+        self.assertIn('Hello', response.json()['html'])
+        response = self.client.post(url, {'name': 'new', 'email': 'wrong', 'body': 'Hello'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('email', response.json()['errors'])
+
+
+class SidebarCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author')
+        cls.post = Post.objects.create(title='First', slug='first', author=cls.author,
+                                       body='Body.', status='published')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_saving_a_post_changes_the_sidebar(self):
+        self.assertEqual(blog_tags.total_posts(), 1)
+        self.assertEqual([post.title for post in blog_tags.show_latest_posts()['latest_posts']], ['First'])
+        Post.objects.create(title='Second', slug='second', author=self.author,
+                            body='Body.', status='published')
+        self.assertEqual(blog_tags.total_posts(), 2)
+        self.assertEqual([post.title for post in blog_tags.show_latest_posts()['latest_posts']],
+                         ['Second', 'First'])
+        self.post.title = 'First, renamed'
+        self.post.save()
+        self.assertEqual([post.title for post in blog_tags.show_latest_posts()['latest_posts']],
+                         ['Second', 'First, renamed'])
+
+    def test_a_comment_changes_the_most_commented(self):
+        other = Post.objects.create(title='Other', slug='other', author=self.author,
+                                    body='Body.', status='published')
+        Comment.objects.create(post=other, name='reader', email='reader@example.com', body='Hi')
+        self.assertEqual([post.pk for post in blog_tags.get_most_commented_posts(1)], [other.pk])
+        for _ in range(2):
+            Comment.objects.create(post=self.post, name='reader', email='reader@example.com', body='Hi')
+        self.assertEqual([post.pk for post in blog_tags.get_most_commented_posts(1)], [self.post.pk])
+
+    def test_only_one_request_computes_a_missing_value(self):
+        calls = []
+        barrier = threading.Barrier(5)
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        def ask():
+            barrier.wait()
+            results.append(get_or_compute('blog:test:stampede', compute, 60))
+
+        results = []
+        threads = [threading.Thread(target=ask) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 5)
+
+
+class CommentCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        cls.post = Post.objects.create(title='Counted', slug='counted', author=author,
+                                       body='Body.', status='published')
+        cls.other = Post.objects.create(title='Other', slug='other', author=author,
+                                        body='Body.', status='published')
+
+    def counter(self, post=None):
+        return Post.objects.get(pk=(post or self.post).pk).active_comments
+
+    def comment(self, **fields):
+        return Comment.objects.create(**dict({'post': self.post, 'name': 'reader',
+                                              'email': 'reader@example.com', 'body': 'Hi'}, **fields))
+
+    def test_saving_deactivating_and_deleting(self):
+        first, second = self.comment(), self.comment()
+        self.comment(active=False)
+        self.assertEqual(self.counter(), 2)
+        first.active = False
+        first.save()
+        self.assertEqual(self.counter(), 1)
+        # saving again without a change doesn't count it twice.
+        first.save()
+        second.save()
+        self.assertEqual(self.counter(), 1)
+        first.active = True
+        first.save()
+        self.assertEqual(self.counter(), 2)
+        second.delete()
+        self.assertEqual(self.counter(), 1)
+
+    def test_moving_a_comment_to_another_post(self):
+        comment = self.comment()
+        comment.post = self.other
+        comment.save()
+        self.assertEqual((self.counter(), self.counter(self.other)), (0, 1))
+
+    def test_repair_fixes_drifted_counters(self):
+        self.comment()
+        self.comment()
+        Post.objects.filter(pk=self.post.pk).update(active_comments=7)
+        Post.objects.filter(pk=self.other.pk).update(active_comments=1)
+        out = io.StringIO()
+        call_command('repair_comment_counts', '--dry-run', stdout=out)
+        self.assertIn('2 counters found', out.getvalue())
+        self.assertEqual(self.counter(), 7)
+        out = io.StringIO()
+        call_command('repair_comment_counts', '--batch-size', '1', stdout=out)
+        self.assertIn(f'Post {self.post.pk}: stored 7, actual 2', out.getvalue())
+        self.assertEqual((self.counter(), self.counter(self.other)), (2, 0))
+
+
+class KeysetPaginatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        noon = datetime.datetime(2020, 5, 1, 12, 0)
+        # posts 2, 3 and 4 are published at the same moment: only the id tells them apart.
+        days = [-2, -1, 0, 0, 0, 1, 2]
+        cls.posts = [Post.objects.create(title=f'Post {number}', slug=f'post-{number}', author=author,
+                                         body='Body.', status='published',
+                                         publish=noon + datetime.timedelta(days=days[number]))
+                     for number in range(7)]
+
+    def setUp(self):
+        self.paginator = KeysetPaginator(Post.published.all(), 2)
+        self.expected = sorted(self.posts, key=lambda post: (post.publish, post.pk), reverse=True)
+
+    def walk_forward(self):
+        pages, page = [], self.paginator.page()
+        while True:
+            pages.append(page)
+            if not page.has_next():
+                return pages
+            page = self.paginator.page(page.next_cursor)
+
+    def test_next_pages_walk_every_post_once(self):
+        pages = self.walk_forward()
+        self.assertEqual([post.pk for page in pages for post in page], [post.pk for post in self.expected])
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+        self.assertFalse(pages[0].has_previous())
+        self.assertTrue(pages[-1].has_previous())
+
+    def test_previous_goes_back_to_the_same_pages(self):
+        pages = self.walk_forward()
+        page = pages[-1]
+        for expected in reversed(pages[:-1]):
+            page = self.paginator.page(page.previous_cursor)
+            self.assertEqual([post.pk for post in page], [post.pk for post in expected])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_ties_on_publish_are_split_by_id(self):
+        tied = [post.pk for post in self.expected if post.publish == self.posts[2].publish]
+        self.assertEqual(tied, sorted(tied, reverse=True))
+        # a page ending in the middle of the tie goes on with the next id.
+        page = self.paginator.page()
+        while page[-1].pk not in tied[:-1]:
+            page = self.paginator.page(page.next_cursor)
+        following = self.paginator.page(page.next_cursor)
+        self.assertEqual(following[0].pk, tied[tied.index(page[-1].pk) + 1])
+
+    def test_broken_cursors_give_the_first_page(self):
+        first = [post.pk for post in self.paginator.page()]
+        tampered = base64.urlsafe_b64encode(json.dumps(['n', ['not a date', 'x']]).encode()).decode()
+        for cursor in ('garbage', '!!!', tampered, self.paginator.page().next_cursor[:-3],
+                       base64.urlsafe_b64encode(b'["x", []]').decode()):
+            self.assertEqual([post.pk for post in self.paginator.page(cursor)], first)
+        response = self.client.get(reverse('BlogApp:post_list'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 200)
+
+
+# It's a TransactionTestCase because the lists are refreshed after the commit.
+class RelatedPostTests(TransactionTestCase):
+    def setUp(self):
+        author = User.objects.create_user('author')
+        self.posts = []
+        for number in range(8):
+            post = Post.objects.create(title=f'Post {number}', slug=f'post-{number}', author=author,
+                                       body='Body.', status='published')
+            post.tags.add('django', *[f'tag-{tag}' for tag in range(number % 3)])
+            self.posts.append(post)
+
+    def lists(self):
+        return list(RelatedPost.objects.order_by('post_id', 'rank')
+                    .values_list('post_id', 'related_id', 'score', 'rank'))
+
+    def rebuilt(self):
+        call_command('rebuild_related_posts', stdout=io.StringIO())
+        return self.lists()
+
+    def test_signals_keep_the_same_lists_as_a_rebuild(self):
+        post = self.posts[0]
+        post.tags.add('tag-0', 'tag-1')
+        refreshed = self.lists()
+        self.assertEqual(refreshed, self.rebuilt())
+        self.assertIn((self.posts[2].pk, post.pk, 3), [row[:3] for row in refreshed])
+
+        post.status = 'draft'
+        post.save()
+        refreshed = self.lists()
+        self.assertEqual(refreshed, self.rebuilt())
+        self.assertNotIn(post.pk, [related_id for _, related_id, _, _ in refreshed])
+
+        self.posts[1].delete()
+        self.assertEqual(self.lists(), self.rebuilt())
+
+    def test_refresh_costs_the_same_for_any_number_of_lists(self):
+        self.rebuilt()
+        with count_queries() as few:
+            self.assertEqual(len(refresh_around(self.posts[2].pk)), 8)
+        author = self.posts[0].author
+        # (not so many that SQLite needs two INSERTs for the rows.)
+        for number in range(8, 23):
+            Post.objects.create(title=f'Post {number}', slug=f'post-{number}', author=author,
+                                body='Body.', status='published').tags.add('django')
+        with count_queries() as many:
+            self.assertEqual(len(refresh_around(self.posts[2].pk)), 23)
+        self.assertEqual(many.count, few.count)
+
+
+# It needs a second database in DATABASES, e.g. another SQLite file:
+#   DATABASES['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'replica.sqlite3'}
+# Nothing copies the rows, so a post only on 'default' tells where a read went.
+@skipUnless('replica' in settings.DATABASES, 'no replica database configured')
+@override_settings(BLOG_REPLICAS=['replica'], BLOG_PAGE_CACHE_TIMEOUT=0)
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        health.clear()
+        author = User.objects.create_user('author')
+        self.post = Post.objects.create(title='Fresh', slug='fresh', author=author,
+                                        body='Not replicated yet.', status='published')
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.client.get(self.post.get_absolute_url()).status_code, 404)
+
+    def test_writer_sticks_to_the_primary(self):
+        url = reverse('BlogApp:post_comments', args=[self.post.pk])
+        response = self.client.post(url, {'name': 'me', 'email': 'me@example.com', 'body': 'First!'})
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        # the test client sends the cookie back.
+        response = self.client.get(self.post.get_absolute_url())
+        self.assertContains(response, 'First!')
+        self.client.cookies.pop(PIN_COOKIE)
+        self.assertEqual(self.client.get(self.post.get_absolute_url()).status_code, 404)
+
+    def test_failover_to_the_primary(self):
+        replica = connections['replica']
+        with mock.patch.object(replica, 'ensure_connection', side_effect=OperationalError('down')):
+            with self.assertLogs('BlogApp.routers', 'WARNING'):
+                response = self.client.get(self.post.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(BLOG_VIEW_FLUSH_SECONDS=0)
+class PopularityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        cls.old = Post.objects.create(title='Old favourite', slug='old', author=author,
+                                      body='Read a lot, long ago.', status='published')
+        cls.new = Post.objects.create(title='Trending', slug='trending', author=author,
+                                      body='Read today.', status='published')
+
+    def setUp(self):
+        cache.clear()
+        views_buffer.take()
+
+    def key(self, post):
+        return (post.publish.year, post.publish.month, post.publish.day, post.slug)
+
+    def test_the_blogs_own_requests_are_not_views(self):
+        url = self.new.get_absolute_url()
+        self.client.get(url, **internal_headers())
+        self.client.get(url, HTTP_X_BLOG_INTERNAL='forged')
+        self.assertEqual(views_buffer.flush(), 1)
+        self.new.refresh_from_db()
+        self.assertEqual(self.new.views, 1)
+
+    def test_views_are_buffered_then_flushed(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get(self.new.get_absolute_url()).status_code, 200)
+        self.new.refresh_from_db()
+        self.assertEqual(self.new.views, 0)
+        with count_queries() as counter:
+            self.assertEqual(views_buffer.flush(), 1)
+        # find the posts, lock their rows, update them (and the savepoint),
+        # then check whether the popular posts changed.
+        self.assertLessEqual(counter.count, 6)
+        self.new.refresh_from_db()
+        self.assertEqual(self.new.views, 3)
+
+    def test_workers_add_up(self):
+        # two processes flushing their own counts.
+        for buffer, views in ((ViewBuffer(), 2), (ViewBuffer(), 5)):
+            for _ in range(views):
+                buffer.add(self.key(self.old))
+            buffer.flush()
+        self.old.refresh_from_db()
+        self.assertEqual(self.old.views, 7)
+
+    def test_recent_views_weigh_more(self):
+        eight_weeks_ago = datetime.datetime.now().timestamp() - 8 * 7 * 86400
+        for _ in range(100):
+            views_buffer.add(self.key(self.old), when=eight_weeks_ago)
+        for _ in range(2):
+            views_buffer.add(self.key(self.new))
+        views_buffer.flush()
+        # 100 views halved 8 times are worth less than 2 views today.
+        self.assertEqual([post.slug for post in blog_tags.get_popular_posts()], ['trending', 'old'])
+        with self.assertNumQueries(0):
+            blog_tags.get_popular_posts()
+
+    def test_new_popular_posts_change_the_pages(self):
+        views_buffer.add(self.key(self.old))
+        views_buffer.flush()
+        url = self.new.get_absolute_url()
+        etag = self.client.get(url)['ETag']
+        # the same order: the sidebar and the validators stay.
+        views_buffer.add(self.key(self.old))
+        views_buffer.flush()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        for _ in range(3):
+            views_buffer.add(self.key(self.new))
+        views_buffer.flush()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([post.slug for post in blog_tags.get_popular_posts()], ['trending', 'old'])
+
+    @override_settings(BLOG_POPULARITY_HALF_LIFE_DAYS=0.01)
+    def test_scores_do_not_overflow(self):
+        # a view in 2100 with a 15-minute half-life is worth 2 ** 2800000.
+        far = datetime.datetime(2100, 1, 1).timestamp()
+        for _ in range(3):
+            views_buffer.add(self.key(self.old), when=far - 86400)
+        views_buffer.add(self.key(self.new), when=far)
+        self.assertEqual(views_buffer.flush(), 2)
+        self.old.refresh_from_db()
+        self.new.refresh_from_db()
+        self.assertTrue(math.isfinite(self.old.popularity))
+        # one view a day later beats three a day earlier.
+        self.assertGreater(self.new.popularity, self.old.popularity)
+        views_buffer.add(self.key(self.old), when=far + 86400)
+        views_buffer.flush()
+        self.old.refresh_from_db()
+        self.assertGreater(self.old.popularity, self.new.popularity)
+        self.assertEqual(self.old.views, 4)
+
+
+class PostLookupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        cls.post = Post.objects.create(title='Found', slug='found', author=author,
+                                       body='By its URL.', status='published',
+                                       publish=datetime.datetime(2020, 3, 1, 23, 59))
+        cls.other = Post.objects.create(title='Other', slug='other', author=author,
+                                        body='Another one.', status='published')
+
+    def setUp(self):
+        post_ids.clear()
+
+    def test_warm_lookup_is_one_primary_key_fetch(self):
+        self.assertEqual(views.get_published_post(2020, 3, 1, 'found'), self.post)
+        with count_queries() as counter:
+            self.assertEqual(views.get_published_post(2020, 3, 1, 'found'), self.post)
+        self.assertEqual(counter.count, 1)
+        self.assertIn('"id" =', counter.queries[0])
+        # the range ends at midnight.
+        with self.assertRaises(Http404):
+            views.get_published_post(2020, 3, 2, 'found')
+        with self.assertRaises(Http404):
+            views.get_published_post(2020, 2, 30, 'found')
+
+    def test_changed_posts_are_not_served_from_the_cache(self):
+        views.get_published_post(2020, 3, 1, 'found')
+        self.post.slug = 'moved'
+        self.post.save()
+        with self.assertRaises(Http404):
+            views.get_published_post(2020, 3, 1, 'found')
+        # another process may remember a wrong id: the lookup checks the URL too.
+        post_ids.set((2020, 3, 1, 'moved'), self.other.pk)
+        self.assertEqual(views.get_published_post(2020, 3, 1, 'moved'), self.post)
+
+    def test_least_recently_used_is_evicted(self):
+        ids = PostIdCache(2)
+        ids.set('a', 1)
+        ids.set('b', 2)
+        ids.get('a')
+        ids.set('c', 3)
+        self.assertEqual((ids.get('a'), ids.get('b'), ids.get('c')), (1, None, 3))
+
+
+class InvertedIndexFileTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'search.idx')
+
+    def reopened(self):
+        index = InvertedIndex()
+        index.open(self.path)
+        self.addCleanup(index.close)
+        return index
+
+    def test_save_open_remove_round_trip(self):
+        index = InvertedIndex()
+        self.addCleanup(index.close)
+        index.add(1, 'Django tips', 'Views and templates.')
+        index.add(2, 'Python tricks', 'Generators and Django.')
+        index.save(self.path, {'watermark': 'then'})
+        copy = self.reopened()
+        self.assertEqual(copy.meta['watermark'], 'then')
+        self.assertEqual(copy.search('django'), index.search('django'))
+        self.assertEqual(set(copy.search('django')), {1, 2})
+
+        # removing from the file part, adding to the memory part, and merging.
+        copy.remove(1)
+        copy.add(3, 'More Django', 'Forms.')
+        self.assertEqual(set(copy.search('django')), {2, 3})
+        copy.save(self.path)
+        self.assertEqual(set(self.reopened().search('django')), {2, 3})
+        self.assertEqual(self.reopened().search('templates'), [])
+        self.assertEqual(sorted(os.listdir(self.directory)), ['search.idx', 'search.idx.lock'])
+
+    def test_failed_save_keeps_the_old_file(self):
+        index = InvertedIndex()
+        self.addCleanup(index.close)
+        index.add(1, 'Django tips', 'Views.')
+        index.save(self.path)
+        index.add(2, 'Unsaved', 'Django.')
+        with mock.patch('os.replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                index.save(self.path)
+        self.assertEqual(self.reopened().search('django'), [1])
+        self.assertFalse([name for name in os.listdir(self.directory) if name.endswith('.tmp')])
+
+    def test_catch_up_reads_the_missing_posts_in_chunks(self):
+        author = User.objects.create_user('author')
+        posts = [Post.objects.create(title=f'Django {number}', slug=f'django-{number}', author=author,
+                                     body='Body.', status='published') for number in range(5)]
+        # a file written later than every post, but without them.
+        index = InvertedIndex()
+        index.add(posts[0].pk, posts[0].title, posts[0].body)
+        index.save(self.path, {'watermark': '2999-01-01T00:00:00'})
+        index.close()
+        with override_settings(BLOG_SEARCH_INDEX_PATH=self.path), \
+                mock.patch('BlogApp.search.inverted.CATCH_UP_CHUNK', 2):
+            backend = InvertedIndexBackend()
+            self.addCleanup(backend.index.close)
+            with count_queries() as counter:
+                backend.load()
+        self.assertEqual(set(backend.index.search('django')), {post.pk for post in posts})
+        # the 4 missing posts, 2 at a time.
+        self.assertEqual(len([sql for sql in counter.queries if ' IN (' in sql]), 2)
+
+
+@override_settings(BLOG_SEARCH_BACKEND='BlogApp.search.inverted.InvertedIndexBackend')
+class AdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        cls.published = Post.objects.create(title='About databases', slug='about-databases',
+                                            author=cls.admin, body='Indexes and replicas.',
+                                            status='published')
+        cls.draft = Post.objects.create(title='Databases, a draft', slug='draft',
+                                        author=cls.admin, body='Not yet.')
+        cls.other = Post.objects.create(title='Other', slug='other', author=cls.admin,
+                                        body='Nothing to see.', status='published')
+        for number in range(3):
+            Comment.objects.create(post=cls.published, name=f'reader {number}',
+                                   email='reader@example.com', body='Nice!', active=False)
+        Comment.objects.create(post=cls.other, name='reader', email='reader@example.com',
+                               body='Nice!', active=True)
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        settings_override = override_settings(BLOG_SEARCH_INDEX_PATH=f'{self.index_dir}/search.idx')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        self.client.force_login(self.admin)
+
+    def test_search_uses_the_index_and_finds_drafts_by_title(self):
+        response = self.client.get(reverse('admin:BlogApp_post_changelist'), {'q': 'databases'})
+        cl = response.context['cl']
+        self.assertEqual({post.pk for post in cl.result_list}, {self.published.pk, self.draft.pk})
+        # only the columns on the screen are loaded.
+        self.assertIn('body', cl.result_list[0].get_deferred_fields())
+        self.assertNotContains(response, 'total')
+
+    def test_counts_are_capped(self):
+        with override_settings(BLOG_ADMIN_EXACT_COUNT_LIMIT=2):
+            self.assertEqual(EstimatedCountPaginator(Post.objects.order_by('pk'), 1).count, 2)
+        self.assertEqual(EstimatedCountPaginator(Post.objects.order_by('pk'), 1).count, 3)
+
+    def test_bulk_approve_and_deactivate_keep_the_counters(self):
+        url = reverse('admin:BlogApp_comment_changelist')
+        version = cache.get(SIDEBAR_VERSION_KEY)
+        selected = list(Comment.objects.values_list('pk', flat=True))
+        self.client.post(url, {'action': 'approve_comments', '_selected_action': selected})
+        self.assertEqual(Comment.objects.filter(active=True).count(), 4)
+        self.assertEqual(Post.objects.get(pk=self.published.pk).active_comments, 3)
+        self.assertEqual(Post.objects.get(pk=self.other.pk).active_comments, 1)
+
+        with count_queries() as counter:
+            self.client.post(url, {'action': 'deactivate_comments',
+                                   '_selected_action': selected[:2]})
+        self.assertEqual(Post.objects.get(pk=self.published.pk).active_comments, 1)
+        self.assertEqual(len([sql for sql in counter.queries
+                              if sql.startswith('UPDATE "BlogApp_comment"')]), 1)
+        self.assertNotEqual(cache.get(SIDEBAR_VERSION_KEY), version)
+
+
+@override_settings(BLOG_QUERY_BUDGET_STRICT=True, BLOG_API_CHUNK_SIZE=2,
+                   BLOG_SEARCH_BACKEND='BlogApp.search.inverted.InvertedIndexBackend')
+class ApiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        cls.posts = []
+        for number in range(5):
+            post = Post.objects.create(title=f'Api post {number}', slug=f'api-post-{number}',
+                                       author=author, body=f'The **body** {number}.',
+                                       status='published',
+                                       publish=datetime.datetime(2020, 1, number + 1))
+            post.tags.add('api', f'tag-{number % 2}')
+            cls.posts.append(post)
+        for number in range(3):
+            Comment.objects.create(post=cls.posts[0], name=f'reader {number}',
+                                   email='reader@example.com', body='Nice!')
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        settings_override = override_settings(BLOG_SEARCH_INDEX_PATH=f'{self.index_dir}/search.idx')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        cache.clear()
+
+    def get_json(self, url, data=None, **extra):
+        response = self.client.get(url, data, **extra)
+        if response.streaming:
+            with count_queries() as counter:
+                response.content_json = json.loads(b''.join(response.streaming_content))
+            response.streamed_queries = counter.queries
+        else:
+            response.content_json = response.json()
+        return response
+
+    def test_sparse_fields_leave_the_other_columns_alone(self):
+        response = self.get_json(reverse('BlogApp:api_posts'), {'fields': 'title,url'})
+        results = response.content_json['results']
+        self.assertEqual(results[0], {'title': 'Api post 4', 'url': self.posts[4].get_absolute_url()})
+        self.assertEqual(len(results), 5)
+        # one query per chunk of 2 rows, none of them reading the body.
+        self.assertEqual(len(response.streamed_queries), 1)
+        self.assertNotIn('"body"', response.streamed_queries[0])
+        self.assertEqual(self.get_json(reverse('BlogApp:api_posts'), {'fields': 'title,email'}).status_code, 400)
+
+    def test_cursor_pages_and_tags_per_chunk(self):
+        url, seen = reverse('BlogApp:api_posts'), []
+        response = self.get_json(url, {'limit': 3})
+        seen += [post['slug'] for post in response.content_json['results']]
+        # the posts of a chunk get their tags in one query.
+        self.assertEqual(len(response.streamed_queries), 3)
+        self.assertEqual(response.content_json['results'][0]['tags'], ['api', 'tag-0'])
+        response = self.get_json(response.content_json['next'])
+        seen += [post['slug'] for post in response.content_json['results']]
+        self.assertIsNone(response.content_json['next'])
+        self.assertEqual(seen, [f'api-post-{number}' for number in range(4, -1, -1)])
+
+        by_tag = self.get_json(reverse('BlogApp:api_posts_by_tag', args=['tag-1']), {'fields': 'slug'})
+        self.assertEqual(by_tag.content_json['results'], [{'slug': 'api-post-3'}, {'slug': 'api-post-1'}])
+
+    def test_etags(self):
+        url = reverse('BlogApp:api_posts')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # another page, or other fields, is another answer.
+        self.assertNotEqual(self.client.get(url, {'fields': 'id'})['ETag'], etag)
+        Comment.objects.create(post=self.posts[4], name='reader', email='reader@example.com', body='Hi')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_post_detail(self):
+        post = self.posts[0]
+        url = reverse('BlogApp:api_post_detail', args=[2020, 1, 1, post.slug])
+        response = self.get_json(url)
+        self.assertEqual(response.content_json['body_html'], post.body_html)
+        self.assertEqual(response.content_json['comments'], 3)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        missing = self.get_json(reverse('BlogApp:api_post_detail', args=[2020, 1, 2, post.slug]))
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(missing.content_json, {'error': 'Not found.'})
+
+    def test_comments_tags_and_search(self):
+        url = reverse('BlogApp:api_post_comments', args=[self.posts[0].pk])
+        response = self.get_json(url, {'limit': 2})
+        self.assertEqual([comment['name'] for comment in response.content_json['results']],
+                         ['reader 0', 'reader 1'])
+        self.assertNotIn('email', response.content_json['results'][0])
+        self.assertEqual(len(self.get_json(response.content_json['next']).content_json['results']), 1)
+
+        tags = self.get_json(reverse('BlogApp:api_tags')).content_json['results']
+        self.assertEqual([(tag['slug'], tag['posts']) for tag in tags],
+                         [('api', 5), ('tag-0', 3), ('tag-1', 2)])
+
+        from .search import get_backend
+        get_backend().search('body')
+        response = self.get_json(reverse('BlogApp:api_search'), {'q': 'body', 'limit': 4, 'fields': 'slug'})
+        self.assertEqual(len(response.content_json['results']), 4)
+        self.assertTrue(response.content_json['next'].endswith('page=2'))
+        self.assertEqual(self.client.post(reverse('BlogApp:api_search')).status_code, 405)
+
+
+# The suggestions follow the changes on commit, so this is a TransactionTestCase.
+class SuggestTests(TransactionTestCase):
+    def setUp(self):
+        suggestions.clear()
+        self.addCleanup(suggestions.clear)
+        self.author = User.objects.create_user('author')
+        self.tips = self.create('Django tips', tags=['django'])
+        self.python = self.create('Tips for Python', tags=['python', 'django'])
+        self.create('Tipping point', status='draft')
+        self.cafe = self.create('Café reviews')
+        # read a lot: it comes first, even being older.
+        Post.objects.filter(pk=self.python.pk).update(popularity=view_score() + math.log2(5), views=5)
+
+    def create(self, title, status='published', tags=()):
+        post = Post.objects.create(title=title, slug=title.lower().replace(' ', '-'), author=self.author,
+                                   body='Body.', status=status)
+        post.tags.add(*tags)
+        return post
+
+    def titles(self, query):
+        return [post['title'] for post in suggestions.suggest(query)['posts']]
+
+    def test_any_word_prefix_best_first(self):
+        self.assertEqual(self.titles('tip'), ['Tips for Python', 'Django tips'])
+        self.assertEqual(self.titles('Cafe'), ['Café reviews'])
+        self.assertEqual(self.titles('django t'), ['Django tips'])
+        self.assertEqual(suggestions.suggest('dj')['tags'],
+                         [{'name': 'django', 'url': reverse('BlogApp:post_list_by_tag', args=['django']),
+                           'posts': 2}])
+        self.assertEqual(suggestions.suggest('tips')['posts'][1]['url'], self.tips.get_absolute_url())
+
+    def test_changes_are_followed(self):
+        self.titles('tip')
+        self.create('Tipsy titles', tags=['django'])
+        self.assertEqual(self.titles('tip'), ['Tips for Python', 'Tipsy titles', 'Django tips'])
+        self.assertEqual(suggestions.suggest('djan')['tags'][0]['posts'], 3)
+        self.python.status = 'draft'
+        self.python.save()
+        self.tips.delete()
+        self.assertEqual(self.titles('tip'), ['Tipsy titles'])
+        self.assertEqual(suggestions.suggest('djan')['tags'][0]['posts'], 1)
+
+    def test_tags_are_read_without_the_lock(self):
+        suggestions.suggest('dj')
+        self.create('Django forms', tags=['django'])
+        locked = []
+        read_tags = suggestions.read_tags
+
+        def read_and_look():
+            locked.append(suggestions.lock.locked())
+            return read_tags()
+
+        with mock.patch.object(suggestions, 'read_tags', side_effect=read_and_look):
+            self.assertEqual(suggestions.suggest('dj')['tags'][0]['posts'], 3)
+            suggestions.suggest('dj')
+        self.assertEqual(locked, [False])
+
+    def test_endpoint_costs_no_query_once_loaded(self):
+        url = reverse('BlogApp:post_suggest')
+        # loading reads the posts and the tags once each.
+        with count_queries() as counter:
+            self.client.get(url, {'q': 'tip'})
+        self.assertEqual(counter.count, 2)
+        with count_queries() as counter:
+            response = self.client.get(url, {'q': 'tip'})
+        self.assertEqual(counter.count, 0)
+        self.assertEqual([post['title'] for post in response.json()['posts']],
+                         ['Tips for Python', 'Django tips'])
+        self.assertIn('max-age', response['Cache-Control'])
+
+    def test_prefix_index_top_matches_a_full_scan(self):
+        rng = random.Random(0)
+        entries = [(''.join(rng.choice('ab') for _ in range(5)), rng.randrange(300), rng.random())
+                   for _ in range(2000)]
+        index = PrefixIndex(entries)
+        for prefix in ('', 'a', 'ab', 'bba', 'abab'):
+            best = {}
+            for key, item, weight in entries:
+                if key.startswith(prefix):
+                    best[item] = max(weight, best.get(item, 0))
+            expected = sorted(((weight, item) for item, weight in best.items()), reverse=True)[:7]
+            self.assertEqual(index.top(prefix, 7), expected)
+
+
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author')
+        cls.post = Post.objects.create(title='Timed', slug='timed', author=author,
+                                       body='Some *markdown*.', status='published')
+
+    def setUp(self):
+        cache.clear()
+        reset_metrics()
+
+    def metric(self, text, name):
+        for line in text.splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split()[-1])
+        return None
+
+    def test_request_is_recorded(self):
+        self.client.get(self.post.get_absolute_url())
+        text = self.client.get(reverse('metrics')).content.decode()
+        view = 'view="BlogApp:post_detail"'
+        self.assertEqual(self.metric(text, f'blog_request_seconds_count{{{view}}}'), 1)
+        self.assertGreater(self.metric(text, f'blog_sql_queries_sum{{{view}}}'), 0)
+        self.assertGreater(self.metric(text, f'blog_template_seconds_sum{{{view}}}'), 0)
+        self.assertEqual(self.metric(text, f'blog_sql_queries_bucket{{{view},le="+Inf"}}'), 1)
+
+    @override_settings(INTERNAL_IPS=[])
+    def test_endpoint_is_private(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    @override_settings(BLOG_SLOW_REQUEST_MS=0, BLOG_SLOW_REQUEST_QUERIES=2)
+    def test_slow_request_log(self):
+        with self.assertLogs('BlogApp.metrics', 'WARNING') as logs:
+            self.client.get(self.post.get_absolute_url())
+        self.assertIn('Slow request GET', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+class AsyncViewTests(TransactionTestCase):
+    # The async views fetch from other threads, which only see committed rows.
+    def setUp(self):
+        cache.clear()
+        author = User.objects.create_user('author')
+        self.post = Post.objects.create(title='Async', slug='async', author=author,
+                                        body='Fetched *concurrently*.', status='published')
+        self.post.tags.add('django')
+        Comment.objects.create(post=self.post, name='reader', email='reader@example.com', body='Nice!')
+        self.other = Post.objects.create(title='Other', slug='other', author=author,
+                                         body='Also about Django.', status='published')
+        self.other.tags.add('django')
+
+    def get(self, view, path, *args):
+        request = RequestFactory().get(path)
+        request.COOKIES.pop('sessionid', None)
+        with count_queries() as counter:
+            if asyncio.iscoroutinefunction(view):
+                view = async_to_sync(view)
+            response = view(request, *args)
+        return response, counter.count
+
+    def test_same_page_and_queries_as_sync_views(self):
+        date = self.post.publish
+        args = (date.year, date.month, date.day, self.post.slug)
+        path = self.post.get_absolute_url()
+        for sync_view, async_view, view_args, view_path in (
+                (views.post_detail, asyncviews.post_detail, args, path),
+                (views.post_list, asyncviews.post_list, (), reverse('BlogApp:post_list')),
+                (views.post_share, asyncviews.post_share, (self.post.pk,),
+                 reverse('BlogApp:post_share', args=[self.post.pk]))):
+            cache.clear()
+            expected, sync_queries = self.get(sync_view, view_path, *view_args)
+            cache.clear()
+            response, async_queries = self.get(async_view, view_path, *view_args)
+            self.assertEqual(response.status_code, 200)
+            # the CSRF tokens are different on each request.
+            self.assertEqual(CSRF_RE.sub('', response.content.decode()),
+                             CSRF_RE.sub('', expected.content.decode()))
+            self.assertEqual(async_queries, sync_queries)
+
+    def test_conditional_and_page_cache(self):
+        path = reverse('BlogApp:post_list')
+        response, _ = self.get(asyncviews.post_list, path)
+        self.assertEqual(response['X-Page-Cache'], 'miss')
+        cached, queries = self.get(asyncviews.post_list, path)
+        self.assertEqual((cached['X-Page-Cache'], queries), ('hit', 0))
+        request = RequestFactory().get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        cache.clear()
+        self.assertEqual(async_to_sync(asyncviews.post_list)(request).status_code, 304)
+
+
+class BenchmarkTests(TestCase):
+    def test_every_route_is_measured(self):
+        generate(posts=20, tags=5, comments_per_post=1)
+        measured = {name.split(' ')[0] for name in routes(Client())}
+        self.assertEqual({pattern.name for pattern in urls.urlpatterns} - measured, set())
+
+    def test_generated_tags_are_skewed(self):
+        generate(posts=200, tags=20, comments_per_post=2)
+        self.assertEqual(Post.objects.count(), 200)
+        counts = dict(Post.tags.most_common().values_list('name', 'num_times'))
+        self.assertGreater(counts['tag-0'], 4 * counts.get('tag-19', 0))
+
+    def test_compare_flags_regressions(self):
+        def results(p50, queries):
+            return {'results': {'post_list': {'cold': {'p50_ms': p50, 'p99_ms': p50, 'queries': queries,
+                                                       'peak_kb': 100}}}}
+        self.assertEqual(compare(results(10, 5), results(11, 5))[1], [])
+        self.assertEqual(compare(results(10, 5), results(20, 5))[1], ['post_list [cold]'])
+        self.assertEqual(compare(results(10, 5), results(10, 6))[1], ['post_list [cold]'])
@@ -1,7 +1,16 @@
+import django
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.urls import path
 
-from .feeds import LatestPostsFeed
-from . import views
+from .feeds import latest_posts_feed, latest_posts_atom_feed
+from . import api, views
+
+if getattr(settings, 'BLOG_ASYNC_VIEWS', False):
+    # the same views, fetching their data concurrently (see asyncviews.py).
+    if django.VERSION < (3, 1):
+        raise ImproperlyConfigured('BLOG_ASYNC_VIEWS needs Django 3.1 or newer.')
+    from . import asyncviews as views
 
 app_name = 'BlogApp'
 
@@ -12,6 +21,18 @@ urlpatterns = [
          views.post_detail,
          name='post_detail'),
     path('<int:post_id>/share/', views.post_share, name='post_share'),
-    path('feed/', LatestPostsFeed(), name='post_feed'),
+    path('<int:post_id>/comments/', views.post_comments, name='post_comments'),
+    path('feed/', latest_posts_feed, name='post_feed'),
+    path('feed/atom/', latest_posts_atom_feed, name='post_feed_atom'),
+    path('tag/<slug:tag_slug>/feed/', latest_posts_feed, name='post_feed_by_tag'),
+    path('tag/<slug:tag_slug>/feed/atom/', latest_posts_atom_feed, name='post_feed_by_tag_atom'),
     path('search/', views.post_search, name='post_search'),
+    path('search/suggest/', views.post_suggest, name='post_suggest'),
+    # the JSON API (see api.py).
+    path('api/posts/', api.post_list, name='api_posts'),
+    path('api/posts/<int:year>/<int:month>/<int:day>/<slug:post>/', api.post_detail, name='api_post_detail'),
+    path('api/posts/<int:post_id>/comments/', api.post_comments, name='api_post_comments'),
+    path('api/tags/', api.tag_list, name='api_tags'),
+    path('api/tags/<slug:tag_slug>/posts/', api.post_list_by_tag, name='api_posts_by_tag'),
+    path('api/search/', api.post_search, name='api_search'),
 ]
@@ -1,18 +1,47 @@
 from decouple import config
+from django.conf import settings
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, get_object_or_404
-from django.core.mail import send_mail
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.http import urlquote
 from taggit.models import Tag
-from django.db.models import Count
-from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
 
-from .models import Post
+from .models import Post, Comment, RelatedPost
 from .forms import EmailPostForm, CommentForm, SearchForm
+from .conditional import conditional, list_validators, detail_validators
+from .mailqueue import enqueue_mail
+from .pagecache import cache_page_by_tags, depends_on
+from .popularity import track_views
+from .postlookup import lookup_post
+from .querybudget import query_budget
+from .pagination import KeysetPaginator, page_without_count
+from .search import get_backend
+from .suggest import suggestions
 
 
+# Every view declares how many queries it may run (see querybudget.py).
+# The extra queries are the sidebar tags and validators when their cache is cold.
+# Lists and posts are also kept whole in the page cache (see pagecache.py).
+@query_budget(7, post_list_by_tag=9)
+@cache_page_by_tags
+@conditional(list_validators)
 def post_list(request, tag_slug=None):
-    # Get a list of all published posts
-    published_posts = Post.published.all()
+    return render(request, 'BlogApp/post/list.html', post_list_context(request, tag_slug))
+
+
+# The views fetch their data in these functions, which the async views of
+# asyncviews.py share.
+def post_list_context(request, tag_slug=None):
+    # Get a list of all published posts. The authors come in the same query
+    # and the tags of the whole page in one more, instead of two queries per post.
+    # The body isn't needed, the list shows the stored excerpt.
+    published_posts = (Post.published
+                       .select_related('author')
+                       .prefetch_related('tags')
+                       .defer('body', 'body_html'))
     # create a tag variable to use it inside of the if scope below
     tag = None
 
@@ -22,36 +51,82 @@ def post_list(request, tag_slug=None):
         # and let's filter published_post's list by that tag
         published_posts = published_posts.filter(tags__in=[tag])
 
-    # it determinates the quantity of posts will be displayed
-    paginator = Paginator(published_posts, 2)
     page = request.GET.get('page')
 
-    try:
-        posts = paginator.page(page)
-    except PageNotAnInteger:
-        # If page is not an integer deliver the first page
-        posts = paginator.page(1)
-    except EmptyPage:
-        # If page is out of range deliver last page of results
-        posts = paginator.page(paginator.num_pages)
-    return render(request, 'BlogApp/post/list.html', {'page': page,
-                                                      'posts': posts,
-                                                      'tag': tag})
+    if getattr(settings, 'BLOG_PAGINATION', 'cursor') == 'cursor':
+        # cursor pagination walks (publish, id), without OFFSET and COUNT(*).
+        posts = KeysetPaginator(published_posts, 2).page(request.GET.get('cursor'))
+        pagination_template = 'cursor_pagination.html'
+    else:
+        # it determinates the quantity of posts will be displayed
+        paginator = Paginator(published_posts, 2)
+
+        try:
+            posts = paginator.page(page)
+        except PageNotAnInteger:
+            # If page is not an integer deliver the first page
+            posts = paginator.page(1)
+        except EmptyPage:
+            # If page is out of range deliver last page of results
+            posts = paginator.page(paginator.num_pages)
+        pagination_template = 'pagination.html'
+
+    # the cached page goes away when these posts change, or when the list
+    # (or the tag's list) gets or loses posts.
+    depends_on(request, 'tag:' + tag.slug if tag else 'post-list',
+               *[f'post:{post.pk}' for post in posts])
+
+    return {'page': page,
+            'posts': posts,
+            'tag': tag,
+            'pagination_template': pagination_template}
+
+
+def get_published_post(year, month, day, slug):
+    # a range on publish and the slug, or the post's id once it's known (see postlookup.py).
+    post = lookup_post(Post.published.select_related('author'), year, month, day, slug)
+    if post is None:
+        raise Http404('No Post matches the given query.')
+    return post
+
+
+def similar_posts_of(post):
+    # Similar posts (the ones sharing more tags) are computed when tags change,
+    # and kept in RelatedPost already sorted. So we only read the first 4.
+    return [entry.related for entry in
+            RelatedPost.objects.filter(post=post)
+            .select_related('related')
+            .only('related__title', 'related__slug', 'related__publish')[:4]]
+
+
+def comments_page(post, cursor=None):
+    # One page of the post's active comments, oldest first. The cursor walks
+    # (created, id) on the comment_post_created_idx index, so a post with
+    # thousands of comments costs the same as one with ten.
+    return KeysetPaginator(Comment.objects.filter(post=post, active=True),
+                           getattr(settings, 'BLOG_COMMENTS_PER_PAGE', 20),
+                           ordering=('created', 'id')).page(cursor)
+
+
+def detail_depends_on(request, post, similar_posts):
+    depends_on(request, f'post:{post.pk}', f'comments:{post.pk}', f'related:{post.pk}',
+               *[f'post:{similar.pk}' for similar in similar_posts])
 
 
+@query_budget(10)
+@track_views
+@cache_page_by_tags
+@conditional(detail_validators)
 def post_detail(request, year, month, day, post):
     # This post_detail method is about to properly display in detail a single post
     # and, of course, its other characteristics as comments and a form to write new
     # comments.
 
-    post = get_object_or_404(Post, slug=post,
-                             status='published',
-                             publish__year=year,
-                             publish__month=month,
-                             publish__day=day)
+    post = get_published_post(year, month, day, post)
 
-    # Let's retrieve all the active comments for this post
-    comments = post.comments.filter(active=True)
+    # Let's retrieve the first page of active comments for this post
+    # (the next ones are loaded by post_comments)
+    comments = comments_page(post, request.GET.get('comments'))
 
     # We satiate a new_comment now to deal it later
     new_comment = None
@@ -70,17 +145,14 @@ def post_detail(request, year, month, day, post):
             new_comment.post = post
             # and finally save it in the database
             new_comment.save()
+            # the signals counted the new comment, so let's read the counter again
+            post.refresh_from_db(fields=['active_comments'])
     else:
         # if it's only a GET method, it's only to show the form, so:
         comment_form = CommentForm()
 
-    # Generating a list of similar posts:
-    # post_tags_ids is a list's id of all tags of the current post
-    post_tags_ids = post.tags.values_list('id', flat=True)
-    # similar_posts is list of all post that have the same tags in post_tags_ids except by the current post
-    similar_posts = Post.published.filter(tags__in=post_tags_ids).exclude(id=post.id)
-    # Count the same tags and order by -same_tags and -publish. Show the fist 4 similar_posts.
-    similar_posts = similar_posts.annotate(same_tags=Count('tags')).order_by('-same_tags', '-publish')[:4]
+    similar_posts = similar_posts_of(post)
+    detail_depends_on(request, post, similar_posts)
 
     # Now we have all variable's setup in a properly way, let's rendering it in the html through render method
     return render(request,
@@ -92,6 +164,44 @@ def post_detail(request, year, month, day, post):
                    'similar_posts': similar_posts})
 
 
+@query_budget(2, POST=6)
+@cache_page_by_tags(sidebar=False)
+def post_comments(request, post_id):
+    # The comments after the first page, as JSON, and the comment form posts
+    # here too (with JavaScript on, see js/comments.js), so a new comment is
+    # added to the page without rendering the others again.
+    post = get_object_or_404(Post.published.only('id', 'active_comments'), id=post_id)
+
+    if request.method == 'POST':
+        comment_form = CommentForm(data=request.POST)
+        if not comment_form.is_valid():
+            return JsonResponse({'errors': comment_form.errors}, status=400)
+        new_comment = comment_form.save(commit=False)
+        new_comment.post = post
+        new_comment.save()
+        post.refresh_from_db(fields=['active_comments'])
+        return JsonResponse({'comment': comment_json(new_comment),
+                             'html': render_to_string('BlogApp/post/comments.html', {'comments': [new_comment]}),
+                             'total': post.active_comments}, status=201)
+
+    comments = comments_page(post, request.GET.get('cursor'))
+    depends_on(request, f'comments:{post.pk}')
+    next_url = None
+    if comments.has_next():
+        next_url = reverse('BlogApp:post_comments', args=[post.pk]) + '?cursor=' + urlquote(comments.next_cursor)
+    return JsonResponse({'comments': [comment_json(comment) for comment in comments],
+                         'html': render_to_string('BlogApp/post/comments.html', {'comments': comments}),
+                         'next': next_url})
+
+
+def comment_json(comment):
+    return {'id': comment.pk,
+            'name': comment.name,
+            'body': comment.body,
+            'created': comment.created.isoformat()}
+
+
+@query_budget(5, POST=6)
 def post_share(request, post_id):
     # This method takes the request obj and retrieves a post by its id on post_id's variable.
     # If request's a POST, then it sends a email using form's information.
@@ -115,7 +225,9 @@ def post_share(request, post_id):
 
             message = f"Read {post.title} at {post_url}\n\n{cd['name']}'s comments: {cd['comments']}"
 
-            send_mail(subject, message, config('EMAIL_HOST_USER'), [cd['to']])
+            # the e-mail goes to the outbox and is sent in the background,
+            # so this request doesn't wait for the mail server.
+            enqueue_mail(subject, message, config('EMAIL_HOST_USER'), [cd['to']])
 
             sent = True
 
@@ -130,7 +242,12 @@ def post_share(request, post_id):
                                                        'sent': sent})
 
 
+@query_budget(5)
 def post_search(request):
+    return render(request, 'BlogApp/post/search.html', search_context(request))
+
+
+def search_context(request):
     form = SearchForm()
     query = None
     results = []
@@ -138,14 +255,26 @@ def post_search(request):
         form = SearchForm(request.GET)
         if form.is_valid():
             query = form.cleaned_data['query']
-            search_vector = SearchVector('title', weight='A') + SearchVector('body', weight='B')
-            search_query = SearchQuery(query)
-            results = Post.published.annotate(
-                search=search_vector,
-                rank=SearchRank(search_vector, search_query)
-            ).filter(search=search_query).order_by('-rank')
-    return render(request,
-                  'BlogApp/post/search.html',
-                  {'form': form,
-                   'query': query,
-                   'results': results})
\ No newline at end of file
+            # BLOG_SEARCH_BACKEND decides who searches: PostgreSQL's full-text
+            # search or our own inverted index (see the search package).
+            matches = get_backend().search(query)
+            # only one page of results is loaded, and nothing counts all of them.
+            results = page_without_count(matches,
+                                         request.GET.get('page'),
+                                         settings.BLOG_SEARCH_RESULTS_PER_PAGE,
+                                         settings.BLOG_SEARCH_MAX_PAGES)
+    return {'form': form,
+            'query': query,
+            'results': results}
+
+
+# Suggestions for the search box, as the visitor types (see js/suggest.js).
+# They come from the in-memory index of suggest.py: no query at all, once the
+# index is loaded (loading it takes two).
+@query_budget(2)
+def post_suggest(request):
+    response = JsonResponse(suggestions.suggest(request.GET.get('q', '')))
+    # the same letters get the same answer for a while, in the browser too.
+    patch_cache_control(response, public=True,
+                        max_age=getattr(settings, 'BLOG_SUGGEST_MAX_AGE', 60))
+    return response
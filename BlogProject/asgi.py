@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BlogProject.settings')
 
 application = get_asgi_application()
+
+# The web server's processes send the outbox (see BlogApp/mailqueue.py).
+from BlogApp.mailqueue import start_workers  # noqa: E402
+
+start_workers()
@@ -45,6 +45,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # they come first, so they count the time and the queries of the other middlewares too.
+    'BlogApp.metrics.MetricsMiddleware',
+    'BlogApp.querybudget.QueryBudgetMiddleware',
+    # it chooses between the primary database and the replicas (BlogApp/routers.py).
+    'BlogApp.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,7 +63,9 @@ ROOT_URLCONF = 'BlogProject.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the Django templates, timed for /metrics (BlogApp/metrics.py).
+        'BACKEND': 'BlogApp.metrics.TimedDjangoTemplates',
+        'NAME': 'django',
         'DIRS': [os.path.join(BASE_DIR, 'BlogApp/templates')]
         ,
         'APP_DIRS': True,
@@ -89,6 +96,86 @@ DATABASES = {
     }
 }
 
+# Read replicas: add them to DATABASES and list their aliases here, e.g.
+#   DATABASES['replica'] = {..., 'HOST': '10.0.0.2'}
+#   BLOG_REPLICAS = ['replica']
+# GET requests read from them, writes go to 'default'. A visitor who wrote
+# reads from 'default' for BLOG_PRIMARY_STICKY_SECONDS (set it above the
+# replication lag), and a replica that's down is checked again every
+# BLOG_REPLICA_CHECK_SECONDS.
+DATABASE_ROUTERS = ['BlogApp.routers.ReplicaRouter']
+BLOG_REPLICAS = []
+BLOG_PRIMARY_STICKY_SECONDS = 10
+BLOG_REPLICA_CHECK_SECONDS = 30
+
+# Views declare a query budget (BlogApp/querybudget.py). Going over it logs a
+# warning, or raises an error when this is True.
+BLOG_QUERY_BUDGET_STRICT = False
+
+# Every request is timed (BlogApp/metrics.py) and the histograms are shown on
+# /metrics, for DEBUG or the addresses in INTERNAL_IPS. Requests slower than
+# BLOG_SLOW_REQUEST_MS are logged with their BLOG_SLOW_REQUEST_QUERIES slowest queries.
+INTERNAL_IPS = ['127.0.0.1']
+BLOG_SLOW_REQUEST_MS = 500
+BLOG_SLOW_REQUEST_QUERIES = 5
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# The sidebar is cached until a post or comment changes, or after this many seconds.
+BLOG_SIDEBAR_CACHE_TIMEOUT = 300
+
+# Post lists and posts are cached whole for anonymous visitors, and purged
+# when what they show changes (BlogApp/pagecache.py). 0 turns it off.
+# "python manage.py page_cache_stats" shows the hits and misses.
+# LocMemCache (above) keeps pages, purges and counters per process: with more
+# than one process, use a shared cache like Memcached or Redis, or purges
+# won't reach the other processes.
+BLOG_PAGE_CACHE_TIMEOUT = 600
+
+# Who answers post_search:
+# - 'BlogApp.search.postgres.PostgresSearchBackend' uses PostgreSQL full-text search.
+# - 'BlogApp.search.inverted.InvertedIndexBackend' uses our own index, stored in
+#   BLOG_SEARCH_INDEX_PATH, and works on any database (SQLite too).
+BLOG_SEARCH_BACKEND = 'BlogApp.search.postgres.PostgresSearchBackend'
+BLOG_SEARCH_INDEX_PATH = os.path.join(BASE_DIR, 'search.idx')
+# how much a word is worth in the title and in the body (inverted index only).
+BLOG_SEARCH_FIELD_WEIGHTS = {'title': 2.0, 'body': 1.0}
+
+# Search results are shown in pages of this size, up to BLOG_SEARCH_MAX_PAGES pages.
+BLOG_SEARCH_RESULTS_PER_PAGE = 10
+BLOG_SEARCH_MAX_PAGES = 50
+
+# The search box suggests up to BLOG_SUGGEST_LIMIT posts and tags as the
+# visitor types (BlogApp/suggest.py). Each process reads them again every
+# BLOG_SUGGEST_REFRESH_SECONDS (0 never), and browsers keep an answer
+# BLOG_SUGGEST_MAX_AGE seconds.
+BLOG_SUGGEST_LIMIT = 8
+BLOG_SUGGEST_REFRESH_SECONDS = 300
+BLOG_SUGGEST_MAX_AGE = 60
+
+# The admin counts the rows of a list up to BLOG_ADMIN_EXACT_COUNT_LIMIT and
+# estimates past that (BlogApp/pagination.py). Its post search finds up to
+# BLOG_ADMIN_SEARCH_LIMIT published posts in the search index.
+BLOG_ADMIN_EXACT_COUNT_LIMIT = 10000
+BLOG_ADMIN_SEARCH_LIMIT = 1000
+
+# How many similar posts are precomputed for each post.
+BLOG_RELATED_POSTS = 10
+
+# sitemap.xml is an index of one section per month, with up to this many URLs
+# each (50,000 at most). With BLOG_SITEMAP_DIR set to a folder, the files are
+# kept there and written again when their posts change.
+# "python manage.py build_sitemaps" writes all of them at once.
+BLOG_SITEMAP_SECTION_SIZE = 50000
+BLOG_SITEMAP_DIR = None
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -125,8 +212,45 @@ USE_TZ = False
 
 STATIC_URL = '/static/'
 
+# Blog posts lists are paginated by cursor ('cursor') or by page number ('page').
+BLOG_PAGINATION = 'cursor'
+
+# Each process remembers the post id of this many detail URLs (BlogApp/postlookup.py).
+BLOG_POST_ID_CACHE_SIZE = 1000
+
+# Post views are counted in memory and written every BLOG_VIEW_FLUSH_SECONDS
+# (0 turns it off). Popularity halves every BLOG_POPULARITY_HALF_LIFE_DAYS
+# without new views.
+BLOG_VIEW_FLUSH_SECONDS = 10
+BLOG_POPULARITY_HALF_LIFE_DAYS = 7
+
+# Posts show their comments BLOG_COMMENTS_PER_PAGE at a time, the next ones
+# are loaded from /BlogApp/<post id>/comments/.
+BLOG_COMMENTS_PER_PAGE = 20
+
+# The JSON API (BlogApp/api.py) answers pages of BLOG_API_PAGE_SIZE objects
+# (?limit= goes up to BLOG_API_MAX_PAGE_SIZE), read and written
+# BLOG_API_CHUNK_SIZE rows at a time.
+BLOG_API_PAGE_SIZE = 20
+BLOG_API_MAX_PAGE_SIZE = 500
+BLOG_API_CHUNK_SIZE = 100
+
+# With True (and Django 3.1 or newer, under ASGI) the views are async and
+# fetch the pieces of a page concurrently (BlogApp/asyncviews.py).
+BLOG_ASYNC_VIEWS = False
+
 EMAIL_HOST = config('EMAIL_HOST')
 EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 EMAIL_PORT = config('EMAIL_PORT')
 EMAIL_USE_TLS = config('EMAIL_USE_TLS')
+
+# post_share writes e-mails to an outbox, sent by BLOG_MAIL_WORKERS threads
+# of each web process, started by wsgi.py and asgi.py (0 means: run
+# "python manage.py send_queued_mail --loop" instead).
+BLOG_MAIL_WORKERS = 2
+BLOG_MAIL_BATCH_SIZE = 20
+# failed e-mails wait 30s, 1min, 2min... (up to an hour) and give up after 8 attempts.
+BLOG_MAIL_RETRY_DELAY = 30
+BLOG_MAIL_MAX_BACKOFF = 3600
+BLOG_MAIL_MAX_ATTEMPTS = 8
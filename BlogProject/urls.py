@@ -15,15 +15,18 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from django.contrib.sitemaps.views import sitemap
-from BlogApp.sitemaps import PostSitemap
-
-sitemaps = {
-    'posts': PostSitemap,
-}
+from BlogApp.conditional import conditional, feed_validators
+from BlogApp.metrics import metrics
+from BlogApp.sitemaps import sitemap_index, sitemap_section
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('BlogApp/', include('BlogApp.urls', namespace='BlogApp')),
-    path('sitemap.xml', sitemap, {'sitemaps': sitemaps}, name='django.contrib.sitemaps.views.sitemap'),
+    # the sitemaps change when the feed does: when a published post changes.
+    path('sitemap.xml', conditional(feed_validators)(sitemap_index), name='sitemap'),
+    path('sitemap-posts-<int:year>-<int:month>.xml',
+         conditional(feed_validators)(sitemap_section), name='sitemap_section'),
+    path('sitemap-posts-<int:year>-<int:month>-<int:page>.xml',
+         conditional(feed_validators)(sitemap_section), name='sitemap_section_page'),
+    path('metrics', metrics, name='metrics'),
 ]
\ No newline at end of file
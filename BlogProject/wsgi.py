@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BlogProject.settings')
 
 application = get_wsgi_application()
+
+# The web server's processes send the outbox (see BlogApp/mailqueue.py).
+from BlogApp.mailqueue import start_workers  # noqa: E402
+
+start_workers()